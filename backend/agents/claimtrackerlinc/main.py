@@ -1,5 +1,6 @@
 from fastapi import FastAPI, Depends, HTTPException, Body, status, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import Dict, List, Any, Optional
 import httpx
 import os
@@ -9,7 +10,11 @@ from urllib.parse import urljoin
 import logging
 import hashlib
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, validator
+
+from claim_store import ClaimStore, ClaimExists, project, normalize_service_date
+from duplicate_index import DuplicateIndex
+from change_feed import ChangeFeed
 
 # Configure logging
 logging.basicConfig(
@@ -34,6 +39,28 @@ PORT = int(os.environ.get("PORT", 3008))
 ENVIRONMENT = os.environ.get("ENVIRONMENT", "development")
 FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "http://fhir-gateway:8000/fhir")
 AUTH_SERVICE_URL = os.environ.get("AUTH_SERVICE_URL", "http://authlinc:3003")
+BULK_TRACK_MAX_CLAIMS = int(os.environ.get("BULK_TRACK_MAX_CLAIMS", 10000))
+
+# Indexed claim storage; imports data/tracked_claims.json on first start
+claim_store = ClaimStore()
+
+# Duplicate detection indexes, rebuilt from the store at startup
+duplicate_index = DuplicateIndex()
+for stored_claim in claim_store.iter_claims():
+    duplicate_index.add(
+        stored_claim["claim_id"],
+        stored_claim["patient_id"],
+        stored_claim["date_of_service"],
+        stored_claim.get("hash_signature"),
+        stored_claim.get("procedures", [])
+    )
+logger.info(f"Duplicate index loaded with {len(duplicate_index)} claims")
+
+# Wakes change-feed consumers whenever the store commits claim events
+change_feed = ChangeFeed(claim_store.last_offset())
+claim_store.listeners.append(change_feed.notify)
+EVENT_PAGE_SIZE = int(os.environ.get("CLAIM_EVENT_PAGE_SIZE", 500))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("CLAIM_EVENT_HEARTBEAT", 15))
 
 # Data models
 class ClaimIdentifier(BaseModel):
@@ -59,6 +86,15 @@ class Claim(BaseModel):
     status: str = "draft"
     hash_signature: Optional[str] = None
 
+    @validator('date_of_service')
+    def date_of_service_is_iso(cls, v):
+        # The store indexes claims by this date, so reject it here rather than on insert
+        try:
+            normalize_service_date(v)
+        except ValueError:
+            raise ValueError('date_of_service must be an ISO 8601 date')
+        return v
+
 class TrackedClaim(BaseModel):
     claim: Claim
     tracking_events: List[Dict[str, Any]] = []
@@ -117,13 +153,7 @@ async def track_claim(
     Track a new claim and perform duplicate detection
     """
     # Generate hash signature for duplicate detection
-    hash_input = f"{claim.patient_id}|{claim.date_of_service}|{claim.total_charge}"
-    for proc in claim.procedures:
-        hash_input += f"|{proc.get('code')}"
-    for diag in claim.diagnoses:
-        hash_input += f"|{diag.get('code')}"
-    
-    claim.hash_signature = hashlib.md5(hash_input.encode()).hexdigest()
+    claim.hash_signature = compute_hash_signature(claim)
     
     # Check for duplicates
     duplicate_check = await check_for_duplicates(claim)
@@ -142,23 +172,20 @@ async def track_claim(
         duplicate_check_result=duplicate_check
     )
     
-    # In a real implementation, this would save to a database
-    # For now, we'll save to a local file for demonstration
-    claims_file = "data/tracked_claims.json"
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
-        else:
-            claims_data = []
-        
-        # Convert to dict for JSON serialization
-        claims_data.append(tracked_claim.dict())
-        
-        with open(claims_file, "w") as f:
-            json.dump(claims_data, f, indent=2)
+        claim_store.add(tracked_claim.dict())
+    except ClaimExists as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         logger.error(f"Error saving claim tracking data: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error saving claim, it was not tracked: {str(e)}"
+        )
+    duplicate_index.add(claim.claim_id, claim.patient_id, claim.date_of_service, claim.hash_signature, claim.procedures)
     
     return {
         "tracking_id": claim.claim_id,
@@ -166,72 +193,164 @@ async def track_claim(
         "duplicate_check": duplicate_check
     }
 
-async def check_for_duplicates(claim: Claim) -> Dict[str, Any]:
+@app.post("/claims/track/bulk")
+async def track_claims_bulk(
+    request: Request,
+    user_data: Dict = Depends(validate_token)
+):
     """
-    Check for duplicate claims
+    Track a batch of claims (JSON array or NDJSON) in one transaction
+
+    Each claim is checked against tracked history and against the claims before
+    it in the batch; the response carries a result per claim in input order.
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    claims_file = "data/tracked_claims.json"
+    body = await request.body()
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
+        if "ndjson" in request.headers.get("content-type", ""):
+            entries = [json.loads(line) for line in body.splitlines() if line.strip()]
         else:
-            return {"is_duplicate": False, "duplicate_claims": []}
-        
-        # Find potential duplicates
-        potential_duplicates = []
-        exact_match = False
+            entries = json.loads(body)
+            if isinstance(entries, dict):
+                entries = entries.get("claims", [])
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid claim batch: {str(e)}"
+        )
+    if not isinstance(entries, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Claim batch must be a JSON array or NDJSON"
+        )
+    if len(entries) > BULK_TRACK_MAX_CLAIMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch of {len(entries)} claims exceeds the limit of {BULK_TRACK_MAX_CLAIMS}"
+        )
+    
+    timestamp = datetime.now().isoformat()
+    user_id = user_data.get("sub", "unknown")
+    # Claims earlier in the batch, so duplicates within the batch are caught too
+    batch_index = duplicate_index.scratch()
+    results = []
+    tracked_claims = []
+    # Ids tracked before this batch, and ids taken by earlier entries of it
+    already_tracked = claim_store.existing([e["claim_id"] for e in entries
+                                            if isinstance(e, dict) and isinstance(e.get("claim_id"), str)])
+    batch_ids = set()
+    
+    for position, entry in enumerate(entries):
+        try:
+            claim = Claim(**entry)
+        except (ValidationError, TypeError) as e:
+            results.append({"index": position, "claim_id": entry.get("claim_id") if isinstance(entry, dict) else None,
+                            "status": "rejected", "error": str(e)})
+            continue
+        if claim.claim_id in already_tracked or claim.claim_id in batch_ids:
+            results.append({"index": position, "claim_id": claim.claim_id, "status": "rejected",
+                            "error": f"Claim {claim.claim_id} is already tracked" if claim.claim_id in already_tracked
+                                     else f"Claim {claim.claim_id} appears earlier in the batch"})
+            continue
         
-        for tracked_claim in claims_data:
-            existing_claim = tracked_claim["claim"]
-            
-            # Check for exact hash match
-            if existing_claim.get("hash_signature") == claim.hash_signature and existing_claim.get("claim_id") != claim.claim_id:
-                exact_match = True
-                potential_duplicates.append({
-                    "claim_id": existing_claim.get("claim_id"),
-                    "patient_id": existing_claim.get("patient_id"),
-                    "date_of_service": existing_claim.get("date_of_service"),
-                    "match_type": "exact",
-                    "similarity": 1.0
-                })
-                continue
-            
-            # Check for potential duplicates (same patient, DOS, similar procedures)
-            if (existing_claim.get("patient_id") == claim.patient_id and
-                existing_claim.get("date_of_service") == claim.date_of_service and
-                existing_claim.get("claim_id") != claim.claim_id):
-                
-                # Simple similarity calculation based on procedures
-                existing_procs = set(p.get("code") for p in existing_claim.get("procedures", []))
-                new_procs = set(p.get("code") for p in claim.procedures)
-                
-                if existing_procs and new_procs:
-                    intersection = existing_procs.intersection(new_procs)
-                    union = existing_procs.union(new_procs)
-                    similarity = len(intersection) / len(union)
-                    
-                    if similarity > 0.5:  # Threshold for potential duplicate
-                        potential_duplicates.append({
-                            "claim_id": existing_claim.get("claim_id"),
-                            "patient_id": existing_claim.get("patient_id"),
-                            "date_of_service": existing_claim.get("date_of_service"),
-                            "match_type": "potential",
-                            "similarity": similarity
-                        })
+        claim.hash_signature = compute_hash_signature(claim)
+        try:
+            batch_check = batch_index.check(claim.claim_id, claim.patient_id, claim.date_of_service,
+                                            claim.hash_signature, claim.procedures)
+            batch_index.add(claim.claim_id, claim.patient_id, claim.date_of_service, claim.hash_signature, claim.procedures)
+        except ValueError as e:
+            results.append({"index": position, "claim_id": claim.claim_id, "status": "rejected", "error": str(e)})
+            continue
+        duplicate_check = merge_duplicate_checks(await check_for_duplicates(claim), batch_check)
+        batch_ids.add(claim.claim_id)
         
-        return {
-            "is_duplicate": exact_match,
-            "duplicate_claims": potential_duplicates,
-            "needs_review": len(potential_duplicates) > 0 and not exact_match
-        }
+        tracked_claims.append(TrackedClaim(
+            claim=claim,
+            tracking_events=[
+                {
+                    "event_type": "created",
+                    "timestamp": timestamp,
+                    "user_id": user_id,
+                    "notes": "Initial claim tracking started (bulk import)"
+                }
+            ],
+            duplicate_check_result=duplicate_check
+        ))
+        results.append({"index": position, "claim_id": claim.claim_id, "status": "tracked",
+                        "duplicate_check": duplicate_check})
+    
+    try:
+        claim_store.add_many([tracked_claim.dict() for tracked_claim in tracked_claims])
+    except ClaimExists as e:
+        # Tracked by a concurrent request since the batch was checked
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"{str(e)}, no claims were tracked"
+        )
+    except Exception as e:
+        logger.error(f"Error saving bulk claim tracking data: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error saving claims, no claims were tracked: {str(e)}"
+        )
+    # The shared index only learns about the batch once it is committed
+    for tracked_claim in tracked_claims:
+        claim = tracked_claim.claim
+        duplicate_index.add(claim.claim_id, claim.patient_id, claim.date_of_service, claim.hash_signature, claim.procedures)
+    
+    return {
+        "tracked": len(tracked_claims),
+        "rejected": len(results) - len(tracked_claims),
+        "duplicates": sum(1 for r in results if r.get("duplicate_check", {}).get("is_duplicate")),
+        "needs_review": sum(1 for r in results if r.get("duplicate_check", {}).get("needs_review")),
+        "results": results
+    }
+
+def compute_hash_signature(claim: Claim) -> str:
+    """Signature of the fields that make two claims exact duplicates"""
+    hash_input = f"{claim.patient_id}|{claim.date_of_service}|{claim.total_charge}"
+    for proc in claim.procedures:
+        hash_input += f"|{proc.get('code')}"
+    for diag in claim.diagnoses:
+        hash_input += f"|{diag.get('code')}"
+    return hashlib.md5(hash_input.encode()).hexdigest()
+
+def merge_duplicate_checks(history: Dict[str, Any], batch: Dict[str, Any]) -> Dict[str, Any]:
+    """Combine duplicate check results against history and against the current batch"""
+    seen = {match["claim_id"] for match in history["duplicate_claims"]}
+    duplicates = history["duplicate_claims"] + [
+        match for match in batch["duplicate_claims"] if match["claim_id"] not in seen
+    ]
+    is_duplicate = history.get("is_duplicate", False) or batch["is_duplicate"]
+    return {
+        "is_duplicate": is_duplicate,
+        "duplicate_claims": duplicates,
+        "needs_review": len(duplicates) > 0 and not is_duplicate
+    }
+
+async def check_for_duplicates(claim: Claim) -> Dict[str, Any]:
+    """
+    Check for duplicate claims
+    """
+    try:
+        # Exact hash, same-day and date-window (LSH) matches from the in-memory indexes
+        return duplicate_index.check(
+            claim.claim_id,
+            claim.patient_id,
+            claim.date_of_service,
+            claim.hash_signature,
+            claim.procedures
+        )
     except Exception as e:
         logger.error(f"Error checking for duplicates: {str(e)}")
         return {"is_duplicate": False, "duplicate_claims": [], "error": str(e)}
 
+# Page size limits for GET /claims
+DEFAULT_PAGE_SIZE = int(os.environ.get("CLAIMS_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.environ.get("CLAIMS_MAX_PAGE_SIZE", 1000))
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    return [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
 @app.get("/claims")
 async def get_claims(
     patient_id: Optional[str] = None,
@@ -240,62 +359,84 @@ async def get_claims(
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
     has_duplicate: Optional[bool] = None,
+    sort: str = Query("date_of_service", description="Sort column, prefix with - for descending"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. claim.claim_id,claim.status"),
     user_data: Dict = Depends(validate_token)
 ):
     """
-    Get tracked claims with filtering options
+    Get tracked claims with filtering options, one page at a time
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    claims_file = "data/tracked_claims.json"
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
-        else:
-            return {"claims": []}
-        
-        # Apply filters
-        filtered_claims = claims_data
-        
-        if patient_id:
-            filtered_claims = [c for c in filtered_claims if c["claim"]["patient_id"] == patient_id]
-        
-        if provider_id:
-            filtered_claims = [c for c in filtered_claims if c["claim"]["provider_id"] == provider_id]
-        
-        if status:
-            filtered_claims = [c for c in filtered_claims if c["claim"]["status"] == status]
-        
-        if date_from:
-            date_from_obj = datetime.fromisoformat(date_from.replace("Z", "+00:00"))
-            filtered_claims = [
-                c for c in filtered_claims if 
-                datetime.fromisoformat(c["claim"]["date_of_service"].replace("Z", "+00:00")) >= date_from_obj
-            ]
-        
-        if date_to:
-            date_to_obj = datetime.fromisoformat(date_to.replace("Z", "+00:00"))
-            filtered_claims = [
-                c for c in filtered_claims if 
-                datetime.fromisoformat(c["claim"]["date_of_service"].replace("Z", "+00:00")) <= date_to_obj
-            ]
-        
-        if has_duplicate is not None:
-            filtered_claims = [
-                c for c in filtered_claims if 
-                (c.get("duplicate_check_result", {}).get("is_duplicate", False) == has_duplicate)
-            ]
+        # Filters, sorting and keyset pagination are applied by the store on its indexes
+        page, next_cursor = claim_store.page(
+            sort=sort,
+            after=cursor,
+            limit=limit,
+            patient_id=patient_id,
+            provider_id=provider_id,
+            status=status,
+            date_from=date_from,
+            date_to=date_to,
+            has_duplicate=has_duplicate
+        )
         
-        return {"claims": filtered_claims}
+        projection = parse_fields(fields)
+        return {
+            "claims": [project(tracked_claim, projection) for tracked_claim in page],
+            "next_cursor": next_cursor
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error retrieving claims: {str(e)}")
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            status_code=500,
             detail=f"Error retrieving claims: {str(e)}"
         )
 
+@app.get("/claims/export")
+async def export_claims(
+    patient_id: Optional[str] = None,
+    provider_id: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    has_duplicate: Optional[bool] = None,
+    sort: str = "date_of_service",
+    fields: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Stream every matching tracked claim as NDJSON, one claim per line
+    """
+    projection = parse_fields(fields)
+    filters = {
+        "patient_id": patient_id,
+        "provider_id": provider_id,
+        "status": status,
+        "date_from": date_from,
+        "date_to": date_to,
+        "has_duplicate": has_duplicate
+    }
+    try:
+        # Validate the sort column before the response starts streaming
+        first_page, next_cursor = claim_store.page(sort=sort, limit=MAX_PAGE_SIZE, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    def generate():
+        page, cursor = first_page, next_cursor
+        while True:
+            for tracked_claim in page:
+                yield json.dumps(project(tracked_claim, projection)) + "\n"
+            if cursor is None:
+                break
+            page, cursor = claim_store.page(sort=sort, after=cursor, limit=MAX_PAGE_SIZE, **filters)
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @app.get("/claims/{claim_id}")
 async def get_claim(
     claim_id: str,
@@ -304,18 +445,10 @@ async def get_claim(
     """
     Get details for a specific claim
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    claims_file = "data/tracked_claims.json"
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
-            
-            for claim in claims_data:
-                if claim["claim"]["claim_id"] == claim_id:
-                    return claim
+        tracked_claim = claim_store.get(claim_id)
+        if tracked_claim is not None:
+            return tracked_claim
         
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -339,53 +472,25 @@ async def update_claim_status(
     """
     Update the status of a claim
     """
-    # In a real implementation, this would update a database
-    # This is a mock implementation for demonstration
-    
-    claims_file = "data/tracked_claims.json"
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
-            
-            claim_updated = False
-            for i, claim in enumerate(claims_data):
-                if claim["claim"]["claim_id"] == claim_id:
-                    # Update claim status
-                    claims_data[i]["claim"]["status"] = status_update.status
-                    
-                    # Add tracking event
-                    claims_data[i]["tracking_events"].append({
-                        "event_type": "status_update",
-                        "timestamp": datetime.now().isoformat(),
-                        "user_id": status_update.updated_by or user_data.get("sub", "unknown"),
-                        "old_status": claim["claim"]["status"],
-                        "new_status": status_update.status,
-                        "notes": status_update.notes
-                    })
-                    
-                    claim_updated = True
-                    break
-            
-            if not claim_updated:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail=f"Claim with ID {claim_id} not found"
-                )
-            
-            with open(claims_file, "w") as f:
-                json.dump(claims_data, f, indent=2)
-            
-            return {
-                "status": "updated",
-                "claim_id": claim_id,
-                "new_status": status_update.status
-            }
-        else:
+        old_status = claim_store.update_status(claim_id, status_update.status, {
+            "event_type": "status_update",
+            "timestamp": datetime.now().isoformat(),
+            "user_id": status_update.updated_by or user_data.get("sub", "unknown"),
+            "notes": status_update.notes
+        })
+        
+        if old_status is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Claim with ID {claim_id} not found"
             )
+        
+        return {
+            "status": "updated",
+            "claim_id": claim_id,
+            "new_status": status_update.status
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -404,64 +509,14 @@ async def analyze_duplicates(
     """
     Get analytics on duplicate claims
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    claims_file = "data/tracked_claims.json"
     try:
-        if os.path.exists(claims_file):
-            with open(claims_file, "r") as f:
-                claims_data = json.load(f)
-        else:
-            claims_data = []
-        
-        # Filter by date if provided
-        if date_from:
-            date_from_obj = datetime.fromisoformat(date_from.replace("Z", "+00:00"))
-            claims_data = [
-                c for c in claims_data if 
-                datetime.fromisoformat(c["claim"]["date_of_service"].replace("Z", "+00:00")) >= date_from_obj
-            ]
-        
-        if date_to:
-            date_to_obj = datetime.fromisoformat(date_to.replace("Z", "+00:00"))
-            claims_data = [
-                c for c in claims_data if 
-                datetime.fromisoformat(c["claim"]["date_of_service"].replace("Z", "+00:00")) <= date_to_obj
-            ]
-        
-        # Calculate duplicate statistics
-        total_claims = len(claims_data)
-        exact_duplicates = sum(1 for c in claims_data if c.get("duplicate_check_result", {}).get("is_duplicate", False))
-        potential_duplicates = sum(
-            1 for c in claims_data if 
-            not c.get("duplicate_check_result", {}).get("is_duplicate", False) and 
-            len(c.get("duplicate_check_result", {}).get("duplicate_claims", [])) > 0
-        )
-        
-        # Calculate potential financial impact
-        financial_impact = sum(
-            c["claim"]["total_charge"] for c in claims_data 
-            if c.get("duplicate_check_result", {}).get("is_duplicate", False)
-        )
-        
-        # Group duplicates by provider
-        provider_duplicates = {}
-        for claim in claims_data:
-            if claim.get("duplicate_check_result", {}).get("is_duplicate", False) or len(claim.get("duplicate_check_result", {}).get("duplicate_claims", [])) > 0:
-                provider_id = claim["claim"]["provider_id"]
-                provider_name = claim["claim"]["provider_name"]
-                
-                if provider_id not in provider_duplicates:
-                    provider_duplicates[provider_id] = {
-                        "provider_id": provider_id,
-                        "provider_name": provider_name,
-                        "duplicate_count": 0,
-                        "total_charge": 0
-                    }
-                
-                provider_duplicates[provider_id]["duplicate_count"] += 1
-                provider_duplicates[provider_id]["total_charge"] += claim["claim"]["total_charge"]
+        # Sum the incrementally maintained day/provider buckets for the range
+        summary = claim_store.duplicate_summary(date_from=date_from, date_to=date_to)
+        total_claims = summary["total_claims"]
+        exact_duplicates = summary["exact_duplicates"]
+        potential_duplicates = summary["potential_duplicates"]
+        financial_impact = summary["financial_impact"]
+        provider_duplicates = {p["provider_id"]: p for p in summary["provider_analysis"]}
         
         return {
             "total_claims": total_claims,
@@ -469,7 +524,8 @@ async def analyze_duplicates(
             "potential_duplicates": potential_duplicates,
             "duplicate_percentage": (exact_duplicates + potential_duplicates) / total_claims * 100 if total_claims > 0 else 0,
             "financial_impact": financial_impact,
-            "provider_analysis": list(provider_duplicates.values())
+            "provider_analysis": list(provider_duplicates.values()),
+            "status_breakdown": summary["status_breakdown"]
         }
     except Exception as e:
         logger.error(f"Error analyzing duplicates: {str(e)}")
@@ -478,6 +534,67 @@ async def analyze_duplicates(
             detail=f"Error analyzing duplicates: {str(e)}"
         )
 
+@app.get("/events")
+async def get_claim_events(
+    after: int = Query(0, ge=0, description="Return events with an offset greater than this"),
+    limit: int = Query(EVENT_PAGE_SIZE, ge=1, le=5000),
+    wait: float = Query(0, ge=0, le=60, description="Seconds to long-poll when no events are available"),
+    claim_id: Optional[str] = None,
+    event_type: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Read the claim event log from an offset, optionally long-polling for new events
+    """
+    offset = after
+    events = claim_store.events_after(offset, limit, claim_id=claim_id, event_type=event_type)
+    if not events:
+        # Nothing matched up to the head, so skip past events the filters exclude
+        offset = max(offset, change_feed.head)
+        if wait > 0 and await change_feed.wait(offset, wait):
+            events = claim_store.events_after(offset, limit, claim_id=claim_id, event_type=event_type)
+            if not events:
+                offset = max(offset, change_feed.head)
+    
+    return {
+        "events": events,
+        "next_offset": events[-1]["offset"] if events else offset,
+        "head_offset": change_feed.head
+    }
+
+@app.get("/events/stream")
+async def stream_claim_events(
+    request: Request,
+    after: Optional[int] = Query(None, ge=0, description="Resume after this offset (or send Last-Event-ID)"),
+    claim_id: Optional[str] = None,
+    event_type: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Stream claim events as server-sent events, resuming from an offset
+    """
+    if after is None:
+        last_event_id = request.headers.get("last-event-id")
+        after = int(last_event_id) if last_event_id and last_event_id.isdigit() else change_feed.head
+    
+    async def generate():
+        offset = after
+        while not await request.is_disconnected():
+            events = claim_store.events_after(offset, EVENT_PAGE_SIZE, claim_id=claim_id, event_type=event_type)
+            for event in events:
+                yield f"id: {event['offset']}\nevent: {event['event_type']}\ndata: {json.dumps(event)}\n\n"
+            if events:
+                offset = events[-1]["offset"]
+                if len(events) == EVENT_PAGE_SIZE:
+                    continue
+            else:
+                # Nothing matched up to the head, so skip past events the filters exclude
+                offset = max(offset, change_feed.head)
+            if not await change_feed.wait(offset, SSE_HEARTBEAT_SECONDS):
+                yield ": keep-alive\n\n"
+    
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 # Main execution for direct running
 if __name__ == "__main__":
     # Ensure data directory exists
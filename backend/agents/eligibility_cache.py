@@ -0,0 +1,187 @@
+"""
+Eligibility Cache
+TTL cache of NPHIES eligibility results keyed by patient identity, insurer and
+service date. Ineligible results are cached for a shorter time, and entries are
+dropped when the patient's coverage changes.
+
+Set ELIGIBILITY_CACHE_URL to a redis:// URL to share the cache between
+ClaimLinc workers and the agents service. Both services ship an identical copy
+of this module, so keep them in sync.
+"""
+
+import os
+import json
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Dict, Any, Optional, Tuple, Union
+
+# Lifetime of cached results, in seconds
+ELIGIBILITY_CACHE_TTL = int(os.environ.get("ELIGIBILITY_CACHE_TTL", "3600"))
+ELIGIBILITY_NEGATIVE_TTL = int(os.environ.get("ELIGIBILITY_NEGATIVE_TTL", "300"))
+ELIGIBILITY_CACHE_MAX_PATIENTS = int(os.environ.get("ELIGIBILITY_CACHE_MAX_PATIENTS", "50000"))
+
+def normalize_identity(national_id: Any) -> str:
+    """Normalise a national ID or iqama number to its ASCII digits"""
+    # int() also maps Arabic-Indic digits to their values
+    return "".join(str(int(c)) for c in str(national_id or "") if c.isdigit())
+
+def normalize_insurer(insurer_id: Any) -> str:
+    return str(insurer_id or "").strip().lower()
+
+def insurer_of(insurance: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Return the insurer (payer) ID that cache entries are keyed by"""
+    if not insurance:
+        return None
+    return insurance.get("provider_id") or insurance.get("provider")
+
+def normalize_service_date(service_date: Union[str, date, datetime, None]) -> str:
+    """Reduce a service date to YYYY-MM-DD, defaulting to today"""
+    if service_date is None:
+        return date.today().isoformat()
+    if isinstance(service_date, (date, datetime)):
+        return service_date.isoformat()[:10]
+    return str(service_date).strip()[:10]
+
+def coverage_fingerprint(insurance: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Summarise the coverage details that, when changed, invalidate cached results"""
+    if not insurance:
+        return None
+    fields = ("id", "policy_number", "member_id", "plan_name", "provider_id")
+    return "|".join(str(insurance.get(field, "")).strip().lower() for field in fields)
+
+class EligibilityCache(ABC):
+    """Store for eligibility results, grouped per patient and insurer"""
+
+    def __init__(self, ttl: int = ELIGIBILITY_CACHE_TTL, negative_ttl: int = ELIGIBILITY_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    async def get(self, national_id: Any, insurer_id: Any, service_date: Any = None,
+                  fingerprint: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached eligibility info, if still fresh
+
+        A fingerprint that differs from the one stored with the result means the
+        coverage changed, so every cached result for the patient and insurer is dropped.
+        """
+        identity, insurer = normalize_identity(national_id), normalize_insurer(insurer_id)
+        if not identity:
+            return None
+        entry = await self._read(identity, insurer, normalize_service_date(service_date))
+        if entry is None or entry["expires_at"] <= time.time():
+            self.stats["misses"] += 1
+            return None
+        if fingerprint is not None and entry.get("fingerprint") not in (None, fingerprint):
+            await self.invalidate(national_id, insurer_id)
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return entry["info"]
+
+    async def set(self, national_id: Any, insurer_id: Any, service_date: Any,
+                  info: Dict[str, Any], fingerprint: Optional[str] = None) -> None:
+        """Cache eligibility info, for a shorter time when the patient is not eligible"""
+        identity, insurer = normalize_identity(national_id), normalize_insurer(insurer_id)
+        if not identity:
+            return
+        ttl = self.ttl if info.get("is_eligible") else self.negative_ttl
+        expires_at = time.time() + ttl
+
+        # Never serve a positive result past the end of the coverage period
+        period_end = (info.get("coverage_period") or {}).get("end")
+        if info.get("is_eligible") and period_end:
+            try:
+                end = datetime.fromisoformat(str(period_end)[:10]).timestamp() + 86400
+                expires_at = min(expires_at, end)
+            except ValueError:
+                pass
+        if expires_at <= time.time():
+            return
+
+        entry = {"expires_at": expires_at, "fingerprint": fingerprint, "info": info}
+        await self._write(identity, insurer, normalize_service_date(service_date), entry)
+
+    async def invalidate(self, national_id: Any, insurer_id: Any = None) -> None:
+        """Drop cached results for a patient, for one insurer or all of them"""
+        identity = normalize_identity(national_id)
+        if not identity:
+            return
+        self.stats["invalidations"] += 1
+        await self._delete(identity, normalize_insurer(insurer_id) if insurer_id else None)
+
+    @abstractmethod
+    async def _read(self, identity: str, insurer: str, service_date: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def _write(self, identity: str, insurer: str, service_date: str, entry: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def _delete(self, identity: str, insurer: Optional[str]) -> None:
+        ...
+
+class InMemoryEligibilityCache(EligibilityCache):
+    """Per-process eligibility cache"""
+
+    def __init__(self, max_patients: int = ELIGIBILITY_CACHE_MAX_PATIENTS, **kwargs):
+        super().__init__(**kwargs)
+        self.max_patients = max_patients
+        self._entries: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = {}
+
+    async def _read(self, identity: str, insurer: str, service_date: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get((identity, insurer), {}).get(service_date)
+
+    async def _write(self, identity: str, insurer: str, service_date: str, entry: Dict[str, Any]) -> None:
+        key = (identity, insurer)
+        dates = self._entries.pop(key, {})
+        dates[service_date] = entry
+        # Reinsert so the least recently written patients are evicted first
+        self._entries[key] = dates
+        while len(self._entries) > self.max_patients:
+            self._entries.pop(next(iter(self._entries)))
+
+    async def _delete(self, identity: str, insurer: Optional[str]) -> None:
+        for key in [key for key in self._entries if key[0] == identity and insurer in (None, key[1])]:
+            del self._entries[key]
+
+class RedisEligibilityCache(EligibilityCache):
+    """Eligibility cache shared through Redis, one hash per patient and insurer"""
+
+    def __init__(self, url: str, key_prefix: str = "nphies:eligibility:", **kwargs):
+        super().__init__(**kwargs)
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self.key_prefix = key_prefix
+
+    def _key(self, identity: str, insurer: str) -> str:
+        return f"{self.key_prefix}{identity}:{insurer}"
+
+    async def _read(self, identity: str, insurer: str, service_date: str) -> Optional[Dict[str, Any]]:
+        raw = await self._redis.hget(self._key(identity, insurer), service_date)
+        return json.loads(raw) if raw else None
+
+    async def _write(self, identity: str, insurer: str, service_date: str, entry: Dict[str, Any]) -> None:
+        key = self._key(identity, insurer)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, service_date, json.dumps(entry))
+            # Entries carry their own expiry; the hash just outlives the longest of them
+            pipe.expire(key, max(self.ttl, self.negative_ttl))
+            await pipe.execute()
+
+    async def _delete(self, identity: str, insurer: Optional[str]) -> None:
+        if insurer is not None:
+            await self._redis.delete(self._key(identity, insurer))
+            return
+        keys = [key async for key in self._redis.scan_iter(match=f"{self.key_prefix}{identity}:*")]
+        if keys:
+            await self._redis.delete(*keys)
+
+def create_eligibility_cache(url: Optional[str] = None) -> EligibilityCache:
+    """Create the eligibility cache named by ``url`` or ELIGIBILITY_CACHE_URL"""
+    url = url or os.environ.get("ELIGIBILITY_CACHE_URL")
+    if url and url.startswith(("redis://", "rediss://")):
+        return RedisEligibilityCache(url)
+    return InMemoryEligibilityCache()
@@ -16,6 +16,8 @@ from datetime import datetime, timedelta
 import httpx
 import uuid
 
+from eligibility_cache import create_eligibility_cache
+
 # Configure logging
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
@@ -43,6 +45,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Eligibility results cached by ClaimLinc from NPHIES, shared via ELIGIBILITY_CACHE_URL
+eligibility_cache = create_eligibility_cache()
+
 # Models for Agent Inputs and Outputs
 class DiagnosticInput(BaseModel):
     patient_data: Dict[str, Any]
@@ -113,6 +118,7 @@ class DiagnosticOutput(BaseModel):
 class EligibilityInput(BaseModel):
     national_id: str
     insurance_id: str
+    insurer_id: Optional[str] = None  # payer ID, the key NPHIES results are cached under
     check_date: datetime
     priority: str = "normal"
 
@@ -225,6 +231,26 @@ async def execute_diagnostic_agent(input_data: DiagnosticInput):
 async def execute_eligibility_agent(input_data: EligibilityInput):
     """Execute EligibilityLinc agent for smart eligibility verification"""
     try:
+        # Prefer a recent NPHIES result for the same patient, insurer and service date
+        # insurance_id is the policy; cached results are keyed by the insurer
+        cached = None
+        if input_data.insurer_id:
+            cached = await eligibility_cache.get(input_data.national_id, input_data.insurer_id, input_data.check_date)
+        if cached is not None:
+            is_eligible = cached.get("is_eligible", False)
+            period_end = (cached.get("coverage_period") or {}).get("end")
+            return EligibilityOutput(
+                is_eligible=is_eligible,
+                policy_details={
+                    "policy_number": f"POL-{input_data.insurance_id}",
+                    "benefits": cached.get("benefit_details", []),
+                    "source": "nphies"
+                },
+                coverage=0.80 if is_eligible else 0.0,
+                valid_until=datetime.fromisoformat(period_end[:10]) if period_end else datetime.now(),
+                retry_count=0
+            )
+        
         # Simulate eligibility check with retry logic
         is_eligible = len(input_data.national_id) == 10  # Simple validation
         
@@ -1,5 +1,6 @@
-from fastapi import FastAPI, Depends, HTTPException, Body, status, Request
+from fastapi import FastAPI, Depends, HTTPException, Body, status, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import Dict, List, Any, Optional
 import httpx
 import os
@@ -9,6 +10,11 @@ from urllib.parse import urljoin
 import logging
 from pydantic import BaseModel
 
+from rule_engine import RuleEngine, ValidationMemo
+from validation_cache import ValidationCache
+from terminology import Terminology
+from bundle_audit import BundleAuditor
+
 # Configure logging
 logging.basicConfig(
     level=logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper()),
@@ -33,6 +39,18 @@ ENVIRONMENT = os.environ.get("ENVIRONMENT", "development")
 FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "http://fhir-gateway:8000/fhir")
 AUTH_SERVICE_URL = os.environ.get("AUTH_SERVICE_URL", "http://authlinc:3003")
 
+# Largest number of claims accepted by one /validate/batch request
+VALIDATE_BATCH_MAX_CLAIMS = int(os.environ.get("VALIDATE_BATCH_MAX_CLAIMS", "10000"))
+
+# Diagnosis-procedure rules compiled into code interval tables, recompiled when the file changes
+rule_engine = RuleEngine()
+# Recent validations by normalised claim, emptied whenever the rule set changes
+validation_cache = ValidationCache()
+# Code system tables, memory-mapped on first use
+terminology = Terminology()
+# Whole-bundle coding audit, fanned out to worker processes for large bundles
+bundle_auditor = BundleAuditor(rule_engine, terminology, validation_cache)
+
 # Data models
 class DiagnosisCode(BaseModel):
     code: str
@@ -49,8 +67,42 @@ class ValidationRequest(BaseModel):
     procedure_codes: List[ProcedureCode]
     patient_id: Optional[str] = None
     encounter_id: Optional[str] = None
+    payer_id: Optional[str] = None
     additional_context: Optional[Dict[str, Any]] = None
 
+class BatchClaim(BaseModel):
+    claim_id: Optional[str] = None
+    diagnosis_codes: List[str]
+    procedure_codes: List[str]
+    payer_id: Optional[str] = None
+
+class BatchValidationRequest(BaseModel):
+    claims: List[BatchClaim]
+
+class TerminologyCode(BaseModel):
+    system: str
+    code: str
+
+class TerminologyValidationRequest(BaseModel):
+    codes: List[TerminologyCode]
+    date: Optional[str] = None
+
+DOCUMENTATION_GUIDANCE = [
+    "Ensure documentation clearly connects the diagnosis to the procedures performed",
+    "Document the medical necessity for each procedure",
+    "Include severity and impact on patient's function where appropriate"
+]
+
+def claim_validation(validation_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Overall validation result for one claim's procedure results"""
+    overall_valid = all(r["is_valid"] for r in validation_results)
+    return {
+        "validation_results": validation_results,
+        "overall_valid": overall_valid,
+        # Add documentation guidance if issues were found
+        "documentation_guidance": [] if overall_valid else list(DOCUMENTATION_GUIDANCE)
+    }
+
 # Authentication middleware
 async def validate_token(request: Request) -> Dict[str, Any]:
     auth_header = request.headers.get("Authorization")
@@ -82,6 +134,11 @@ async def validate_token(request: Request) -> Dict[str, Any]:
             detail=f"Authentication error: {str(e)}",
         )
 
+@app.on_event("shutdown")
+async def stop_audit_workers():
+    """Stop the bundle audit worker processes on shutdown"""
+    bundle_auditor.shutdown()
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
@@ -96,77 +153,97 @@ async def validate_diagnosis_procedure_match(
     """
     Validate if the provided diagnosis codes support the procedure codes
     """
-    # In a real implementation, this would use rules-based logic or ML models to validate
-    # Here we're using a mock implementation for demonstration
-    
-    diagnosis_codes = [d.code for d in validation_request.diagnosis_codes]
-    procedure_codes = [p.code for p in validation_request.procedure_codes]
+    rule_set = rule_engine.current()
+    validation_results = validation_cache.validate(
+        rule_set,
+        [p.code for p in validation_request.procedure_codes],
+        [d.code for d in validation_request.diagnosis_codes],
+        payer_id=validation_request.payer_id
+    )
+    for proc, proc_result in zip(validation_request.procedure_codes, validation_results):
+        proc_result["procedure_display"] = proc.display
     
-    # Mock validation logic - this would be replaced with actual validation rules
-    # based on medical coding guidelines, CMS rules, and payer policies
-    validation_results = []
+    result = claim_validation(validation_results)
+    result["rule_set_version"] = rule_set.version
+    return result
+
+@app.post("/validate/batch")
+async def validate_batch(
+    batch: BatchValidationRequest,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Validate many claims against the compiled rules in one request
+
+    Results stream back as NDJSON, one line per claim in request order,
+    followed by a summary line. Repeated procedure and diagnosis-set
+    combinations are validated once per batch, and claims seen before come
+    from the validation cache.
+    """
+    if len(batch.claims) > VALIDATE_BATCH_MAX_CLAIMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch of {len(batch.claims)} claims exceeds the limit of {VALIDATE_BATCH_MAX_CLAIMS}"
+        )
     
-    for proc in validation_request.procedure_codes:
-        proc_result = {
-            "procedure_code": proc.code,
-            "procedure_display": proc.display,
-            "is_valid": False,
-            "matched_diagnosis": None,
-            "confidence": 0,
-            "issues": [],
-            "suggestions": []
-        }
-        
-        # Very simplified mock validation logic
-        # In reality, this would use complex rule sets and potentially ML
-        for diag in validation_request.diagnosis_codes:
-            # Mock check based on code patterns (would be much more sophisticated in reality)
-            if (proc.code.startswith("992") and diag.code.startswith("M")):  # E&M codes with musculoskeletal
-                proc_result["is_valid"] = True
-                proc_result["matched_diagnosis"] = diag.code
-                proc_result["confidence"] = 0.95
-                break
-            elif (proc.code.startswith("706") and diag.code.startswith("J")):  # Respiratory procedures
-                proc_result["is_valid"] = True
-                proc_result["matched_diagnosis"] = diag.code
-                proc_result["confidence"] = 0.9
-                break
-            elif (proc.code.startswith("431") and diag.code.startswith("I")):  # Cardiovascular
-                proc_result["is_valid"] = True
-                proc_result["matched_diagnosis"] = diag.code
-                proc_result["confidence"] = 0.85
-                break
-        
-        if not proc_result["is_valid"]:
-            proc_result["issues"].append("No supporting diagnosis found for this procedure")
-            
-            # Generate suggestions based on the procedure code
-            if proc.code.startswith("992"):  # E&M codes
-                proc_result["suggestions"].append("Consider adding a more specific diagnosis that details the patient's condition")
-            elif proc.code.startswith("706"):  # Respiratory
-                proc_result["suggestions"].append("Add a respiratory diagnosis (J00-J99) that supports this procedure")
-            elif proc.code.startswith("431"):  # Cardiovascular
-                proc_result["suggestions"].append("Add a cardiovascular diagnosis (I00-I99) that supports this procedure")
-            else:
-                proc_result["suggestions"].append("Review documentation for a diagnosis that supports medical necessity")
-        
-        validation_results.append(proc_result)
+    # One rule set for the whole batch, even if the rules reload meanwhile
+    rule_set = rule_engine.current()
+    memo = ValidationMemo(rule_set)
     
-    # Overall validation result
-    result = {
-        "validation_results": validation_results,
-        "overall_valid": all(r["is_valid"] for r in validation_results),
-        "documentation_guidance": []
-    }
+    def generate():
+        valid_claims = 0
+        for claim in batch.claims:
+            result = claim_validation(validation_cache.validate(
+                rule_set, claim.procedure_codes, claim.diagnosis_codes, payer_id=claim.payer_id, memo=memo
+            ))
+            valid_claims += 1 if result["overall_valid"] else 0
+            yield json.dumps({"claim_id": claim.claim_id, **result}) + "\n"
+        yield json.dumps({"summary": {
+            "claims": len(batch.claims),
+            "valid_claims": valid_claims,
+            "invalid_claims": len(batch.claims) - valid_claims,
+            "procedures_validated": memo.lookups,
+            "memoised": memo.hits,
+            "cache": validation_cache.stats(),
+            "rule_set_version": rule_set.version
+        }}) + "\n"
     
-    # Add documentation guidance if issues were found
-    if not result["overall_valid"]:
-        result["documentation_guidance"] = [
-            "Ensure documentation clearly connects the diagnosis to the procedures performed",
-            "Document the medical necessity for each procedure",
-            "Include severity and impact on patient's function where appropriate"
-        ]
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.post("/audit/bundle")
+async def audit_claim_bundle(
+    bundle: Dict[str, Any] = Body(...),
+    payer_id: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Audit the coding of a whole NPHIES claim, preauthorization or predetermination bundle
+
+    Every item, detail and sub-detail is checked against the claim's
+    diagnoses and supportingInfo, the terminology tables, the
+    diagnosis-procedure rules and the MDS lab test requirements, giving
+    findings per line before the bundle is submitted. Batch bundles of claim
+    bundles are audited claim by claim.
+    """
+    try:
+        result = await bundle_auditor.audit([bundle], payer_id=payer_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Error auditing bundle: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error auditing bundle: {str(e)}"
+        )
     
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No Claim resource found in the bundle"
+        )
     return result
 
 @app.get("/coding-rules")
@@ -178,76 +255,113 @@ async def get_coding_rules(
     """
     Get coding rules for specific diagnosis or procedure codes
     """
-    rules = []
-    
-    # In a real implementation, this would retrieve actual coding rules from a database
-    # This is a mock implementation for demonstration purposes
+    rule_set = rule_engine.current()
+    return {
+        "rules": rule_set.coding_rules(diagnosis_code=diagnosis_code, procedure_code=procedure_code),
+        "rule_set_version": rule_set.version
+    }
+
+@app.get("/validation-cache/stats")
+async def get_validation_cache_stats(
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Get validation cache size, hit rate, evictions and rule set invalidations
+    """
+    return validation_cache.stats()
+
+@app.post("/admin/rules/reload")
+async def reload_coding_rules(
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Recompile the coding rules from disk without waiting for the change check
+    """
+    try:
+        rule_set = rule_engine.load()
+    except Exception as e:
+        logger.error(f"Error reloading coding rules: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error reloading coding rules: {str(e)}"
+        )
     
-    if diagnosis_code:
-        if diagnosis_code.startswith("M"):
-            rules.append({
-                "code": diagnosis_code,
-                "code_type": "diagnosis",
-                "compatible_procedures": ["992xx", "977xx", "202xx"],
-                "documentation_requirements": [
-                    "Document location, severity, and functional impact",
-                    "Note duration of symptoms",
-                    "Include any failed conservative treatments"
-                ],
-                "common_pitfalls": [
-                    "Using unspecified codes when more specific ones are available",
-                    "Missing laterality when applicable"
-                ]
-            })
-        elif diagnosis_code.startswith("J"):
-            rules.append({
-                "code": diagnosis_code,
-                "code_type": "diagnosis",
-                "compatible_procedures": ["706xx", "943xx"],
-                "documentation_requirements": [
-                    "Document severity and duration of symptoms",
-                    "Note impact on breathing/oxygenation",
-                    "Include relevant test results (PFTs, O2 sats)"
-                ],
-                "common_pitfalls": [
-                    "Missing documentation of respiratory status",
-                    "Using acute codes for chronic conditions"
-                ]
-            })
+    return {
+        "status": "reloaded",
+        "version": rule_set.version,
+        "name": rule_set.name,
+        "rules": len(rule_set.rules),
+        "loaded_at": rule_engine.loaded_at
+    }
+
+@app.get("/terminology")
+async def get_terminology_systems(
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    List the code system tables available
+    """
+    return {"systems": terminology.systems()}
+
+@app.get("/terminology/{system}/codes")
+async def expand_terminology_prefix(
+    system: str,
+    prefix: str = "",
+    limit: int = Query(100, ge=1, le=10000),
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    List the codes of a system that start with a prefix, in code order
+    """
+    table = terminology.table(system)
+    if table is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No terminology table for {system}"
+        )
     
-    if procedure_code:
-        if procedure_code.startswith("992"):
-            rules.append({
-                "code": procedure_code,
-                "code_type": "procedure",
-                "supporting_diagnoses": ["Any medically necessary diagnosis"],
-                "documentation_requirements": [
-                    "Document history elements appropriate for service level",
-                    "Include examination elements required for service level",
-                    "Document appropriate complexity of medical decision making"
-                ],
-                "common_pitfalls": [
-                    "Missing documentation to support the level of service billed",
-                    "Inadequate medical decision making documentation"
-                ]
-            })
-        elif procedure_code.startswith("706"):
-            rules.append({
-                "code": procedure_code,
-                "code_type": "procedure",
-                "supporting_diagnoses": ["J00-J99", "R05", "R06.0"],
-                "documentation_requirements": [
-                    "Document medical necessity for the procedure",
-                    "Include relevant respiratory findings",
-                    "Note the patient's response to the procedure"
-                ],
-                "common_pitfalls": [
-                    "Missing documentation of medical necessity",
-                    "Inadequate description of procedure findings"
-                ]
-            })
+    return {
+        "system": system,
+        "prefix": prefix,
+        "total": table.count_prefix(prefix),
+        "codes": list(table.prefix(prefix, limit=limit))
+    }
+
+@app.get("/terminology/{system}/codes/{code}")
+async def lookup_terminology_code(
+    system: str,
+    code: str,
+    date: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Look up a code's display, parent chain and validity
+    """
+    table = terminology.table(system)
+    entry = table.lookup(code) if table else None
+    if entry is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Code {code} not found in {system}"
+        )
     
-    return {"rules": rules}
+    return dict(
+        entry,
+        valid=terminology.validate(system, code, date)["valid"],
+        ancestors=terminology.ancestors(system, code)
+    )
+
+@app.post("/terminology/validate")
+async def validate_terminology_codes(
+    request: TerminologyValidationRequest,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Check codes exist in their systems and are in force on a date
+
+    known and valid are null for systems without a table.
+    """
+    return {"results": [terminology.validate(c.system, c.code, request.date) for c in request.codes]}
 
 @app.get("/training-resources")
 async def get_training_resources(
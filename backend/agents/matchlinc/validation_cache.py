@@ -0,0 +1,102 @@
+"""
+Validation cache for MatchLinc
+Keeps recent claim validations in an LRU keyed by the normalised claim (sorted
+procedure codes, sorted diagnosis codes, payer), so the common code
+combinations validate with one dictionary lookup. Entries belong to the rule
+set version they were computed with; when new rules are loaded the cache is
+emptied before it answers again, and a reload that leaves the rules unchanged
+keeps it.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+
+from rule_engine import RuleSet, ValidationMemo, diagnosis_key, claim_results, normalize_procedure
+
+CacheKey = Tuple[Tuple[str, ...], Tuple[str, ...], Optional[str]]
+
+class ValidationCache:
+    """LRU of per-procedure validation results for normalised claims, tagged with the rule set version"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        """
+        Initialize the validation cache
+
+        Args:
+            max_entries: Claims kept (defaults to environment variable; 0 disables caching)
+        """
+        self.max_entries = max_entries if max_entries is not None else \
+            int(os.environ.get("VALIDATION_CACHE_SIZE", "100000"))
+        self.version: Optional[str] = None
+        self.generation = -1
+        self._entries: "OrderedDict[CacheKey, Dict[str, Dict[str, Any]]]" = OrderedDict()
+        # Batches validate on worker threads, so lookups and inserts are serialised
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _results(self, rule_set: RuleSet, key: CacheKey, memo: Optional[ValidationMemo]) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            if rule_set.generation > self.generation:
+                # New rules loaded: every entry was computed with the old ones
+                if rule_set.version != self.version and self._entries:
+                    self._entries.clear()
+                    self.invalidations += 1
+                self.version, self.generation = rule_set.version, rule_set.generation
+            results = self._entries.get(key) if rule_set.version == self.version else None
+            if results is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return results
+            self.misses += 1
+
+        procedures, diagnoses, payer_id = key
+        memo = memo or ValidationMemo(rule_set)
+        results = {code: memo.match(code, diagnoses, payer_id) for code in procedures}
+
+        with self._lock:
+            # Results from a superseded rule set (a reload mid-batch) are returned but not kept
+            if self.max_entries > 0 and rule_set.version == self.version:
+                self._entries[key] = results
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return results
+
+    def validate(self, rule_set: RuleSet, procedure_codes: List[str], diagnosis_codes: List[str],
+                 payer_id: Optional[str] = None, memo: Optional[ValidationMemo] = None) -> List[Dict[str, Any]]:
+        """
+        Validation results for every procedure against a claim's diagnoses
+
+        Args:
+            rule_set: Rule set to validate against
+            procedure_codes: Claim procedure codes, in claim order
+            diagnosis_codes: Claim diagnosis codes
+            payer_id: Payer whose rules apply
+            memo: Batch memo used to compute claims that are not cached
+
+        Returns:
+            list: One result per procedure code, in claim order
+        """
+        diagnoses, spelled = diagnosis_key(diagnosis_codes)
+        key = (tuple(sorted({normalize_procedure(code) for code in procedure_codes})), diagnoses, payer_id)
+        results = self._results(rule_set, key, memo)
+        return claim_results(results, procedure_codes, spelled)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "rule_set_version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,101 @@
+"""
+Fee comparison benchmark for ReviewerLinc
+Analyses synthetic payer contracts against Medicare, average and top-payer
+benchmarks, timing the columnar build and the vectorised comparison and
+checking the results against a per-item Python reference.
+
+Usage:
+    python bench_fee_comparison.py --payers 20 --codes 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from fee_schedule_index import FeeScheduleSnapshot
+from fee_analysis import FeeComparison
+
+def build(payers: int, codes: int, seed: int, directory: str) -> tuple:
+    rng = random.Random(seed)
+    procedure_codes = [f"{10000 + i}" for i in range(codes)]
+    medicare = {code: round(rng.uniform(15, 2500), 2) for code in procedure_codes}
+
+    schedules, volumes = [], []
+    for p in range(payers):
+        payer_id = f"PAYER{p:03d}"
+        items = []
+        for code in procedure_codes:
+            # Not every payer contracts every code
+            if rng.random() < 0.1:
+                continue
+            items.append({
+                "procedure_code": code,
+                "description": f"Procedure {code}",
+                "fee": round(medicare[code] * rng.uniform(0.8, 1.3), 2),
+                "effective_date": "2025-01-01",
+                "end_date": "2025-12-31",
+                "payer_id": payer_id
+            })
+            volumes.append({"payer_id": payer_id, "procedure_code": code, "monthly_volume": rng.randint(0, 400)})
+        schedules.append({"payer_id": payer_id, "payer_name": f"Payer {p}", "items": items})
+
+    with open(os.path.join(directory, "medicare.json"), "w") as f:
+        json.dump([{"procedure_code": code, "fee": fee, "effective_date": "2025-01-01"}
+                   for code, fee in medicare.items()], f)
+    with open(os.path.join(directory, "volumes.json"), "w") as f:
+        json.dump(volumes, f)
+    return FeeScheduleSnapshot(schedules), medicare, volumes
+
+def reference(snapshot: FeeScheduleSnapshot, medicare: dict, volumes: list) -> float:
+    """Monthly revenue shortfall against Medicare, one item at a time"""
+    volume = {(v["payer_id"], v["procedure_code"]): v["monthly_volume"] for v in volumes}
+    shortfall = 0.0
+    for schedule in snapshot.schedules:
+        for item in schedule["items"]:
+            rate = medicare.get(item["procedure_code"])
+            if rate and item["fee"] < rate:
+                shortfall += (rate - item["fee"]) * volume.get((schedule["payer_id"], item["procedure_code"]), 0)
+    return shortfall
+
+def run(payers: int, codes: int, repeats: int, seed: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot, medicare, volumes = build(payers, codes, seed, directory)
+        engine = FeeComparison(os.path.join(directory, "medicare.json"), os.path.join(directory, "volumes.json"))
+
+        start = time.perf_counter()
+        engine.prepare(snapshot)
+        prepare_seconds = time.perf_counter() - start
+
+        timings = {}
+        for benchmark in ("medicare", "average", "top_payer"):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                result = engine.analyze(snapshot, benchmark=benchmark, as_of="2025-06-01")
+            timings[benchmark] = (time.perf_counter() - start) / repeats
+            if benchmark == "medicare":
+                monthly = result["potential_revenue_impact"]["monthly"]
+
+        start = time.perf_counter()
+        expected = reference(snapshot, medicare, volumes)
+        reference_seconds = time.perf_counter() - start
+
+    items = sum(len(schedule["items"]) for schedule in snapshot.schedules)
+    print(f"payers x codes:     {payers} x {codes:,} ({items:,} contracted fees)")
+    print(f"columnar build:     {prepare_seconds * 1000:.0f} ms (once per fee schedule snapshot)")
+    for benchmark, seconds in timings.items():
+        print(f"analysis {benchmark + ':':<10} {seconds * 1000:.0f} ms")
+    print(f"python reference:   {reference_seconds * 1000:.0f} ms (Medicare shortfall only)")
+    print(f"shortfall match:    {abs(monthly - expected) < 0.01 * max(1.0, expected) / 100}"
+          f" ({monthly:,.2f} vs {expected:,.2f})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ReviewerLinc fee comparison analysis")
+    parser.add_argument("--payers", type=int, default=20)
+    parser.add_argument("--codes", type=int, default=50000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.payers, args.codes, args.repeats, args.seed)
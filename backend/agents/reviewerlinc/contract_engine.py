@@ -0,0 +1,421 @@
+"""
+Contract term engine for ReviewerLinc
+Compiles payer contract terms into rules indexed by payer and procedure code
+range, and evaluates the expected reimbursement of whole claims against them.
+
+Supported reimbursement terms:
+
+- percent of a benchmark: "110% of Medicare", "95% of billed charges",
+  "100% of fee schedule"
+- fixed rates: "SAR 250 per unit", "150 flat"
+- caps: "capped at SAR 1200", "maximum 900"
+- carve-outs: any term marked ``carve_out`` (or described as a carve-out),
+  which overrides the standard rates for its codes; "not covered" pays nothing
+
+A term applies to its ``procedure_codes`` or ``code_range`` when given,
+otherwise to the service line named in its description (E&M, preventive,
+surgery, ...), otherwise to every code of the payer.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+
+from fee_schedule_index import FeeScheduleSnapshot, parse_day, write_json_atomic, OPEN_END
+
+logger = logging.getLogger("reviewerlinc.contracts")
+
+# Procedure code ranges for the service lines contract descriptions refer to
+SERVICE_RANGES = [
+    ("preventive", ("99381", "99429")),
+    ("e&m", ("99202", "99499")),
+    ("evaluation and management", ("99202", "99499")),
+    ("anesthesia", ("00100", "01999")),
+    ("surgery", ("10004", "69990")),
+    ("surgical", ("10004", "69990")),
+    ("radiology", ("70010", "79999")),
+    ("laboratory", ("80047", "89398")),
+    ("pathology", ("80047", "89398")),
+    ("medicine", ("90281", "99199")),
+]
+# Every code of a payer
+ALL_CODES = ("", "\uffff")
+
+PERCENT_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*%\s*of\s+(medicare|billed charges?|charges|fee schedule)", re.I)
+CAP_PATTERN = re.compile(r"^\s*(?:capped at|cap(?: of)?|max(?:imum)?(?: of)?)\s*(?:SAR|\$)?\s*(\d+(?:\.\d+)?)", re.I)
+FIXED_PATTERN = re.compile(r"^\s*(?:SAR|\$)?\s*(\d+(?:\.\d+)?)\s*(?:SAR)?\s*(?:flat|fixed|per (?:unit|visit|case|service))", re.I)
+NOT_COVERED_PATTERN = re.compile(r"not covered|excluded", re.I)
+
+BASES = {"medicare": "medicare", "billed charge": "billed", "billed charges": "billed", "charges": "billed",
+         "fee schedule": "fee_schedule"}
+
+# Rate rules are tried in this order; within a kind, narrower code scopes first
+CARVE_OUT, CODE_LIST, RANGE = 0, 1, 2
+
+class ContractRule:
+    """One compiled reimbursement term"""
+
+    __slots__ = ("kind", "percent", "basis", "amount", "start", "end", "priority",
+                 "term_id", "contract_id", "description")
+
+    def __init__(self, kind: str, term: Dict[str, Any], contract: Dict[str, Any], priority: tuple,
+                 percent: Optional[float] = None, basis: Optional[str] = None, amount: Optional[float] = None):
+        self.kind = kind  # "percent", "fixed" or "cap"
+        self.percent = percent
+        self.basis = basis
+        self.amount = amount
+        effective_date = term.get("effective_date") or contract.get("effective_date")
+        end_date = term.get("end_date") or contract.get("end_date")
+        self.start = parse_day(effective_date) if effective_date else 0
+        self.end = parse_day(end_date) if end_date else OPEN_END
+        self.priority = priority
+        self.term_id = term.get("term_id")
+        self.contract_id = contract.get("contract_id")
+        self.description = term.get("description")
+
+    def applies_on(self, day: int) -> bool:
+        return self.start <= day <= self.end
+
+def parse_term_value(value: Any) -> Optional[Dict[str, Any]]:
+    """Rate definition of a term value, or None if it is not a reimbursement rate"""
+    if isinstance(value, dict):
+        kind = value.get("type")
+        if kind in ("percent", "percent_of"):
+            return {"kind": "percent", "percent": float(value["percent"]),
+                    "basis": BASES.get(str(value.get("basis", "medicare")).lower(), value.get("basis"))}
+        if kind in ("fixed", "cap"):
+            return {"kind": kind, "amount": float(value["amount"])}
+        if kind in ("not_covered", "excluded"):
+            return {"kind": "fixed", "amount": 0.0}
+        return None
+    if not isinstance(value, str):
+        return None
+    match = PERCENT_PATTERN.match(value)
+    if match:
+        return {"kind": "percent", "percent": float(match.group(1)), "basis": BASES[match.group(2).lower()]}
+    match = CAP_PATTERN.match(value)
+    if match:
+        return {"kind": "cap", "amount": float(match.group(1))}
+    match = FIXED_PATTERN.match(value)
+    if match:
+        return {"kind": "fixed", "amount": float(match.group(1))}
+    if NOT_COVERED_PATTERN.search(value):
+        return {"kind": "fixed", "amount": 0.0}
+    return None
+
+def term_scope(term: Dict[str, Any]) -> Tuple[Optional[List[str]], Tuple[str, str]]:
+    """The explicit procedure codes, or the code range, a term applies to"""
+    value = term.get("value") if isinstance(term.get("value"), dict) else {}
+    codes = term.get("procedure_codes") or value.get("procedure_codes")
+    if codes:
+        return [str(code) for code in codes], ALL_CODES
+    code_range = term.get("code_range") or value.get("code_range")
+    if code_range:
+        return None, (str(code_range[0]), str(code_range[1]))
+    description = (term.get("description") or "").lower()
+    for keyword, service_range in SERVICE_RANGES:
+        if keyword in description:
+            return None, service_range
+    return None, ALL_CODES
+
+def range_width(low: str, high: str) -> int:
+    """Number of codes in a range, for ranking overlapping terms by specificity"""
+    if (low, high) == ALL_CODES:
+        return 10 ** 9
+    if low.isdigit() and high.isdigit():
+        return int(high) - int(low)
+    return 10 ** 8
+
+def pricing_status(lines: int, unpriced_lines: int) -> str:
+    """priced, partially_priced or unpriced, for a claim with that many lines"""
+    if unpriced_lines == 0 and lines > 0:
+        return "priced"
+    return "partially_priced" if unpriced_lines < lines else "unpriced"
+
+class PayerRules:
+    """A payer's compiled rules, by exact code and by elementary code range"""
+
+    def __init__(self):
+        self.exact: Dict[str, List[ContractRule]] = {}
+        self.ranged: List[Tuple[str, str, ContractRule]] = []
+        self.boundaries: List[str] = []
+        self.segments: List[List[ContractRule]] = []
+
+    def seal(self) -> None:
+        """Cut the code ranges at every boundary so a lookup is one bisect"""
+        # Ranges are inclusive; high + "\0" is the first code after high
+        points = sorted({low for low, _, _ in self.ranged} | {high + "\0" for _, high, _ in self.ranged})
+        self.boundaries = points
+        self.segments = []
+        for low, high in zip(points, points[1:]):
+            covering = [rule for start, end, rule in self.ranged if start <= low and high <= end + "\0"]
+            self.segments.append(sorted(covering, key=lambda rule: rule.priority))
+        if points:
+            self.segments.append([])
+        for rules in self.exact.values():
+            rules.sort(key=lambda rule: rule.priority)
+
+    def rules_for(self, procedure_code: str) -> List[ContractRule]:
+        rules = self.exact.get(procedure_code, [])
+        i = bisect_right(self.boundaries, procedure_code) - 1
+        if i >= 0:
+            rules = rules + self.segments[i] if rules else self.segments[i]
+        return rules
+
+class CompiledContracts:
+    """Immutable compiled view of every payer contract"""
+
+    def __init__(self, contracts: List[Dict[str, Any]], version: int = 0):
+        self.contracts = contracts
+        self.version = version
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.payers: Dict[str, PayerRules] = {}
+        self.rule_count = 0
+
+        for contract in contracts:
+            self.by_id.setdefault(contract.get("contract_id") or contract.get("id"), contract)
+            if contract.get("status", "active") not in ("active", "pending"):
+                continue
+            payer = self.payers.setdefault(contract.get("payer_id"), PayerRules())
+            for term in contract.get("terms", []):
+                try:
+                    self.add_term(payer, term, contract)
+                except (KeyError, TypeError, ValueError) as e:
+                    # One bad term must not stop the rest of the contracts from compiling
+                    logger.warning(f"Skipping contract term {term.get('term_id')}: {str(e)}")
+        for payer in self.payers.values():
+            payer.seal()
+
+    def add_term(self, payer: PayerRules, term: Dict[str, Any], contract: Dict[str, Any]) -> None:
+        """
+        Compile a contract term into a payer's rules
+
+        Raises:
+            KeyError, TypeError, ValueError: The term's value or dates are invalid
+        """
+        if term.get("category", "reimbursement") != "reimbursement":
+            return
+        definition = parse_term_value(term.get("value"))
+        if definition is not None:
+            self._add(payer, term, contract, definition)
+
+    def _add(self, payer: PayerRules, term: Dict[str, Any], contract: Dict[str, Any],
+             definition: Dict[str, Any]) -> None:
+        codes, (low, high) = term_scope(term)
+        carve_out = bool(term.get("carve_out")) or "carve" in (term.get("description") or "").lower()
+        kind_rank = CARVE_OUT if carve_out else CODE_LIST if codes else RANGE
+        # Narrower ranges win over wider ones; later-effective terms win ties
+        width = 0 if codes else range_width(low, high)
+        effective_date = term.get("effective_date") or contract.get("effective_date")
+        priority = (kind_rank, width, -(parse_day(effective_date) if effective_date else 0))
+        rule = ContractRule(definition["kind"], term, contract, priority, percent=definition.get("percent"),
+                            basis=definition.get("basis"), amount=definition.get("amount"))
+        if codes:
+            for code in codes:
+                payer.exact.setdefault(code, []).append(rule)
+        else:
+            payer.ranged.append((low, high, rule))
+        self.rule_count += 1
+
+    def evaluate_line(self, payer_id: str, line: Dict[str, Any], day: int, on_date: str,
+                      fee_schedules: FeeScheduleSnapshot, medicare: FeeScheduleSnapshot) -> Dict[str, Any]:
+        """Expected reimbursement of one claim line"""
+        code = str(line.get("procedure_code", ""))
+        quantity = float(line.get("quantity") or 1)
+        charge = line.get("charge")
+        payer = self.payers.get(payer_id)
+        rules = [rule for rule in payer.rules_for(code) if rule.applies_on(day)] if payer else []
+
+        rate_rule = next((rule for rule in rules if rule.kind != "cap"), None)
+        expected, basis, term_id, contract_id = None, None, None, None
+        if rate_rule is not None:
+            term_id, contract_id = rate_rule.term_id, rate_rule.contract_id
+            if rate_rule.kind == "fixed":
+                expected, basis = rate_rule.amount * quantity, "fixed"
+            elif rate_rule.basis == "billed":
+                expected = charge * rate_rule.percent / 100 if charge is not None else None
+                basis = "billed"
+            else:
+                source = medicare.fee("medicare", code, on_date) if rate_rule.basis == "medicare" \
+                    else fee_schedules.fee(payer_id, code, on_date)
+                expected = source["fee"] * quantity * rate_rule.percent / 100 if source else None
+                basis = rate_rule.basis
+        if expected is None and basis is None:
+            # No contract rate: fall back to the payer's fee schedule
+            item = fee_schedules.fee(payer_id, code, on_date)
+            if item is not None:
+                expected, basis = item["fee"] * quantity, "fee_schedule"
+
+        capped_by = None
+        if expected is not None:
+            cap_rule = min((rule for rule in rules if rule.kind == "cap"), key=lambda rule: rule.amount, default=None)
+            if cap_rule is not None and expected > cap_rule.amount * quantity:
+                expected, capped_by = cap_rule.amount * quantity, cap_rule.term_id
+            # Payers allow the lesser of the contracted rate and the billed charge
+            if charge is not None and expected > charge:
+                expected, basis = float(charge), "billed_charge_limit"
+
+        return {
+            "sequence": line.get("sequence"),
+            "procedure_code": code,
+            "quantity": quantity,
+            "charge": charge,
+            "expected": round(expected, 2) if expected is not None else None,
+            "basis": basis,
+            "term_id": term_id,
+            "contract_id": contract_id,
+            "capped_by": capped_by
+        }
+
+class ContractEngine:
+    """Loads contracts, keeps them compiled, and evaluates expected reimbursement"""
+
+    def __init__(self, contracts_path: Optional[str] = None, medicare_path: Optional[str] = None):
+        """
+        Initialize the contract engine
+
+        Args:
+            contracts_path: Contract JSON file (defaults to environment variable)
+            medicare_path: Medicare rate file (defaults to environment variable)
+        """
+        self.contracts_path = contracts_path or os.environ.get("CONTRACTS_PATH", "data/contracts.json")
+        self.medicare_path = medicare_path or os.environ.get("MEDICARE_RATES_PATH", "data/medicare_rates.json")
+        self.check_interval = float(os.environ.get("FEE_SCHEDULE_RELOAD_CHECK", "2"))
+        # Relative shortfall tolerated before a paid line counts as underpaid
+        self.underpayment_tolerance = float(os.environ.get("UNDERPAYMENT_TOLERANCE", "0.01"))
+        self.compiled = CompiledContracts([])
+        self.medicare = FeeScheduleSnapshot([])
+        self._mtimes: Optional[tuple] = None
+        self._next_check = 0.0
+        self._write_lock = threading.Lock()
+        self.load()
+
+    def _stat(self) -> tuple:
+        stats = []
+        for path in (self.contracts_path, self.medicare_path):
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+
+    @staticmethod
+    def _read(path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def load(self) -> CompiledContracts:
+        """Read and compile contracts and Medicare rates, then swap them in"""
+        mtimes = self._stat()
+        contracts = self._read(self.contracts_path)
+        self.medicare = FeeScheduleSnapshot([{"payer_id": "medicare", "items": self._read(self.medicare_path)}])
+        self.compiled = CompiledContracts(contracts, self.compiled.version + 1)
+        self._mtimes = mtimes
+        logger.info(f"Compiled {self.compiled.rule_count} contract rules for {len(self.compiled.payers)} payers")
+        return self.compiled
+
+    def current(self) -> CompiledContracts:
+        """The compiled contracts, recompiling first if the files have changed"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            if self._stat() != self._mtimes and self._write_lock.acquire(blocking=False):
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error(f"Error reloading contracts: {str(e)}")
+                finally:
+                    self._write_lock.release()
+        return self.compiled
+
+    def add_term(self, contract_id: str, term: Dict[str, Any]) -> bool:
+        """
+        Append a term to a contract, persist atomically and recompile
+
+        Returns:
+            bool: False if the contract is unknown
+
+        Raises:
+            ValueError: The term does not compile
+        """
+        with self._write_lock:
+            contracts = self._read(self.contracts_path)
+            for i, contract in enumerate(contracts):
+                if (contract.get("contract_id") or contract.get("id")) == contract_id:
+                    contracts[i] = dict(contract, terms=contract.get("terms", []) + [term])
+                    break
+            else:
+                return False
+            # Compile the term before saving it, so a bad term is never persisted
+            try:
+                CompiledContracts([]).add_term(PayerRules(), term, contracts[i])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid contract term: {str(e)}")
+            write_json_atomic(self.contracts_path, contracts)
+            self.load()
+            return True
+
+    def evaluate(self, claims: List[Dict[str, Any]], fee_schedules: FeeScheduleSnapshot) -> List[Dict[str, Any]]:
+        """
+        Expected reimbursement for every line of a batch of claims
+
+        Each claim has payer_id, date_of_service and items (procedure_code,
+        quantity, charge and optionally paid). Claims with paid amounts get a
+        variance and an underpaid flag per line and in total; the totals only
+        cover priced lines, and are null when no line could be priced.
+        """
+        compiled = self.current()
+        medicare = self.medicare
+        results = []
+        for claim in claims:
+            payer_id = claim.get("payer_id")
+            on_date = claim.get("date_of_service") or datetime.now().date().isoformat()
+            day = parse_day(on_date)
+            lines = [compiled.evaluate_line(payer_id, line, day, on_date, fee_schedules, medicare)
+                     for line in claim.get("items", [])]
+
+            expected_total = paid_total = priced_paid = 0.0
+            has_paid = False
+            for line, source in zip(lines, claim.get("items", [])):
+                paid = source.get("paid")
+                if line["expected"] is not None:
+                    expected_total += line["expected"]
+                if paid is not None:
+                    has_paid = True
+                    paid_total += paid
+                    line["paid"] = paid
+                    if line["expected"] is not None:
+                        priced_paid += paid
+                        line["variance"] = round(paid - line["expected"], 2)
+                        line["underpaid"] = self.is_underpaid(paid, line["expected"])
+
+            unpriced_lines = sum(1 for line in lines if line["expected"] is None)
+            result = {
+                "claim_id": claim.get("claim_id"),
+                "payer_id": payer_id,
+                "date_of_service": on_date,
+                "expected_total": round(expected_total, 2),
+                "pricing": pricing_status(len(lines), unpriced_lines),
+                "unpriced_lines": unpriced_lines,
+                "items": lines
+            }
+            if has_paid:
+                result["paid_total"] = round(paid_total, 2)
+                priced = result["pricing"] != "unpriced"
+                result["variance"] = round(priced_paid - expected_total, 2) if priced else None
+                result["underpaid"] = self.is_underpaid(priced_paid, expected_total) if priced else None
+            results.append(result)
+        return results
+
+    def is_underpaid(self, paid: float, expected: float) -> bool:
+        return paid < expected - max(0.01, expected * self.underpayment_tolerance)
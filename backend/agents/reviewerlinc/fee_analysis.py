@@ -0,0 +1,298 @@
+"""
+Fee comparison analysis for ReviewerLinc
+Holds contracted fees, benchmark rates and procedure volumes as columnar NumPy
+arrays (payers x procedure codes) and computes difference percentages, revenue
+impact and per-payer averages for every code in a few vectorised passes.
+"""
+
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+from fee_schedule_index import FeeScheduleSnapshot, parse_day, OPEN_END
+
+logger = logging.getLogger("reviewerlinc.fee_analysis")
+
+BENCHMARKS = ("medicare", "average", "top_payer")
+
+class FeeColumns:
+    """Every item of a set of fee schedules as parallel arrays"""
+
+    def __init__(self, schedules: List[Dict[str, Any]]):
+        self.payers: List[str] = []
+        self.payer_names: Dict[str, Optional[str]] = {}
+        self.codes: List[str] = []
+        self.descriptions: Dict[str, str] = {}
+        payer_index: Dict[str, int] = {}
+        self.code_index: Dict[str, int] = {}
+
+        payer_idx, code_idx, starts, ends, fees = [], [], [], [], []
+        for schedule in schedules:
+            payer_id = schedule.get("payer_id")
+            if payer_id not in payer_index:
+                payer_index[payer_id] = len(self.payers)
+                self.payers.append(payer_id)
+                self.payer_names[payer_id] = schedule.get("payer_name")
+            p = payer_index[payer_id]
+            for item in schedule.get("items", []):
+                code = item.get("procedure_code")
+                c = self.code_index.get(code)
+                if c is None:
+                    c = self.code_index[code] = len(self.codes)
+                    self.codes.append(code)
+                    self.descriptions[code] = item.get("description")
+                payer_idx.append(p)
+                code_idx.append(c)
+                starts.append(parse_day(item["effective_date"]))
+                ends.append(parse_day(item["end_date"]) if item.get("end_date") else OPEN_END)
+                fees.append(float(item.get("fee", 0)))
+
+        # Sorted by cell, then effective date, so the last candidate per cell is the latest
+        self.cells = np.asarray(payer_idx, dtype=np.int64) * max(len(self.codes), 1) + np.asarray(code_idx, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.fees = np.asarray(fees, dtype=np.float64)
+        order = np.lexsort((self.starts, self.cells))
+        self.cells, self.starts, self.ends, self.fees = (
+            self.cells[order], self.starts[order], self.ends[order], self.fees[order]
+        )
+
+    @property
+    def shape(self) -> tuple:
+        return len(self.payers), len(self.codes)
+
+    def fees_on(self, day: int) -> np.ndarray:
+        """
+        Payer x code fee matrix for a day ordinal, NaN where a payer has no rate
+
+        Only items in force on the day count; a rate that has lapsed is not
+        carried forward (see lapsed_on).
+        """
+        matrix = np.full(self.shape, np.nan)
+        candidates = np.flatnonzero((self.starts <= day) & (self.ends >= day))
+        if candidates.size:
+            cells = self.cells[candidates]
+            last = np.r_[cells[1:] != cells[:-1], True]
+            matrix.flat[cells[last]] = self.fees[candidates[last]]
+        return matrix
+
+    def lapsed_on(self, day: int) -> np.ndarray:
+        """Payer x code mask of cells whose rates had all lapsed by a day ordinal"""
+        lapsed = np.zeros(self.shape, dtype=bool)
+        lapsed.flat[self.cells[self.ends < day]] = True
+        lapsed.flat[self.cells[(self.starts <= day) & (self.ends >= day)]] = False
+        return lapsed
+
+class FeeTables:
+    """The arrays built for one fee schedule snapshot, published as a unit"""
+
+    __slots__ = ("snapshot", "columns", "volumes", "medicare", "medicare_codes")
+
+    def __init__(self, snapshot: FeeScheduleSnapshot, columns: FeeColumns, volumes: np.ndarray,
+                 medicare: FeeColumns, medicare_codes: np.ndarray):
+        self.snapshot = snapshot
+        self.columns = columns
+        self.volumes = volumes
+        self.medicare = medicare
+        self.medicare_codes = medicare_codes
+
+def nanmean(values: np.ndarray, axis: Optional[int] = None) -> np.ndarray:
+    """Mean of the non-NaN values, NaN where there are none (without warnings)"""
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=axis)
+    sums = np.where(valid, values, 0.0).sum(axis=axis)
+    return np.divide(sums, counts, out=np.full(np.shape(sums), np.nan), where=counts > 0)
+
+def as_float(value: Any) -> Optional[float]:
+    value = float(value)
+    return None if np.isnan(value) else round(value, 2)
+
+def negotiation_opportunity(average_difference: Optional[float]) -> str:
+    if average_difference is None or average_difference >= 0:
+        return "None"
+    if average_difference <= -5:
+        return "High"
+    if average_difference <= -1:
+        return "Medium"
+    return "Low"
+
+class FeeComparison:
+    """Vectorised comparison of contracted fees against benchmark rates"""
+
+    def __init__(self, medicare_path: Optional[str] = None, volume_path: Optional[str] = None):
+        """
+        Initialize the fee comparison engine
+
+        Args:
+            medicare_path: Medicare rate file (defaults to environment variable)
+            volume_path: Monthly procedure volume file (defaults to environment variable)
+        """
+        self.medicare_path = medicare_path or os.environ.get("MEDICARE_RATES_PATH", "data/medicare_rates.json")
+        self.volume_path = volume_path or os.environ.get("PROCEDURE_VOLUMES_PATH", "data/procedure_volumes.json")
+        self.tables: Optional[FeeTables] = None
+        # Serialises rebuilds so concurrent requests after a change build the tables once
+        self._prepare_lock = threading.Lock()
+
+    @staticmethod
+    def _read(path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"{path} not found")
+            return []
+
+    def prepare(self, snapshot: FeeScheduleSnapshot) -> FeeTables:
+        """
+        The columnar arrays for a fee schedule snapshot, built once per snapshot
+
+        Building takes seconds for large schedules, so call this off the event
+        loop. The new tables replace the previous ones in a single reference
+        assignment, so an analysis that is already running keeps its own.
+        """
+        tables = self.tables
+        if tables is not None and tables.snapshot is snapshot:
+            return tables
+        with self._prepare_lock:
+            tables = self.tables
+            if tables is not None and tables.snapshot is snapshot:
+                return tables
+
+            columns = FeeColumns(snapshot.schedules)
+            payer_index = {payer_id: p for p, payer_id in enumerate(columns.payers)}
+
+            volumes = np.zeros(columns.shape)
+            for record in self._read(self.volume_path):
+                p = payer_index.get(record.get("payer_id"))
+                c = columns.code_index.get(record.get("procedure_code"))
+                if p is not None and c is not None:
+                    volumes[p, c] += float(record.get("monthly_volume", 0))
+
+            medicare = FeeColumns([{"payer_id": "medicare", "items": self._read(self.medicare_path)}])
+            medicare_codes = np.array([columns.code_index.get(code, -1) for code in medicare.codes], dtype=np.int64)
+
+            self.tables = FeeTables(snapshot, columns, volumes, medicare, medicare_codes)
+            return self.tables
+
+    @staticmethod
+    def benchmark_rates(tables: FeeTables, benchmark: str, fees: np.ndarray, day: int) -> np.ndarray:
+        """Benchmark fee per code, NaN where the benchmark has no rate"""
+        if benchmark == "medicare":
+            rates = np.full(fees.shape[1], np.nan)
+            medicare_fees = tables.medicare.fees_on(day)[0] if tables.medicare.shape[0] else np.zeros(0)
+            known = tables.medicare_codes >= 0
+            rates[tables.medicare_codes[known]] = medicare_fees[known]
+            return rates
+        if benchmark == "average":
+            return nanmean(fees, axis=0)
+        if benchmark == "top_payer":
+            return np.fmax.reduce(fees, axis=0) if fees.shape[0] else np.full(fees.shape[1], np.nan)
+        raise ValueError(f"Unknown benchmark {benchmark}")
+
+    def analyze(self, snapshot: FeeScheduleSnapshot, benchmark: str = "medicare",
+                payer_id: Optional[str] = None, as_of: Optional[str] = None,
+                renewal_dates: Optional[Dict[str, str]] = None, limit: int = 50) -> Dict[str, Any]:
+        """
+        Compare contracted fees with a benchmark for every payer and code
+
+        Args:
+            snapshot: Fee schedule snapshot to analyse
+            benchmark: medicare, average (mean across payers) or top_payer (highest payer)
+            payer_id: Restrict the result to one payer; benchmarks still use every payer
+            as_of: Date the fees and rates are taken on (defaults to today)
+            renewal_dates: Contract end date per payer
+            limit: Procedures listed, largest revenue impact first
+
+        Returns:
+            dict: Analysis in the /analysis/fee-comparison response format
+        """
+        tables = self.prepare(snapshot)
+        columns = tables.columns
+        day = parse_day(as_of) if as_of else datetime.now().date().toordinal()
+        renewal_dates = renewal_dates or {}
+
+        fees = columns.fees_on(day)
+        lapsed = columns.lapsed_on(day)
+        rates = self.benchmark_rates(tables, benchmark, fees, day)
+
+        rows = np.array([p for p, payer in enumerate(columns.payers) if not payer_id or payer == payer_id],
+                        dtype=np.int64)
+
+        payer_fees = fees[rows]
+        payer_lapsed = lapsed[rows]
+        volumes = tables.volumes[rows]
+        difference = payer_fees - rates
+        with np.errstate(invalid="ignore"):
+            percentage = np.divide(difference, rates, out=np.full(difference.shape, np.nan), where=rates > 0) * 100
+        compared = ~np.isnan(percentage)
+        revenue_impact = np.where(compared, difference, 0.0) * volumes
+        # Revenue recovered if every code below benchmark were raised to it
+        shortfall = np.where(compared, np.maximum(-difference, 0.0), 0.0) * volumes
+
+        payer_average = nanmean(percentage, axis=1)
+
+        # Per-code view across the selected payers, fees weighted by volume
+        weights = np.where(compared, volumes, 0.0)
+        weight_totals = weights.sum(axis=0)
+        weighted_fee = np.divide((np.where(compared, payer_fees, 0.0) * weights).sum(axis=0), weight_totals,
+                                 out=np.full(weight_totals.shape, np.nan), where=weight_totals > 0)
+        your_fee = np.where(np.isnan(weighted_fee), nanmean(np.where(compared, payer_fees, np.nan), axis=0), weighted_fee)
+        code_percentage = np.divide(your_fee - rates, rates, out=np.full(rates.shape, np.nan), where=rates > 0) * 100
+        code_volume = volumes.sum(axis=0)
+        code_impact = revenue_impact.sum(axis=0)
+        code_compared = ~np.isnan(code_percentage)
+
+        ranked = np.flatnonzero(code_compared)
+        ranked = ranked[np.argsort(-np.abs(code_impact[ranked]), kind="stable")][:limit]
+
+        valid_percentages = percentage[compared]
+        monthly = float(shortfall.sum())
+
+        return {
+            "benchmark_type": benchmark,
+            "analysis_date": datetime.now().isoformat(),
+            "as_of": datetime.fromordinal(day).date().isoformat(),
+            "codes_compared": int(code_compared.sum()),
+            # Payer and code pairs left out because their contracted rate has lapsed
+            "lapsed_rates": [
+                {"payer_id": columns.payers[rows[i]], "procedure_code": columns.codes[c]}
+                for i, c in zip(*np.nonzero(payer_lapsed))
+            ],
+            "overall_comparison": {
+                "average_difference_percentage": as_float(valid_percentages.mean()) if valid_percentages.size else None,
+                "highest_difference_percentage": as_float(valid_percentages.max()) if valid_percentages.size else None,
+                "lowest_difference_percentage": as_float(valid_percentages.min()) if valid_percentages.size else None,
+            },
+            "potential_revenue_impact": {
+                "monthly": round(monthly, 2),
+                "annual": round(monthly * 12, 2),
+                "notes": "Based on current procedure volume and payer mix"
+            },
+            "procedure_analysis": [
+                {
+                    "procedure_code": columns.codes[c],
+                    "description": columns.descriptions.get(columns.codes[c]),
+                    "your_fee": as_float(your_fee[c]),
+                    "benchmark_fee": as_float(rates[c]),
+                    "difference_percentage": as_float(code_percentage[c]),
+                    "volume_last_month": int(code_volume[c]),
+                    "revenue_impact": as_float(code_impact[c])
+                }
+                for c in ranked.tolist()
+            ],
+            "payer_analysis": [
+                {
+                    "payer_id": columns.payers[p],
+                    "payer_name": columns.payer_names.get(columns.payers[p]),
+                    "average_difference_percentage": as_float(payer_average[i]),
+                    "contract_renewal_date": renewal_dates.get(columns.payers[p], "N/A"),
+                    "negotiation_opportunity": negotiation_opportunity(as_float(payer_average[i]))
+                }
+                for i, p in enumerate(rows.tolist())
+            ]
+        }
@@ -0,0 +1,275 @@
+"""
+Fee schedule index for ReviewerLinc
+Loads fee schedules once and indexes them by payer and procedure code. Each
+code's items become a sorted, non-overlapping run of effective-date intervals,
+so "fee for payer X, code Y on date D" is a binary search. The file is
+reloaded when its modification time changes, or on demand.
+
+Snapshots are never mutated once published. An update builds the next
+snapshot alongside the current one, persists it with write-to-temp-then-rename
+and swaps the reference, so readers never take a lock or see a partial write.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+from datetime import date, datetime
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+logger = logging.getLogger("reviewerlinc.fee_index")
+
+# Open-ended items run to the last representable day
+OPEN_END = date.max.toordinal()
+
+@lru_cache(maxsize=4096)
+def parse_day(value: str) -> int:
+    """Day ordinal of an ISO date or timestamp; schedules repeat a handful of dates"""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).date().toordinal()
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """Persist JSON atomically: write a temporary file beside the target, then rename it"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file owner-only; keep the permissions of the file being replaced
+        mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class FeeIntervals:
+    """Non-overlapping effective-date intervals for one payer and procedure code"""
+
+    __slots__ = ("starts", "ends", "items")
+
+    def __init__(self, items: List[Dict[str, Any]]):
+        # Where items overlap, the one that took effect last wins, so the
+        # overlap is cut at elementary date boundaries and each piece keeps
+        # only its winning item
+        spans = sorted(
+            (parse_day(item["effective_date"]),
+             parse_day(item["end_date"]) if item.get("end_date") else OPEN_END,
+             order, item)
+            for order, item in enumerate(items)
+        )
+        boundaries = sorted({start for start, _, _, _ in spans} | {end + 1 for _, end, _, _ in spans})
+
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.items: List[Dict[str, Any]] = []
+        for low, high in zip(boundaries, boundaries[1:]):
+            covering = [span for span in spans if span[0] <= low and high - 1 <= span[1]]
+            if not covering:
+                continue
+            item = max(covering, key=lambda span: (span[0], span[2]))[3]
+            if self.items and self.items[-1] is item and self.ends[-1] == low - 1:
+                self.ends[-1] = high - 1
+            else:
+                self.starts.append(low)
+                self.ends.append(high - 1)
+                self.items.append(item)
+
+    def at(self, day: int) -> Optional[Dict[str, Any]]:
+        """The item in force on a day ordinal, if any"""
+        i = bisect_right(self.starts, day) - 1
+        if i >= 0 and day <= self.ends[i]:
+            return self.items[i]
+        return None
+
+class FeeScheduleSnapshot:
+    """Immutable view of the fee schedules, indexed by payer and procedure code"""
+
+    def __init__(self, schedules: List[Dict[str, Any]], version: int = 0):
+        self.schedules = schedules
+        self.version = version
+        self.by_payer: Dict[str, Dict[str, Any]] = {}
+        self.intervals: Dict[Tuple[str, str], FeeIntervals] = {}
+        self.items: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        # Procedure codes per payer in schedule order, for listing responses
+        self.codes: Dict[str, List[str]] = {}
+
+        for schedule in schedules:
+            self._index(schedule)
+
+    def _index(self, schedule: Dict[str, Any]) -> None:
+        payer_id = schedule.get("payer_id")
+        self.by_payer.setdefault(payer_id, schedule)
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for item in schedule.get("items", []):
+            grouped.setdefault(item.get("procedure_code"), []).append(item)
+        codes = self.codes.setdefault(payer_id, [])
+        for code, items in grouped.items():
+            if (payer_id, code) not in self.intervals:
+                codes.append(code)
+                self.items[(payer_id, code)] = items
+                self.intervals[(payer_id, code)] = FeeIntervals(items)
+
+    def replace(self, schedule: Dict[str, Any]) -> "FeeScheduleSnapshot":
+        """
+        Copy-on-write: a new snapshot with one payer's schedule replaced
+
+        Other payers' schedules and interval indexes are shared with this
+        snapshot, which itself is left untouched.
+        """
+        payer_id = schedule.get("payer_id")
+        schedules = [s for s in self.schedules if s.get("payer_id") != payer_id]
+        position = next((i for i, s in enumerate(self.schedules) if s.get("payer_id") == payer_id), len(schedules))
+        schedules.insert(position, schedule)
+
+        snapshot = FeeScheduleSnapshot.__new__(FeeScheduleSnapshot)
+        snapshot.schedules = schedules
+        snapshot.version = self.version + 1
+        snapshot.by_payer = {p: s for p, s in self.by_payer.items() if p != payer_id}
+        snapshot.intervals = {key: value for key, value in self.intervals.items() if key[0] != payer_id}
+        snapshot.items = {key: value for key, value in self.items.items() if key[0] != payer_id}
+        snapshot.codes = {p: codes for p, codes in self.codes.items() if p != payer_id}
+        snapshot._index(schedule)
+        return snapshot
+
+    def fee(self, payer_id: str, procedure_code: str, on_date: str) -> Optional[Dict[str, Any]]:
+        """The fee schedule item for a payer and code in force on a date"""
+        intervals = self.intervals.get((payer_id, procedure_code))
+        return intervals.at(parse_day(on_date)) if intervals else None
+
+    def query(self, payer_id: Optional[str] = None, procedure_code: Optional[str] = None,
+              effective_date: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Fee schedules filtered by payer, code and the date their items are in force"""
+        if payer_id:
+            schedules = [self.by_payer[payer_id]] if payer_id in self.by_payer else []
+        else:
+            schedules = self.schedules
+        if not procedure_code and not effective_date:
+            return schedules
+
+        day = parse_day(effective_date) if effective_date else None
+        filtered_schedules = []
+        for schedule in schedules:
+            schedule_payer = schedule.get("payer_id")
+            codes = [procedure_code] if procedure_code else self.codes.get(schedule_payer, [])
+            filtered_items = []
+            for code in codes:
+                if day is None:
+                    filtered_items.extend(self.items.get((schedule_payer, code), []))
+                    continue
+                intervals = self.intervals.get((schedule_payer, code))
+                item = intervals.at(day) if intervals else None
+                if item is not None:
+                    filtered_items.append(item)
+            if filtered_items:
+                filtered_schedule = schedule.copy()
+                filtered_schedule["items"] = filtered_items
+                filtered_schedules.append(filtered_schedule)
+        return filtered_schedules
+
+class FeeScheduleIndex:
+    """Loads the fee schedule file into snapshots and reloads it when it changes"""
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Initialize the fee schedule index
+
+        Args:
+            path: Fee schedule JSON file (defaults to environment variable)
+        """
+        self.path = path or os.environ.get("FEE_SCHEDULE_PATH", "data/fee_schedules.json")
+        # Seconds between modification time checks on the request path
+        self.check_interval = float(os.environ.get("FEE_SCHEDULE_RELOAD_CHECK", "2"))
+        self.snapshot = FeeScheduleSnapshot([])
+        self.loaded_at: Optional[str] = None
+        self._mtime: Optional[Tuple[int, int]] = None
+        self._next_check = 0.0
+        # Serialises writers and reloads; readers only ever read self.snapshot
+        self._write_lock = threading.Lock()
+        self.load()
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> FeeScheduleSnapshot:
+        """Parse the fee schedule file and swap in a new snapshot"""
+        with self._write_lock:
+            return self._load()
+
+    def _load(self) -> FeeScheduleSnapshot:
+        mtime = self._stat()
+        try:
+            with open(self.path, "r") as f:
+                schedules = json.load(f)
+        except FileNotFoundError:
+            schedules = []
+        self._publish(FeeScheduleSnapshot(schedules, self.snapshot.version + 1), mtime)
+        logger.info(f"Loaded {len(schedules)} fee schedules with {len(self.snapshot.intervals)} payer/code entries")
+        return self.snapshot
+
+    def _publish(self, snapshot: FeeScheduleSnapshot, mtime: Optional[Tuple[int, int]]) -> None:
+        # A single reference assignment, so a reader sees the old or the new snapshot whole
+        self.snapshot = snapshot
+        self._mtime = mtime
+        self.loaded_at = datetime.now().isoformat()
+
+    def current(self) -> FeeScheduleSnapshot:
+        """The current snapshot, reloading first if the file has changed"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            # Skip the check while a writer holds the lock; its snapshot is about to be published
+            if self._stat() != self._mtime and self._write_lock.acquire(blocking=False):
+                try:
+                    self._load()
+                except Exception as e:
+                    # Keep serving the previous snapshot until the file parses again
+                    logger.error(f"Error reloading fee schedules: {str(e)}")
+                finally:
+                    self._write_lock.release()
+        return self.snapshot
+
+    def update(self, payer_id: str, build: Callable[[Optional[Dict[str, Any]]], Dict[str, Any]],
+               expected_version: Optional[int] = None) -> FeeScheduleSnapshot:
+        """
+        Replace one payer's schedule and publish the next snapshot
+
+        Args:
+            payer_id: Payer whose schedule is replaced
+            build: Returns the new schedule given the current one (or None); must not mutate it
+            expected_version: Fail with a VersionConflict unless this is the current version
+
+        Returns:
+            FeeScheduleSnapshot: The published snapshot
+        """
+        with self._write_lock:
+            # Pick up edits made to the file outside this process before building on them
+            if self._stat() != self._mtime:
+                self._load()
+            base = self.snapshot
+            if expected_version is not None and expected_version != base.version:
+                raise VersionConflict(base.version)
+
+            schedule = build(base.by_payer.get(payer_id))
+            snapshot = base.replace(dict(schedule, payer_id=payer_id))
+            write_json_atomic(self.path, snapshot.schedules)
+            self._publish(snapshot, self._stat())
+            return snapshot
+
+class VersionConflict(Exception):
+    """The fee schedules changed since the version an update was based on"""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"Fee schedules are at version {current_version}")
+        self.current_version = current_version
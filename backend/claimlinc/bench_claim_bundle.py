@@ -0,0 +1,58 @@
+"""
+Microbenchmark for the NPHIES claim conversion hot path
+Times claim conversion, bundle assembly and JSON encoding per claim, without any network I/O.
+
+Usage:
+    python bench_claim_bundle.py --claims 20000 --procedures 5
+"""
+
+import argparse
+import time
+
+from bench_nphies import sample_claim
+from nphies_integration import NPHIESIntegration
+from nphies_templates import encode_bundle
+
+def build_claims(count: int, procedures: int) -> list:
+    """Build sample claims with the given number of procedure lines"""
+    claims = []
+    for index in range(count):
+        claim = sample_claim(index)
+        claim["procedures"] = claim["procedures"] * procedures
+        claims.append(claim)
+    return claims
+
+def timed(label: str, count: int, func) -> None:
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed * 1e6 / count:8.1f} us/claim  ({count / elapsed:,.0f} claims/s)")
+
+def run(count: int, procedures: int) -> None:
+    client = NPHIESIntegration(api_url="http://127.0.0.1:1", base_url="http://127.0.0.1:1/$process-message")
+    claims = build_claims(count, procedures)
+
+    def convert():
+        for claim in claims:
+            client._convert_to_nphies_claim_format(claim)
+
+    def convert_and_bundle():
+        for claim in claims:
+            client._create_bundle("claim", {"resources": [client._convert_to_nphies_claim_format(claim)]})
+
+    def convert_bundle_encode():
+        for claim in claims:
+            bundle = client._create_bundle("claim", {"resources": [client._convert_to_nphies_claim_format(claim)]})
+            encode_bundle(bundle)
+
+    print(f"claims: {count}, procedures per claim: {procedures}")
+    timed("convert", count, convert)
+    timed("convert + bundle", count, convert_and_bundle)
+    timed("convert + bundle + json", count, convert_bundle_encode)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NPHIES claim conversion and bundling")
+    parser.add_argument("--claims", type=int, default=20000)
+    parser.add_argument("--procedures", type=int, default=5)
+    args = parser.parse_args()
+    run(args.claims, args.procedures)
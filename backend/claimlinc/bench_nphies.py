@@ -0,0 +1,71 @@
+"""
+Offline throughput benchmark for the NPHIES client
+Starts the NPHIES stub server in-process and submits claims through NPHIESIntegration.
+
+Usage:
+    python bench_nphies.py --claims 500 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import time
+
+import uvicorn
+
+import nphies_stub
+from nphies_integration import NPHIESIntegration
+
+def sample_claim(index: int) -> dict:
+    """Build a small claim in ClaimLinc format"""
+    return {
+        "claim_id": f"BENCH-{index:06d}",
+        "patient": {"id": f"P{index}", "firstName": "Bench", "lastName": "Patient", "insurance": {"id": "COV1"}},
+        "provider": {"id": "PR1", "name": "Bench Clinic"},
+        "encounter": {"id": f"E{index}"},
+        "diagnosis": [{"code": "J06.9", "description": "Acute upper respiratory infection"}],
+        "procedures": [{"code": "99213", "description": "Office visit", "cost": 150.0}],
+    }
+
+async def run(claims: int, concurrency: int, port: int) -> None:
+    server = uvicorn.Server(uvicorn.Config(nphies_stub.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    client = NPHIESIntegration(
+        api_url=f"http://127.0.0.1:{port}",
+        base_url=f"http://127.0.0.1:{port}/$process-message",
+        max_connections=concurrency
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def submit(index: int) -> bool:
+        async with semaphore:
+            result = await client.send_claim(sample_claim(index))
+            return result["success"]
+
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(submit(i) for i in range(claims)))
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.aclose()
+        server.should_exit = True
+        await server_task
+
+    print(f"claims:          {claims}")
+    print(f"concurrency:     {concurrency}")
+    print(f"stub latency:    {nphies_stub.STUB_LATENCY_MS:.0f} ms")
+    print(f"succeeded:       {sum(results)}")
+    print(f"elapsed:         {elapsed:.2f} s")
+    print(f"throughput:      {claims / elapsed:.1f} claims/s")
+    print(f"token requests:  {nphies_stub.stats['token_requests']}")
+    print(f"messages:        {nphies_stub.stats['messages']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NPHIES claim submission against the local stub")
+    parser.add_argument("--claims", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=7099)
+    args = parser.parse_args()
+    asyncio.run(run(args.claims, args.concurrency, args.port))
@@ -7,20 +7,22 @@ Date: May 21, 2025
 
 import os
 import json
+import asyncio
 import logging
 from fastapi import FastAPI, HTTPException, Depends, Header, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from datetime import datetime, timedelta
-import httpx
 import uuid
 import jwt
 from fastapi.security import OAuth2PasswordBearer
 
 # Import NPHIES integration
 from nphies_integration import NPHIESIntegration
+from status_poller import ClaimStatusPoller
+from usage_recorder import UsageRecorder
 
 # Configure logging
 logging.basicConfig(
@@ -58,12 +60,40 @@ nphies_client = NPHIESIntegration(
     base_url=os.environ.get("NPHIES_BASE_URL", "https://HSB.nphies.sa/$process-message")
 )
 
+# Background poller for outstanding claim responses
+status_poller = ClaimStatusPoller(nphies_client)
+
+# Buffered billing usage, flushed in the background
+usage_recorder = UsageRecorder()
+STATUS_POLLER_ENABLED = os.environ.get("STATUS_POLLER_ENABLED", "true").lower() == "true"
+
+@app.on_event("startup")
+async def start_nphies_background_tasks():
+    """Renew the NPHIES auth token ahead of expiry, reload outstanding claims and start status polling"""
+    nphies_client.start_token_refresher()
+    usage_recorder.start()
+    if STATUS_POLLER_ENABLED:
+        try:
+            await status_poller.load()
+        except Exception as e:
+            logger.error(f"Error restoring outstanding claims: {str(e)}")
+        status_poller.start()
+
+@app.on_event("shutdown")
+async def close_nphies_client():
+    """Stop status polling, flush usage and release pooled NPHIES connections on shutdown"""
+    await status_poller.stop()
+    await usage_recorder.stop()
+    await nphies_client.aclose()
+
 # Models
 class ClaimStatusRequest(BaseModel):
     claim_id: str = Field(..., description="Unique identifier for the claim")
 
 class EligibilityRequest(BaseModel):
     patient: Dict[str, Any] = Field(..., description="Patient information including insurance details")
+    service_date: Optional[str] = Field(None, description="Date of service in format YYYY-MM-DD (defaults to today)")
+    force_refresh: bool = Field(False, description="Bypass cached eligibility results")
 
 class PatientInfo(BaseModel):
     id: str = Field(..., description="Unique identifier for the patient")
@@ -165,12 +195,13 @@ async def process_claim(claim: ClaimRequest, current_user: Dict[str, Any] = Depe
             claim.total_charge = sum(proc.cost * (proc.quantity or 1) for proc in claim.procedures)
         
         # Submit claim to NPHIES
-        nphies_response = nphies_client.send_claim(claim.dict())
+        nphies_response = await nphies_client.send_claim(claim.dict())
         
         if not nphies_response["success"]:
             logger.warning(f"NPHIES claim submission failed: {nphies_response['message']}")
         else:
             logger.info(f"NPHIES claim submission successful: {nphies_response['message']}")
+            status_poller.track(claim.claim_id, get_claim_payer_id(claim), nphies_response.get("nphies_claim_id"))
         
         # Process claim internally
         processed_claim = {
@@ -187,7 +218,7 @@ async def process_claim(claim: ClaimRequest, current_user: Dict[str, Any] = Depe
         }
         
         # Record usage for billing
-        await record_usage(current_user.get("user_id"), "claim_submission", 1)
+        record_usage(current_user.get("user_id"), "claim_submission", 1)
         
         return processed_claim
     
@@ -202,11 +233,16 @@ async def check_claim_status(status_request: ClaimStatusRequest, current_user: D
     try:
         logger.info(f"Checking status for claim {status_request.claim_id}")
         
-        # Check status with NPHIES
-        nphies_status = nphies_client.check_claim_status(status_request.claim_id)
+        # Serve claims the poller is tracking without another NPHIES round trip
+        nphies_status = status_poller.get_status(status_request.claim_id)
+        if nphies_status is not None:
+            nphies_status = {**nphies_status, "success": True, "message": "Status from claim status poller"}
+        else:
+            # Check status with NPHIES
+            nphies_status = await nphies_client.check_claim_status(status_request.claim_id)
         
         # Record usage for billing
-        await record_usage(current_user.get("user_id"), "claim_status_check", 1)
+        record_usage(current_user.get("user_id"), "claim_status_check", 1)
         
         return {
             "claim_id": status_request.claim_id,
@@ -226,6 +262,16 @@ async def check_claim_status(status_request: ClaimStatusRequest, current_user: D
         logger.error(f"Error checking claim status: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking claim status: {str(e)}")
 
+@app.get("/status/poller")
+async def get_status_poller_stats(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """Report claim status poller activity"""
+    return {
+        "enabled": STATUS_POLLER_ENABLED,
+        "outstanding_claims": len(status_poller.outstanding),
+        "payer_turnaround_seconds": status_poller.payer_turnaround,
+        **status_poller.stats
+    }
+
 # Check eligibility endpoint
 @app.post("/check-eligibility")
 async def check_eligibility(eligibility_request: EligibilityRequest, current_user: Dict[str, Any] = Depends(get_current_user)):
@@ -234,10 +280,14 @@ async def check_eligibility(eligibility_request: EligibilityRequest, current_use
         logger.info(f"Checking eligibility for patient {eligibility_request.patient.get('id')}")
         
         # Check eligibility with NPHIES
-        eligibility_response = nphies_client.check_eligibility(eligibility_request.patient)
+        eligibility_response = await nphies_client.check_eligibility(
+            eligibility_request.patient,
+            service_date=eligibility_request.service_date,
+            use_cache=not eligibility_request.force_refresh
+        )
         
         # Record usage for billing
-        await record_usage(current_user.get("user_id"), "eligibility_check", 1)
+        record_usage(current_user.get("user_id"), "eligibility_check", 1)
         
         return {
             "patient_id": eligibility_request.patient.get("id"),
@@ -246,6 +296,7 @@ async def check_eligibility(eligibility_request: EligibilityRequest, current_use
             "check_date": datetime.utcnow().isoformat(),
             "coverage_period": eligibility_response.get("coverage_period"),
             "benefits": eligibility_response.get("benefit_details", []),
+            "cached": eligibility_response.get("cached", False),
             "success": eligibility_response.get("success", False),
             "message": eligibility_response.get("message", "")
         }
@@ -254,13 +305,27 @@ async def check_eligibility(eligibility_request: EligibilityRequest, current_use
         logger.error(f"Error checking eligibility: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking eligibility: {str(e)}")
 
+@app.delete("/eligibility-cache/{national_id}")
+async def invalidate_eligibility_cache(
+    national_id: str,
+    insurer_id: Optional[str] = None,
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """Drop cached eligibility results after a patient's coverage changes"""
+    await nphies_client.eligibility_cache.invalidate(national_id, insurer_id)
+    return {
+        "success": True,
+        "message": f"Eligibility cache cleared for {national_id}",
+        "cache_stats": nphies_client.eligibility_cache.stats
+    }
+
 # Test endpoint for NPHIES connection
 @app.get("/test-nphies-connection")
 async def test_nphies_connection(current_user: Dict[str, Any] = Depends(get_current_user)):
     """Test connection to NPHIES"""
     try:
         # Get auth token as a simple connection test
-        token = nphies_client._get_auth_token()
+        token = await nphies_client._get_auth_token()
         
         if token:
             return {
@@ -369,6 +434,124 @@ async def get_eligibility_checks_report(current_user: Dict[str, Any] = Depends(g
 class BatchClaimRequest(BaseModel):
     claims: List[ClaimRequest] = Field(..., description="List of claims to process in batch")
     parallel_processing: Optional[bool] = Field(False, description="Whether to process claims in parallel")
+    stream: Optional[bool] = Field(False, description="Stream per-claim results as NDJSON as they complete")
+
+# Maximum in-flight NPHIES batch bundles per payer, shared by all batches
+BATCH_PAYER_CONCURRENCY = int(os.environ.get("BATCH_PAYER_CONCURRENCY", "10"))
+payer_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def get_payer_semaphore(payer_id: str) -> asyncio.Semaphore:
+    """Get the concurrency limiter for a payer"""
+    semaphore = payer_semaphores.get(payer_id)
+    if semaphore is None:
+        semaphore = payer_semaphores[payer_id] = asyncio.Semaphore(BATCH_PAYER_CONCURRENCY)
+    return semaphore
+
+def get_claim_payer_id(claim: ClaimRequest) -> str:
+    """Identify the payer a claim is submitted to"""
+    insurance = claim.patient.insurance or {}
+    return str(insurance.get("provider_id") or insurance.get("provider") or "default")
+
+def chunk_batch_claims(claims: List[ClaimRequest]) -> List[Tuple[str, List[Tuple[int, ClaimRequest]]]]:
+    """Group claims by payer and split each group into NPHIES batch-bundle sized chunks"""
+    by_payer: Dict[str, List[Tuple[int, ClaimRequest]]] = {}
+    for index, claim in enumerate(claims):
+        by_payer.setdefault(get_claim_payer_id(claim), []).append((index, claim))
+    
+    size = nphies_client.batch_size
+    return [
+        (payer_id, indexed_claims[start:start + size])
+        for payer_id, indexed_claims in by_payer.items()
+        for start in range(0, len(indexed_claims), size)
+    ]
+
+def build_batch_result(claim: ClaimRequest, nphies_response: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the result entry for one submitted batch claim"""
+    processed_claim = {
+        "claim_id": claim.claim_id,
+        "claim_status": "submitted",
+        "processing_date": datetime.utcnow().isoformat(),
+        "patient_id": claim.patient.id,
+        "provider_id": claim.provider.id,
+        "total_charge": claim.total_charge,
+        "currency": "SAR",
+        "nphies_status": "submitted" if nphies_response["success"] else "failed",
+        "nphies_details": nphies_response.get("data"),
+        "nphies_claim_id": nphies_response.get("nphies_claim_id")
+    }
+    
+    return {
+        "success": True,
+        "claim": processed_claim
+    }
+
+async def submit_claim_chunk(payer_id: str, indexed_claims: List[Tuple[int, ClaimRequest]]) -> List[Tuple[int, Dict[str, Any]]]:
+    """Submit a chunk of one payer's claims as a single NPHIES batch bundle"""
+    for _, claim in indexed_claims:
+        # Generate claim ID if not provided
+        if not claim.claim_id:
+            claim.claim_id = f"CLM-{uuid.uuid4().hex[:8].upper()}"
+        
+        # Calculate total charge if not provided
+        if claim.total_charge is None:
+            claim.total_charge = sum(proc.cost * (proc.quantity or 1) for proc in claim.procedures)
+    
+    try:
+        async with get_payer_semaphore(payer_id):
+            nphies_responses = await nphies_client.send_claims_batch([claim.dict() for _, claim in indexed_claims])
+        
+        for (_, claim), nphies_response in zip(indexed_claims, nphies_responses):
+            if nphies_response["success"]:
+                status_poller.track(claim.claim_id, payer_id, nphies_response.get("nphies_claim_id"))
+        
+        return [
+            (index, build_batch_result(claim, nphies_response))
+            for (index, claim), nphies_response in zip(indexed_claims, nphies_responses)
+        ]
+    
+    except Exception as e:
+        return [
+            (index, {
+                "success": False,
+                "claim_id": getattr(claim, "claim_id", "unknown"),
+                "error": str(e)
+            })
+            for index, claim in indexed_claims
+        ]
+
+def summarize_batch(batch_id: str, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the batch summary fields"""
+    return {
+        "batch_id": batch_id,
+        "total_claims": len(results),
+        "successful_claims": sum(1 for r in results if r.get("success")),
+        "failed_claims": sum(1 for r in results if not r.get("success")),
+        "processing_date": datetime.utcnow().isoformat()
+    }
+
+async def stream_batch_results(batch_request: BatchClaimRequest, batch_id: str, user_id: str):
+    """Yield one NDJSON line per claim as its chunk completes, then a summary line"""
+    results = []
+    tasks = []
+    try:
+        chunks = chunk_batch_claims(batch_request.claims)
+        if batch_request.parallel_processing:
+            tasks = [asyncio.ensure_future(submit_claim_chunk(*chunk)) for chunk in chunks]
+            completed = asyncio.as_completed(tasks)
+        else:
+            completed = (submit_claim_chunk(*chunk) for chunk in chunks)
+        
+        for next_chunk in completed:
+            for index, result in await next_chunk:
+                results.append(result)
+                yield json.dumps({"index": index, **result}) + "\n"
+        
+        record_usage(user_id, "batch_claim_submission", len(batch_request.claims))
+        yield json.dumps({"summary": summarize_batch(batch_id, results)}) + "\n"
+    finally:
+        # Stop outstanding submissions if the client disconnects mid-stream
+        for task in tasks:
+            task.cancel()
 
 @app.post("/batch/process")
 async def process_claims_batch(
@@ -387,62 +570,31 @@ async def process_claims_batch(
                 detail="Batch processing requires a Pro or Enterprise subscription"
             )
         
-        # Process claims
-        results = []
+        batch_id = f"BATCH-{uuid.uuid4().hex[:8].upper()}"
+        
+        if batch_request.stream:
+            return StreamingResponse(
+                stream_batch_results(batch_request, batch_id, current_user.get("user_id")),
+                media_type="application/x-ndjson"
+            )
         
+        # Submit claims as NPHIES batch bundles, keeping results in request order
+        chunks = chunk_batch_claims(batch_request.claims)
         if batch_request.parallel_processing:
-            # In a production environment, we would use async tasks or a task queue
-            # For this prototype, we'll process sequentially
-            logger.warning("Parallel processing requested but not implemented, processing sequentially")
+            chunk_results = await asyncio.gather(*(submit_claim_chunk(*chunk) for chunk in chunks))
+        else:
+            chunk_results = [await submit_claim_chunk(*chunk) for chunk in chunks]
         
-        for claim in batch_request.claims:
-            try:
-                # Generate claim ID if not provided
-                if not claim.claim_id:
-                    claim.claim_id = f"CLM-{uuid.uuid4().hex[:8].upper()}"
-                
-                # Calculate total charge if not provided
-                if claim.total_charge is None:
-                    claim.total_charge = sum(proc.cost * (proc.quantity or 1) for proc in claim.procedures)
-                
-                # Submit claim to NPHIES
-                nphies_response = nphies_client.send_claim(claim.dict())
-                
-                # Process claim internally
-                processed_claim = {
-                    "claim_id": claim.claim_id,
-                    "claim_status": "submitted",
-                    "processing_date": datetime.utcnow().isoformat(),
-                    "patient_id": claim.patient.id,
-                    "provider_id": claim.provider.id,
-                    "total_charge": claim.total_charge,
-                    "currency": "SAR",
-                    "nphies_status": "submitted" if nphies_response["success"] else "failed",
-                    "nphies_details": nphies_response.get("data"),
-                    "nphies_claim_id": nphies_response.get("nphies_claim_id")
-                }
-                
-                results.append({
-                    "success": True,
-                    "claim": processed_claim
-                })
-                
-            except Exception as e:
-                results.append({
-                    "success": False,
-                    "claim_id": getattr(claim, "claim_id", "unknown"),
-                    "error": str(e)
-                })
+        results = [None] * len(batch_request.claims)
+        for indexed_results in chunk_results:
+            for index, result in indexed_results:
+                results[index] = result
         
         # Record usage for billing
-        await record_usage(current_user.get("user_id"), "batch_claim_submission", len(batch_request.claims))
+        record_usage(current_user.get("user_id"), "batch_claim_submission", len(batch_request.claims))
         
         return {
-            "batch_id": f"BATCH-{uuid.uuid4().hex[:8].upper()}",
-            "total_claims": len(batch_request.claims),
-            "successful_claims": sum(1 for r in results if r.get("success")),
-            "failed_claims": sum(1 for r in results if not r.get("success")),
-            "processing_date": datetime.utcnow().isoformat(),
+            **summarize_batch(batch_id, results),
             "results": results
         }
         
@@ -453,29 +605,11 @@ async def process_claims_batch(
         raise HTTPException(status_code=500, detail=f"Error processing batch of claims: {str(e)}")
 
 # Record usage for billing
-async def record_usage(user_id: str, operation_type: str, count: int = 1):
+def record_usage(user_id: str, operation_type: str, count: int = 1):
     """Record API usage for billing purposes"""
     try:
-        # In a production environment, this would make an async call to the billing service
-        billing_url = os.environ.get("BILLING_SERVICE_URL", "http://billing-service:8080/api/usage")
-        
-        usage_data = {
-            "user_id": user_id,
-            "service": "claimlinc",
-            "operation": operation_type,
-            "count": count,
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        
-        # In this prototype, we'll just log the usage
-        logger.info(f"Usage recorded: {json.dumps(usage_data)}")
-        
-        # In production, uncomment this to send to billing service
-        # async with httpx.AsyncClient() as client:
-        #     response = await client.post(billing_url, json=usage_data)
-        #     if response.status_code != 200:
-        #         logger.error(f"Failed to record usage: {response.text}")
-        
+        # Buffered and sent to the billing service in aggregated batches
+        usage_recorder.record(user_id, operation_type, count)
     except Exception as e:
         logger.error(f"Error recording usage: {str(e)}")
         # Don't re-raise, as this is a background operation that shouldn't affect the main API response
@@ -7,12 +7,18 @@ Date: May 21, 2025
 
 import os
 import json
+import asyncio
 import logging
-import requests
+import random
 import uuid
+from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
-from requests.auth import HTTPBasicAuth
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from eligibility_cache import EligibilityCache, create_eligibility_cache, coverage_fingerprint, insurer_of
+import nphies_templates as templates
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +31,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger("nphies_integration")
 
+class TokenCache(ABC):
+    """Store for the NPHIES auth token, keyed by client ID"""
+    
+    @abstractmethod
+    async def get(self, client_id: str) -> Optional[Tuple[str, datetime]]:
+        """Return the cached (token, expiry) pair, if any"""
+    
+    @abstractmethod
+    async def set(self, client_id: str, token: str, expiry: datetime) -> None:
+        """Store a token until its expiry"""
+
+class InMemoryTokenCache(TokenCache):
+    """Per-process token cache"""
+    
+    def __init__(self):
+        self._tokens: Dict[str, Tuple[str, datetime]] = {}
+    
+    async def get(self, client_id: str) -> Optional[Tuple[str, datetime]]:
+        return self._tokens.get(client_id)
+    
+    async def set(self, client_id: str, token: str, expiry: datetime) -> None:
+        self._tokens[client_id] = (token, expiry)
+
+class RedisTokenCache(TokenCache):
+    """Token cache shared by every worker process through Redis"""
+    
+    def __init__(self, url: str, key_prefix: str = "nphies:token:"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self.key_prefix = key_prefix
+    
+    async def get(self, client_id: str) -> Optional[Tuple[str, datetime]]:
+        raw = await self._redis.get(f"{self.key_prefix}{client_id}")
+        if not raw:
+            return None
+        entry = json.loads(raw)
+        return entry["access_token"], datetime.fromtimestamp(entry["expiry"])
+    
+    async def set(self, client_id: str, token: str, expiry: datetime) -> None:
+        ttl = int((expiry - datetime.now()).total_seconds())
+        if ttl <= 0:
+            return
+        entry = json.dumps({"access_token": token, "expiry": expiry.timestamp()})
+        await self._redis.set(f"{self.key_prefix}{client_id}", entry, ex=ttl)
+
+def create_token_cache(url: Optional[str] = None) -> TokenCache:
+    """Create the token cache named by ``url`` or NPHIES_TOKEN_CACHE_URL"""
+    url = url or os.environ.get("NPHIES_TOKEN_CACHE_URL")
+    if url and url.startswith(("redis://", "rediss://")):
+        return RedisTokenCache(url)
+    return InMemoryTokenCache()
+
+# HTTP status codes worth retrying: throttling and transient upstream failures
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+# Responses that mean the request was not processed, so even submissions may be resent
+UNPROCESSED_STATUS_CODES = {429, 503}
+# Failures before the request reached NPHIES
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
 class NPHIESIntegration:
     """Integration client for NPHIES Saudi Arabia"""
     
@@ -32,7 +97,12 @@ class NPHIESIntegration:
                  api_url: Optional[str] = None, 
                  base_url: Optional[str] = None,
                  client_id: Optional[str] = None,
-                 client_secret: Optional[str] = None):
+                 client_secret: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None,
+                 max_connections: Optional[int] = None,
+                 token_cache: Optional["TokenCache"] = None,
+                 eligibility_cache: Optional[EligibilityCache] = None):
         """
         Initialize NPHIES Integration client
         
@@ -41,6 +111,11 @@ class NPHIESIntegration:
             base_url: NPHIES Base URL (defaults to environment variable)
             client_id: NPHIES client ID (defaults to environment variable)
             client_secret: NPHIES client secret (defaults to environment variable)
+            timeout: Request timeout in seconds (defaults to environment variable)
+            max_retries: Retries for transient failures (defaults to environment variable)
+            max_connections: Size of the HTTP connection pool (defaults to environment variable)
+            token_cache: Cache for sharing the auth token (defaults to NPHIES_TOKEN_CACHE_URL)
+            eligibility_cache: Cache for eligibility results (defaults to ELIGIBILITY_CACHE_URL)
         """
         # Load from provided parameters or environment variables
         self.api_url = api_url or os.environ.get("NPHIES_API_URL", "http://172.16.6.66:7000")
@@ -48,126 +123,265 @@ class NPHIESIntegration:
         self.client_id = client_id or os.environ.get("NPHIES_CLIENT_ID", "developer_client")
         self.client_secret = client_secret or os.environ.get("NPHIES_CLIENT_SECRET", "developer_secret")
         
-        # Access token storage
+        # HTTP transport settings
+        self.timeout = timeout if timeout is not None else float(os.environ.get("NPHIES_TIMEOUT", "30"))
+        self.connect_timeout = float(os.environ.get("NPHIES_CONNECT_TIMEOUT", "5"))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("NPHIES_MAX_RETRIES", "3"))
+        self.retry_backoff = float(os.environ.get("NPHIES_RETRY_BACKOFF", "0.5"))
+        self.max_connections = max_connections or int(os.environ.get("NPHIES_MAX_CONNECTIONS", "100"))
+        self.keepalive_expiry = float(os.environ.get("NPHIES_KEEPALIVE_EXPIRY", "30"))
+        self.batch_size = max(1, int(os.environ.get("NPHIES_BATCH_SIZE", "50")))
+        
+        # MessageHeader destination, shared by every bundle sent to this endpoint
+        self._destination = templates.destination(self.base_url)
+        
+        # Shared connection pool, created lazily inside the running event loop
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # Access token storage, shared across workers through the token cache
         self.access_token = None
         self.token_expiry = None
+        self.token_cache = token_cache or create_token_cache()
+        self.token_refresh_ahead = float(os.environ.get("NPHIES_TOKEN_REFRESH_AHEAD", "120"))
+        self.token_retry_delay = float(os.environ.get("NPHIES_TOKEN_RETRY_DELAY", "30"))
+        self._token_lifetime = 3600
+        self._token_lock: Optional[asyncio.Lock] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        
+        # Recent eligibility results, so repeated front-desk checks skip NPHIES
+        self.eligibility_cache = eligibility_cache or create_eligibility_cache()
         
         logger.info(f"NPHIES Integration initialized with API URL: {self.api_url}")
 
-    def _get_auth_token(self) -> str:
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the pooled HTTP client, creating it on first use"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Stop the token refresher and release pooled connections"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, url: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+        """
+        POST to NPHIES over the pooled client, retrying transient failures
+        
+        Idempotent requests (token, status and eligibility queries) retry on any
+        transport error and on throttling/gateway responses. Submissions and
+        poll requests are not idempotent: after a read timeout or a 502/504,
+        NPHIES may already have accepted the message, and each attempt carries
+        a new Bundle id. So they are retried only when the request never
+        reached NPHIES (connection failures) or was refused unprocessed
+        (429/503). Retries back off exponentially, with full jitter so that
+        concurrent callers do not retry in lockstep, up to ``max_retries`` times.
+        
+        Returns:
+            httpx.Response: The last response received
+        """
+        client = self._get_client()
+        if "json" in kwargs:
+            # Encode once, compactly, rather than on every retry
+            kwargs["content"] = templates.encode_bundle(kwargs.pop("json"))
+        retry_status = RETRYABLE_STATUS_CODES if idempotent else UNPROCESSED_STATUS_CODES
+        retry_errors = httpx.TransportError if idempotent else UNSENT_ERRORS
+        attempt = 0
+        while True:
+            try:
+                response = await client.post(url, **kwargs)
+                if response.status_code not in retry_status or attempt >= self.max_retries:
+                    return response
+                logger.warning(f"NPHIES returned {response.status_code} for {url}, retrying")
+            except retry_errors as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"NPHIES request to {url} failed ({type(e).__name__}), retrying")
+            
+            delay = random.uniform(0, self.retry_backoff * (2 ** attempt))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _get_token_lock(self) -> asyncio.Lock:
+        """Return the token refresh lock, created inside the running event loop"""
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        return self._token_lock
+
+    def _token_valid(self, margin: float = 0) -> bool:
+        """Whether the in-process token is usable for at least ``margin`` seconds"""
+        return bool(
+            self.access_token and self.token_expiry
+            and datetime.now() + timedelta(seconds=margin) < self.token_expiry
+        )
+
+    async def _load_cached_token(self, margin: float = 0) -> bool:
+        """Adopt a token renewed by another worker, if the shared cache holds one"""
+        cached = await self.token_cache.get(self.client_id)
+        if not cached:
+            return False
+        token, expiry = cached
+        if datetime.now() + timedelta(seconds=margin) >= expiry:
+            return False
+        self.access_token = token
+        self.token_expiry = expiry
+        return True
+
+    async def _get_auth_token(self) -> str:
         """
         Get authentication token from NPHIES
         
+        Concurrent callers that find the token expired share a single refresh:
+        the first one renews it while the others wait on the lock and then
+        reuse the result. The lock is per process; other workers are not
+        blocked, but pick up a token renewed meanwhile from the shared token
+        cache, so at most one renewal per worker races at expiry.
+        
         Returns:
             str: Authentication token
         """
         try:
-            logger.info("Getting authentication token from NPHIES")
-            
             # Check if we have a valid token
-            if self.access_token and self.token_expiry and datetime.now() < self.token_expiry:
-                logger.info("Using cached token")
+            if self._token_valid():
+                logger.debug("Using cached token")
                 return self.access_token
             
-            # Make token request
-            auth_url = f"{self.api_url}/oauth2/token"
-            
-            # Using client credentials flow
-            data = {
-                "grant_type": "client_credentials",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "scope": "nphies_api"
-            }
-            
-            headers = {
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-            
-            logger.info(f"Requesting token from {auth_url}")
-            response = requests.post(
-                auth_url,
-                data=data,
-                headers=headers
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Token request failed: {response.status_code} {response.text}")
-                return None
-            
-            # Parse response
-            token_data = response.json()
-            self.access_token = token_data.get("access_token")
-            
-            # Set token expiry (usually 1 hour, but subtract 5 minutes for safety)
-            expires_in = token_data.get("expires_in", 3600) - 300
-            self.token_expiry = datetime.now() + timedelta(seconds=expires_in)
-            
-            logger.info("Successfully obtained NPHIES auth token")
-            return self.access_token
+            async with self._get_token_lock():
+                # Another coroutine or worker may have renewed it while we waited
+                if self._token_valid() or await self._load_cached_token():
+                    return self.access_token
+                
+                return await self._fetch_auth_token()
         
         except Exception as e:
             logger.error(f"Error getting auth token: {str(e)}")
             return None
+
+    async def _fetch_auth_token(self) -> Optional[str]:
+        """
+        Request a new authentication token from NPHIES
+        
+        Callers must hold the token lock.
+        
+        Returns:
+            str: Authentication token, or None if the request failed
+        """
+        logger.info("Getting authentication token from NPHIES")
+        
+        # Make token request
+        auth_url = f"{self.api_url}/oauth2/token"
+        
+        # Using client credentials flow
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "scope": "nphies_api"
+        }
+        
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        
+        logger.info(f"Requesting token from {auth_url}")
+        response = await self._post(
+            auth_url,
+            data=data,
+            headers=headers
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"Token request failed: {response.status_code} {response.text}")
+            return None
+        
+        # Parse response
+        token_data = response.json()
+        self.access_token = token_data.get("access_token")
+        
+        # Set token expiry (usually 1 hour) 5 minutes early for safety, but
+        # never more than half the lifetime, so short-lived tokens are not
+        # already expired and renewed in a tight loop
+        expires_in = int(token_data.get("expires_in", 3600))
+        lifetime = max(expires_in - min(300, expires_in // 2), 1)
+        self.token_expiry = datetime.now() + timedelta(seconds=lifetime)
+        self._token_lifetime = lifetime
+        
+        try:
+            await self.token_cache.set(self.client_id, self.access_token, self.token_expiry)
+        except Exception as e:
+            logger.warning(f"Could not share NPHIES auth token: {str(e)}")
+        
+        logger.info("Successfully obtained NPHIES auth token")
+        return self.access_token
+
+    def start_token_refresher(self) -> None:
+        """Start renewing the auth token in the background before it expires"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_token_periodically())
+
+    async def _refresh_token_periodically(self) -> None:
+        """Renew the auth token ``token_refresh_ahead`` seconds before expiry"""
+        while True:
+            try:
+                # Spread wake-ups so that workers sharing a cache do not all renew at once
+                ahead = self.token_refresh_ahead + random.uniform(0, self.token_refresh_ahead / 2)
+                # Short-lived tokens are renewed halfway through their lifetime
+                ahead = min(ahead, self._token_lifetime / 2)
+                if self.token_expiry:
+                    delay = (self.token_expiry - datetime.now()).total_seconds() - ahead
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                
+                async with self._get_token_lock():
+                    if self._token_valid(ahead) or await self._load_cached_token(ahead):
+                        continue
+                    token = await self._fetch_auth_token()
+                
+                if not token:
+                    await asyncio.sleep(self.token_retry_delay)
+            
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error refreshing auth token: {str(e)}")
+                await asyncio.sleep(self.token_retry_delay)
     
-    def _create_bundle(self, message_type: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    def _create_bundle(self, message_type: str, payload: Dict[str, Any],
+                       timestamp: Optional[str] = None) -> Dict[str, Any]:
         """
         Create FHIR Bundle for NPHIES message
         
         Args:
             message_type: Type of message (claim, eligibility, etc.)
             payload: Payload resources to include in the bundle
+            timestamp: Bundle timestamp (defaults to now)
             
         Returns:
             dict: FHIR Bundle
         """
-        # Create a FHIR Bundle with the appropriate message type
-        bundle_id = str(uuid.uuid4())
-        timestamp = datetime.utcnow().isoformat() + "Z"
-        
-        bundle = {
-            "resourceType": "Bundle",
-            "id": bundle_id,
-            "type": "message",
-            "timestamp": timestamp,
-            "entry": [
-                {
-                    "fullUrl": f"urn:uuid:{str(uuid.uuid4())}",
-                    "resource": {
-                        "resourceType": "MessageHeader",
-                        "id": str(uuid.uuid4()),
-                        "eventCoding": {
-                            "system": "https://nphies.sa/terminology/message-events",
-                            "code": message_type
-                        },
-                        "source": {
-                            "name": "BrainSAIT Healthcare",
-                            "software": "ClaimLinc",
-                            "version": "2.0.0",
-                            "endpoint": "https://api.brainsait.com"
-                        },
-                        "destination": [
-                            {
-                                "name": "NPHIES",
-                                "endpoint": self.base_url
-                            }
-                        ]
-                    }
-                }
-            ]
-        }
-        
-        # Add payload resources to the bundle
-        for resource in payload.get("resources", []):
-            resource_id = resource.get("id", str(uuid.uuid4()))
-            bundle["entry"].append({
-                "fullUrl": f"urn:uuid:{resource_id}",
-                "resource": resource
-            })
-        
-        return bundle
+        return templates.message_bundle(
+            message_type,
+            self._destination,
+            payload.get("resources", []),
+            timestamp or templates.utc_timestamp()
+        )
 
-    def send_claim(self, claim_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def send_claim(self, claim_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Send a claim to NPHIES
         
@@ -181,13 +395,14 @@ class NPHIESIntegration:
             logger.info(f"Sending claim {claim_data.get('claim_id')} to NPHIES")
             
             # Convert to NPHIES format
-            nphies_claim = self._convert_to_nphies_claim_format(claim_data)
+            timestamp = templates.utc_timestamp()
+            nphies_claim = self._convert_to_nphies_claim_format(claim_data, created=timestamp)
             
             # Create bundle
-            bundle = self._create_bundle("claim", {"resources": [nphies_claim]})
+            bundle = self._create_bundle("claim", {"resources": [nphies_claim]}, timestamp)
             
             # Get auth token
-            token = self._get_auth_token()
+            token = await self._get_auth_token()
             if not token:
                 return {
                     "success": False,
@@ -203,8 +418,9 @@ class NPHIESIntegration:
             }
             
             logger.info(f"Sending claim bundle to {self.base_url}")
-            response = requests.post(
+            response = await self._post(
                 self.base_url,
+                idempotent=False,
                 json=bundle,
                 headers=headers
             )
@@ -237,7 +453,130 @@ class NPHIESIntegration:
                 "data": None
             }
     
-    def check_claim_status(self, claim_id: str) -> Dict[str, Any]:
+    async def send_claims_batch(self, claims_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send several claims to NPHIES in batch-request bundles
+        
+        Claims are packed up to ``batch_size`` per batch bundle, each wrapped in its
+        own claim message bundle as NPHIES expects, and every batch is sent in a
+        single round trip. Response entries are mapped back to their claims.
+        
+        Args:
+            claims_data: Claims in BrainSAIT format
+            
+        Returns:
+            list: One send_claim-style result per claim, in input order
+        """
+        if len(claims_data) == 1:
+            return [await self.send_claim(claims_data[0])]
+        
+        chunks = [
+            claims_data[start:start + self.batch_size]
+            for start in range(0, len(claims_data), self.batch_size)
+        ]
+        chunk_results = await asyncio.gather(*(self._send_batch_bundle(chunk) for chunk in chunks))
+        return [result for results in chunk_results for result in results]
+
+    async def _send_batch_bundle(self, claims_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send one batch-request bundle and map its response back to each claim"""
+        try:
+            logger.info(f"Sending batch of {len(claims_data)} claims to NPHIES")
+            
+            # Wrap each claim in its own message bundle inside the batch
+            timestamp = templates.utc_timestamp()
+            claim_bundles = [
+                self._create_bundle(
+                    "claim",
+                    {"resources": [self._convert_to_nphies_claim_format(claim_data, created=timestamp)]},
+                    timestamp
+                )
+                for claim_data in claims_data
+            ]
+            bundle = self._create_bundle("batch-request", {"resources": claim_bundles}, timestamp)
+            bundle["entry"][0]["resource"]["focus"] = [
+                {"reference": entry["fullUrl"]} for entry in bundle["entry"][1:]
+            ]
+            
+            # Get auth token
+            token = await self._get_auth_token()
+            if not token:
+                return [{
+                    "success": False,
+                    "message": "Failed to get authentication token",
+                    "data": None
+                } for _ in claims_data]
+            
+            # Send to NPHIES
+            headers = {
+                "Content-Type": "application/fhir+json",
+                "Authorization": f"Bearer {token}",
+                "X-Request-ID": str(uuid.uuid4())
+            }
+            
+            response = await self._post(
+                self.base_url,
+                idempotent=False,
+                json=bundle,
+                headers=headers
+            )
+            
+            if response.status_code not in [200, 201, 202]:
+                logger.error(f"Batch submission failed: {response.status_code} {response.text}")
+                return [{
+                    "success": False,
+                    "message": f"Batch submission failed: {response.status_code}",
+                    "data": response.text if response.text else None
+                } for _ in claims_data]
+            
+            # Parse response and match each inner response to its request bundle
+            responses = self._map_batch_responses(response.json())
+            
+            results = []
+            for claim_bundle in claim_bundles:
+                # NPHIES answers a message with the id of its MessageHeader, not of the bundle
+                claim_response = responses.get(claim_bundle["entry"][0]["resource"]["id"])
+                if claim_response is None:
+                    results.append({
+                        "success": False,
+                        "message": "No response for claim in batch response",
+                        "data": None
+                    })
+                    continue
+                results.append({
+                    "success": True,
+                    "message": "Claim submitted successfully",
+                    "data": claim_response,
+                    "nphies_claim_id": self._extract_nphies_claim_id(claim_response)
+                })
+            
+            logger.info(f"Batch submission successful: {sum(1 for r in results if r['success'])}/{len(results)} claims answered")
+            return results
+        
+        except Exception as e:
+            logger.error(f"Error sending claim batch: {str(e)}")
+            return [{
+                "success": False,
+                "message": f"Error sending claim batch: {str(e)}",
+                "data": None
+            } for _ in claims_data]
+
+    def _map_batch_responses(self, response_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Index the message bundles of a batch response by the request MessageHeader they answer"""
+        responses = {}
+        for entry in response_data.get("entry", []):
+            resource = entry.get("resource", {})
+            if resource.get("resourceType") != "Bundle":
+                continue
+            for inner_entry in resource.get("entry", []):
+                header = inner_entry.get("resource", {})
+                if header.get("resourceType") == "MessageHeader":
+                    request_id = header.get("response", {}).get("identifier")
+                    if request_id:
+                        responses[request_id] = resource
+                    break
+        return responses
+    
+    async def check_claim_status(self, claim_id: str) -> Dict[str, Any]:
         """
         Check the status of a claim with NPHIES
         
@@ -268,7 +607,7 @@ class NPHIESIntegration:
             bundle = self._create_bundle("claim-status", {"resources": [status_request]})
             
             # Get auth token
-            token = self._get_auth_token()
+            token = await self._get_auth_token()
             if not token:
                 return {
                     "success": False,
@@ -284,7 +623,7 @@ class NPHIESIntegration:
             }
             
             logger.info(f"Sending status check to {self.base_url}")
-            response = requests.post(
+            response = await self._post(
                 self.base_url,
                 json=bundle,
                 headers=headers
@@ -322,12 +661,134 @@ class NPHIESIntegration:
                 "data": None
             }
     
-    def check_eligibility(self, patient_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def poll_messages(self, message_type: str = "claim-response", count: int = 100) -> Dict[str, Any]:
+        """
+        Poll NPHIES for queued response messages
+        
+        One poll-request returns the queued responses for every outstanding
+        request of the given type, so many claims are checked in a single call.
+        
+        Args:
+            message_type: Response message type to collect (e.g. claim-response)
+            count: Maximum number of messages to collect
+            
+        Returns:
+            dict: Poll result with the queued response bundles under "messages"
+        """
+        try:
+            logger.info(f"Polling NPHIES for queued {message_type} messages")
+            
+            # Create poll Task
+            today = datetime.utcnow().date().isoformat()
+            poll_task = {
+                "resourceType": "Task",
+                "id": str(uuid.uuid4()),
+                "status": "requested",
+                "intent": "order",
+                "priority": "stat",
+                "code": {
+                    "coding": [
+                        {
+                            "system": "http://nphies.sa/terminology/CodeSystem/task-code",
+                            "code": "poll"
+                        }
+                    ]
+                },
+                "authoredOn": today,
+                "lastModified": today,
+                "input": [
+                    {
+                        "type": {
+                            "coding": [
+                                {
+                                    "system": "http://nphies.sa/terminology/CodeSystem/task-input-type",
+                                    "code": "include-message-type"
+                                }
+                            ]
+                        },
+                        "valueCode": message_type
+                    },
+                    {
+                        "type": {
+                            "coding": [
+                                {
+                                    "system": "http://nphies.sa/terminology/CodeSystem/task-input-type",
+                                    "code": "count"
+                                }
+                            ]
+                        },
+                        "valuePositiveInt": count
+                    }
+                ]
+            }
+            
+            # Create bundle
+            bundle = self._create_bundle("poll-request", {"resources": [poll_task]})
+            
+            # Get auth token
+            token = await self._get_auth_token()
+            if not token:
+                return {
+                    "success": False,
+                    "message": "Failed to get authentication token",
+                    "messages": []
+                }
+            
+            # Send to NPHIES
+            headers = {
+                "Content-Type": "application/fhir+json",
+                "Authorization": f"Bearer {token}",
+                "X-Request-ID": str(uuid.uuid4())
+            }
+            
+            response = await self._post(
+                self.base_url,
+                idempotent=False,
+                json=bundle,
+                headers=headers
+            )
+            
+            if response.status_code not in [200, 201, 202]:
+                logger.error(f"Poll request failed: {response.status_code} {response.text}")
+                return {
+                    "success": False,
+                    "message": f"Poll request failed: {response.status_code}",
+                    "messages": []
+                }
+            
+            # Queued messages are returned as nested Bundle entries
+            response_data = response.json()
+            messages = [
+                entry.get("resource", {})
+                for entry in response_data.get("entry", [])
+                if entry.get("resource", {}).get("resourceType") == "Bundle"
+            ]
+            
+            logger.info(f"Poll returned {len(messages)} queued messages")
+            return {
+                "success": True,
+                "message": "Poll successful",
+                "messages": messages
+            }
+        
+        except Exception as e:
+            logger.error(f"Error polling NPHIES: {str(e)}")
+            return {
+                "success": False,
+                "message": f"Error polling NPHIES: {str(e)}",
+                "messages": []
+            }
+    
+    async def check_eligibility(self, patient_data: Dict[str, Any],
+                                service_date: Optional[str] = None,
+                                use_cache: bool = True) -> Dict[str, Any]:
         """
         Check patient eligibility with NPHIES
         
         Args:
             patient_data: Patient data including insurance information
+            service_date: Date of service (defaults to today)
+            use_cache: Serve a recent result for the same patient, insurer and date
             
         Returns:
             dict: Eligibility response
@@ -335,6 +796,25 @@ class NPHIESIntegration:
         try:
             logger.info(f"Checking eligibility for patient ID: {patient_data.get('id', 'unknown')}")
             
+            insurance = patient_data.get("insurance", {})
+            national_id = patient_data.get("nationalId") or patient_data.get("iqamaNumber")
+            insurer_id = insurer_of(insurance)
+            fingerprint = coverage_fingerprint(insurance)
+            
+            if use_cache:
+                cached = await self.eligibility_cache.get(national_id, insurer_id, service_date, fingerprint)
+                if cached is not None:
+                    logger.info("Eligibility served from cache")
+                    return {
+                        "success": True,
+                        "message": "Eligibility check successful (cached)",
+                        "is_eligible": cached.get("is_eligible", False),
+                        "coverage_period": cached.get("coverage_period"),
+                        "benefit_details": cached.get("benefit_details", []),
+                        "cached": True,
+                        "data": None
+                    }
+            
             # Convert BrainSAIT patient format to NPHIES FHIR format
             eligibility_request = self._convert_to_eligibility_request(patient_data)
             
@@ -342,7 +822,7 @@ class NPHIESIntegration:
             bundle = self._create_bundle("coverage-eligibility", {"resources": [eligibility_request]})
             
             # Get auth token
-            token = self._get_auth_token()
+            token = await self._get_auth_token()
             if not token:
                 return {
                     "success": False,
@@ -358,7 +838,7 @@ class NPHIESIntegration:
             }
             
             logger.info("Sending eligibility request to NPHIES")
-            response = requests.post(
+            response = await self._post(
                 self.base_url,
                 json=bundle,
                 headers=headers
@@ -380,12 +860,17 @@ class NPHIESIntegration:
             # Extract eligibility information
             eligibility_info = self._extract_eligibility_info(response_data)
             
+            # Extraction failures carry a message and are not worth caching
+            if "message" not in eligibility_info:
+                await self.eligibility_cache.set(national_id, insurer_id, service_date, eligibility_info, fingerprint)
+            
             return {
                 "success": True,
                 "message": "Eligibility check successful",
                 "is_eligible": eligibility_info.get("is_eligible", False),
                 "coverage_period": eligibility_info.get("coverage_period"),
                 "benefit_details": eligibility_info.get("benefit_details", []),
+                "cached": False,
                 "data": response_data
             }
             
@@ -494,12 +979,14 @@ class NPHIESIntegration:
             logger.error(f"Error extracting eligibility info: {str(e)}")
             return {"is_eligible": False, "message": str(e)}
     
-    def _convert_to_nphies_claim_format(self, claim_data: Dict[str, Any]) -> Dict[str, Any]:
+    def _convert_to_nphies_claim_format(self, claim_data: Dict[str, Any],
+                                        created: Optional[str] = None) -> Dict[str, Any]:
         """
         Convert BrainSAIT claim format to NPHIES FHIR Claim format
         
         Args:
             claim_data: Claim data in BrainSAIT format
+            created: Creation timestamp (defaults to now)
             
         Returns:
             dict: NPHIES FHIR Claim resource
@@ -511,40 +998,26 @@ class NPHIESIntegration:
         diagnosis = claim_data.get("diagnosis", [])
         procedures = claim_data.get("procedures", [])
         
-        # Create NPHIES FHIR Claim
-        claim_id = claim_data.get("claim_id", str(uuid.uuid4()))
+        # Create NPHIES FHIR Claim from the shared static sections
+        claim_id = claim_data.get("claim_id") or templates.new_id()
+        encounter_section = [{"reference": f"Encounter/{encounter.get('id', '1')}"}]
         
         nphies_claim = {
             "resourceType": "Claim",
             "id": claim_id,
             "status": "active",
-            "type": {
-                "coding": [
-                    {
-                        "system": "http://terminology.hl7.org/CodeSystem/claim-type",
-                        "code": "professional",
-                        "display": "Professional"
-                    }
-                ]
-            },
+            "type": templates.CLAIM_TYPE_PROFESSIONAL,
             "use": "claim",
             "patient": {
                 "reference": f"Patient/{patient.get('id', '1')}",
                 "display": f"{patient.get('firstName', '')} {patient.get('lastName', '')}"
             },
-            "created": datetime.utcnow().isoformat() + "Z",
+            "created": created or templates.utc_timestamp(),
             "provider": {
                 "reference": f"Practitioner/{provider.get('id', '1')}",
                 "display": provider.get('name', 'Provider')
             },
-            "priority": {
-                "coding": [
-                    {
-                        "system": "http://terminology.hl7.org/CodeSystem/processpriority",
-                        "code": "normal"
-                    }
-                ]
-            },
+            "priority": templates.CLAIM_PRIORITY_NORMAL,
             "insurance": [
                 {
                     "sequence": 1,
@@ -554,53 +1027,18 @@ class NPHIESIntegration:
                     }
                 }
             ],
-            "item": []
+            # Add procedures as items
+            "item": [
+                templates.claim_item(i, proc, encounter_section)
+                for i, proc in enumerate(procedures, 1)
+            ]
         }
         
         # Add diagnoses
         if diagnosis:
-            nphies_claim["diagnosis"] = []
-            for i, diag in enumerate(diagnosis):
-                nphies_claim["diagnosis"].append({
-                    "sequence": i + 1,
-                    "diagnosisCodeableConcept": {
-                        "coding": [
-                            {
-                                "system": "http://hl7.org/fhir/sid/icd-10",
-                                "code": diag.get("code", "R69"),
-                                "display": diag.get("description", "Illness, unspecified")
-                            }
-                        ]
-                    }
-                })
-        
-        # Add procedures as items
-        for i, proc in enumerate(procedures):
-            nphies_claim["item"].append({
-                "sequence": i + 1,
-                "productOrService": {
-                    "coding": [
-                        {
-                            "system": "http://www.ama-assn.org/go/cpt",
-                            "code": proc.get("code", "99213"),
-                            "display": proc.get("description", "Office visit")
-                        }
-                    ]
-                },
-                "unitPrice": {
-                    "value": proc.get("cost", 0),
-                    "currency": "SAR"
-                },
-                "net": {
-                    "value": proc.get("cost", 0),
-                    "currency": "SAR"
-                },
-                "encounter": [
-                    {
-                        "reference": f"Encounter/{encounter.get('id', '1')}"
-                    }
-                ]
-            })
+            nphies_claim["diagnosis"] = [
+                templates.claim_diagnosis(i, diag) for i, diag in enumerate(diagnosis, 1)
+            ]
         
         return nphies_claim
     
@@ -0,0 +1,141 @@
+"""
+Local NPHIES stub server for ClaimLinc
+Answers the OAuth token and $process-message endpoints with canned FHIR responses
+so the NPHIES client can be exercised and benchmarked offline.
+
+Run with:
+    NPHIES_STUB_LATENCY_MS=50 uvicorn nphies_stub:app --port 7000
+"""
+
+import os
+import uuid
+import asyncio
+from datetime import datetime
+from typing import Dict, Any
+
+from fastapi import FastAPI, Request
+
+app = FastAPI(
+    title="NPHIES Stub",
+    description="Offline stand-in for the NPHIES token and message endpoints",
+    version="1.0.0",
+)
+
+# Simulated NPHIES round-trip latency
+STUB_LATENCY_MS = float(os.environ.get("NPHIES_STUB_LATENCY_MS", "50"))
+STUB_TOKEN_TTL = int(os.environ.get("NPHIES_STUB_TOKEN_TTL", "3600"))
+
+# Counters so benchmarks can report how many upstream calls were made
+stats = {"token_requests": 0, "messages": 0, "polls": 0}
+
+# Claim responses waiting to be collected by a poll-request
+queued_messages = []
+
+# Response resource type and outcome for each request message event
+RESPONSE_EVENTS = {
+    "claim": ("ClaimResponse", "complete"),
+    "claim-status": ("ClaimResponse", "complete"),
+    "coverage-eligibility": ("CoverageEligibilityResponse", "complete"),
+}
+
+def _response_resource(request_resource: Dict[str, Any], event_code: str) -> Dict[str, Any]:
+    """Build a canned response resource for one request resource"""
+    resource_type, outcome = RESPONSE_EVENTS.get(event_code, ("OperationOutcome", "complete"))
+    resource = {
+        "resourceType": resource_type,
+        "id": str(uuid.uuid4()),
+        "status": "active",
+        "outcome": outcome,
+        "created": datetime.utcnow().isoformat() + "Z",
+        "request": {"reference": f"{request_resource.get('resourceType')}/{request_resource.get('id')}"},
+    }
+    if resource_type == "ClaimResponse":
+        total = sum(item.get("net", {}).get("value", 0) for item in request_resource.get("item", []))
+        resource["payment"] = {
+            "amount": {"value": total, "currency": "SAR"},
+            "date": datetime.utcnow().date().isoformat(),
+        }
+    elif resource_type == "CoverageEligibilityResponse":
+        resource["insurance"] = [{
+            "inforce": True,
+            "coverage": {"period": {"start": f"{datetime.utcnow().year}-01-01", "end": f"{datetime.utcnow().year}-12-31"}},
+            "item": [],
+        }]
+    return resource
+
+@app.post("/oauth2/token")
+async def issue_token():
+    """Issue a client-credentials access token"""
+    stats["token_requests"] += 1
+    await asyncio.sleep(STUB_LATENCY_MS / 1000)
+    return {
+        "access_token": uuid.uuid4().hex,
+        "token_type": "Bearer",
+        "expires_in": STUB_TOKEN_TTL,
+    }
+
+def _respond(bundle: Dict[str, Any]) -> Dict[str, Any]:
+    """Answer a message bundle with one response entry per payload resource"""
+    entries = bundle.get("entry", [])
+    header = entries[0].get("resource", {}) if entries else {}
+    event_code = header.get("eventCoding", {}).get("code", "")
+
+    response_entries = [{
+        "fullUrl": f"urn:uuid:{uuid.uuid4()}",
+        "resource": {
+            "resourceType": "MessageHeader",
+            "id": str(uuid.uuid4()),
+            "eventCoding": {
+                "system": "https://nphies.sa/terminology/message-events",
+                "code": event_code.replace("-request", "") + "-response",
+            },
+            # NPHIES identifies the request by its MessageHeader id
+            "response": {"identifier": header.get("id"), "code": "ok"},
+        },
+    }]
+    if event_code == "poll-request":
+        stats["polls"] += 1
+        count = 100
+        for task_input in entries[1].get("resource", {}).get("input", []) if len(entries) > 1 else []:
+            count = task_input.get("valuePositiveInt", count)
+        for message in queued_messages[:count]:
+            response_entries.append({"fullUrl": f"urn:uuid:{message['id']}", "resource": message})
+        del queued_messages[:count]
+        entries = []
+
+    for entry in entries[1:]:
+        resource = entry.get("resource", {})
+        if event_code == "batch-request":
+            # Each batch entry is a complete message bundle of its own
+            resource = _respond(resource)
+        else:
+            resource = _response_resource(resource, event_code)
+        response_entries.append({"fullUrl": f"urn:uuid:{resource['id']}", "resource": resource})
+
+    response = {
+        "resourceType": "Bundle",
+        "id": str(uuid.uuid4()),
+        "type": "message",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "entry": response_entries,
+    }
+    if event_code == "claim":
+        queued_messages.append(response)
+    return response
+
+@app.post("/$process-message")
+async def process_message(request: Request):
+    """Answer a message or batch-request bundle"""
+    stats["messages"] += 1
+    bundle = await request.json()
+    await asyncio.sleep(STUB_LATENCY_MS / 1000)
+    return _respond(bundle)
+
+@app.get("/stats")
+async def get_stats():
+    """Return upstream call counters"""
+    return stats
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("nphies_stub:app", host="127.0.0.1", port=int(os.environ.get("PORT", 7000)))
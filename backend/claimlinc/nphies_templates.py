@@ -0,0 +1,130 @@
+"""
+NPHIES Bundle Templates for ClaimLinc
+Static sections of NPHIES message bundles and claims, built once at import time.
+Per-message builders reference these sections instead of rebuilding them, so
+they are shared between bundles and must be treated as read-only.
+"""
+
+import json
+import uuid
+from datetime import datetime
+from typing import Dict, Any, List
+
+MESSAGE_EVENT_SYSTEM = "https://nphies.sa/terminology/message-events"
+
+MESSAGE_SOURCE = {
+    "name": "BrainSAIT Healthcare",
+    "software": "ClaimLinc",
+    "version": "2.0.0",
+    "endpoint": "https://api.brainsait.com"
+}
+
+# One eventCoding per message type, created on first use
+_EVENT_CODINGS: Dict[str, Dict[str, str]] = {}
+
+CLAIM_TYPE_PROFESSIONAL = {
+    "coding": [
+        {
+            "system": "http://terminology.hl7.org/CodeSystem/claim-type",
+            "code": "professional",
+            "display": "Professional"
+        }
+    ]
+}
+
+CLAIM_PRIORITY_NORMAL = {
+    "coding": [
+        {
+            "system": "http://terminology.hl7.org/CodeSystem/processpriority",
+            "code": "normal"
+        }
+    ]
+}
+
+ICD10_SYSTEM = "http://hl7.org/fhir/sid/icd-10"
+CPT_SYSTEM = "http://www.ama-assn.org/go/cpt"
+
+def event_coding(message_type: str) -> Dict[str, str]:
+    coding = _EVENT_CODINGS.get(message_type)
+    if coding is None:
+        coding = _EVENT_CODINGS[message_type] = {"system": MESSAGE_EVENT_SYSTEM, "code": message_type}
+    return coding
+
+def destination(endpoint: str) -> List[Dict[str, str]]:
+    """Build the MessageHeader destination section for an NPHIES endpoint"""
+    return [{"name": "NPHIES", "endpoint": endpoint}]
+
+def utc_timestamp() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+def new_id() -> str:
+    return str(uuid.uuid4())
+
+def message_bundle(message_type: str, destination_section: List[Dict[str, str]],
+                   resources: List[Dict[str, Any]], timestamp: str) -> Dict[str, Any]:
+    """
+    Assemble a message bundle from the shared header sections
+
+    The header id doubles as its fullUrl, so a bundle needs two new UUIDs
+    rather than three.
+    """
+    header_id = new_id()
+    entries = [None] * (len(resources) + 1)
+    entries[0] = {
+        "fullUrl": f"urn:uuid:{header_id}",
+        "resource": {
+            "resourceType": "MessageHeader",
+            "id": header_id,
+            "eventCoding": event_coding(message_type),
+            "source": MESSAGE_SOURCE,
+            "destination": destination_section
+        }
+    }
+    for index, resource in enumerate(resources, 1):
+        entries[index] = {
+            "fullUrl": f"urn:uuid:{resource.get('id') or new_id()}",
+            "resource": resource
+        }
+    return {
+        "resourceType": "Bundle",
+        "id": new_id(),
+        "type": "message",
+        "timestamp": timestamp,
+        "entry": entries
+    }
+
+def claim_diagnosis(sequence: int, diagnosis: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "sequence": sequence,
+        "diagnosisCodeableConcept": {
+            "coding": [
+                {
+                    "system": ICD10_SYSTEM,
+                    "code": diagnosis.get("code", "R69"),
+                    "display": diagnosis.get("description", "Illness, unspecified")
+                }
+            ]
+        }
+    }
+
+def claim_item(sequence: int, procedure: Dict[str, Any], encounter_section: List[Dict[str, str]]) -> Dict[str, Any]:
+    cost = procedure.get("cost", 0)
+    return {
+        "sequence": sequence,
+        "productOrService": {
+            "coding": [
+                {
+                    "system": CPT_SYSTEM,
+                    "code": procedure.get("code", "99213"),
+                    "display": procedure.get("description", "Office visit")
+                }
+            ]
+        },
+        "unitPrice": {"value": cost, "currency": "SAR"},
+        "net": {"value": cost, "currency": "SAR"},
+        "encounter": encounter_section
+    }
+
+def encode_bundle(bundle: Dict[str, Any]) -> bytes:
+    """Serialise a bundle compactly, once, for sending"""
+    return json.dumps(bundle, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
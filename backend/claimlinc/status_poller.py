@@ -0,0 +1,381 @@
+"""
+Claim Status Poller for ClaimLinc
+Tracks outstanding NPHIES claims, collects their responses with batched poll
+requests and pushes status changes to ClaimTrackerLinc. A poll dequeues every
+response waiting for the provider, so responses for claims this process is
+not tracking are forwarded to ClaimTrackerLinc too.
+
+Outstanding claims are journalled to a local file so they survive a restart,
+and a claim that gets no final response within a maximum age or number of
+checks is marked timed out instead of being polled forever.
+"""
+
+import os
+import json
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional, List
+
+import httpx
+
+from nphies_integration import NPHIESIntegration
+
+logger = logging.getLogger("claimlinc.status_poller")
+
+# ClaimResponse outcomes that end tracking of a claim
+FINAL_OUTCOMES = {"complete", "error", "partial"}
+
+# Status given to claims that never received a final response
+TIMEOUT_STATUS = "timeout"
+
+# ClaimResponse outcome to ClaimTrackerLinc claim status
+TRACKER_STATUS = {
+    "queued": "submitted",
+    "complete": "adjudicated",
+    "partial": "partially_adjudicated",
+    "error": "rejected",
+    TIMEOUT_STATUS: "no_response",
+}
+
+class OutstandingClaim:
+    """A submitted claim whose final NPHIES response has not arrived yet"""
+
+    def __init__(self, claim_id: str, payer_id: str, nphies_claim_id: Optional[str] = None,
+                 submitted_at: Optional[datetime] = None):
+        self.claim_id = claim_id
+        self.payer_id = payer_id
+        self.nphies_claim_id = nphies_claim_id
+        self.submitted_at = submitted_at or datetime.now()
+        self.next_check = self.submitted_at
+        self.checks = 0
+        self.status = "queued"
+        self.details: Dict[str, Any] = {}
+
+    def age(self, now: datetime) -> float:
+        return (now - self.submitted_at).total_seconds()
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "claim_id": self.claim_id,
+            "payer_id": self.payer_id,
+            "nphies_claim_id": self.nphies_claim_id,
+            "submitted_at": self.submitted_at.isoformat()
+        }
+
+class ClaimStatusPoller:
+    """Background poller for outstanding NPHIES claim responses"""
+
+    def __init__(self, nphies_client: NPHIESIntegration,
+                 tracker_url: Optional[str] = None,
+                 tracker_token: Optional[str] = None,
+                 journal_path: Optional[str] = None):
+        """
+        Initialize the claim status poller
+
+        Args:
+            nphies_client: Client used for poll requests
+            tracker_url: ClaimTrackerLinc base URL (defaults to environment variable)
+            tracker_token: Service token for ClaimTrackerLinc (defaults to environment variable)
+            journal_path: File outstanding claims are journalled to (defaults to environment variable)
+        """
+        self.nphies_client = nphies_client
+        self.tracker_url = tracker_url or os.environ.get("CLAIMTRACKERLINC_URL", "http://claimtrackerlinc:3008")
+        self.tracker_token = tracker_token or os.environ.get("CLAIMTRACKERLINC_TOKEN", "")
+
+        # Polling intervals in seconds
+        self.tick = float(os.environ.get("STATUS_POLL_TICK", "5"))
+        self.min_interval = float(os.environ.get("STATUS_POLL_MIN_INTERVAL", "30"))
+        self.max_interval = float(os.environ.get("STATUS_POLL_MAX_INTERVAL", "3600"))
+        self.age_factor = float(os.environ.get("STATUS_POLL_AGE_FACTOR", "0.25"))
+        self.poll_count = int(os.environ.get("STATUS_POLL_COUNT", "100"))
+        # Claims with no final response after this many seconds or checks are timed out
+        self.max_age = float(os.environ.get("STATUS_POLL_MAX_AGE", "604800"))
+        self.max_checks = int(os.environ.get("STATUS_POLL_MAX_CHECKS", "500"))
+
+        # Append-only record of tracked and resolved claims, compacted on load
+        self.journal_path = journal_path or os.environ.get("STATUS_POLL_JOURNAL_PATH", "logs/outstanding_claims.jsonl")
+        self._journal_lines = 0
+        self._resolved_since_journal: List[OutstandingClaim] = []
+        # Keeps appends from landing in a journal that a compaction is replacing
+        self._journal_lock = threading.Lock()
+
+        self.outstanding: Dict[str, OutstandingClaim] = {}
+        # Last known status of recently finished claims, served to /status callers
+        self.resolved: Dict[str, Dict[str, Any]] = {}
+        self.max_resolved = int(os.environ.get("STATUS_POLL_RESOLVED_CACHE", "10000"))
+        # Exponentially weighted average turnaround per payer, in seconds
+        self.payer_turnaround: Dict[str, float] = {}
+
+        self.stats = {"polls": 0, "messages": 0, "status_changes": 0, "untracked_responses": 0, "timeouts": 0,
+                      "tracker_errors": 0}
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def track(self, claim_id: str, payer_id: str, nphies_claim_id: Optional[str] = None) -> None:
+        """Start tracking a submitted claim until its final response arrives"""
+        claim = OutstandingClaim(claim_id, payer_id, nphies_claim_id)
+        self.outstanding[claim_id] = claim
+        self.resolved.pop(claim_id, None)
+        try:
+            self._append_journal([claim.to_record()])
+        except OSError as e:
+            logger.error(f"Error journalling claim {claim_id}: {str(e)}")
+
+    async def load(self) -> int:
+        """
+        Reload the claims still outstanding from the journal, then compact it
+
+        Returns:
+            int: Number of outstanding claims restored
+        """
+        records = await asyncio.to_thread(self._read_journal)
+        pending: Dict[str, Dict[str, Any]] = {}
+        for record in records:
+            if record.get("resolved"):
+                # Only the submission it resolved; the claim may have been submitted again since
+                if pending.get(record.get("claim_id"), {}).get("submitted_at") == record.get("submitted_at"):
+                    del pending[record["claim_id"]]
+            elif record.get("claim_id"):
+                pending[record["claim_id"]] = record
+
+        for claim_id, record in pending.items():
+            if claim_id in self.outstanding:
+                continue
+            try:
+                submitted_at = datetime.fromisoformat(record["submitted_at"])
+            except (KeyError, TypeError, ValueError):
+                submitted_at = None
+            self.outstanding[claim_id] = OutstandingClaim(
+                claim_id, record.get("payer_id"), record.get("nphies_claim_id"), submitted_at
+            )
+        await asyncio.to_thread(self._compact_journal)
+        logger.info(f"Restored {len(pending)} outstanding claims from {self.journal_path}")
+        return len(pending)
+
+    def get_status(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        """Return the last known status for a claim, if the poller knows it"""
+        if claim_id in self.resolved:
+            return self.resolved[claim_id]
+        claim = self.outstanding.get(claim_id)
+        if claim is None:
+            return None
+        return {"status": claim.status, "details": claim.details, "final": False}
+
+    def _next_interval(self, claim: OutstandingClaim, now: datetime) -> float:
+        """
+        Time until the claim should next be checked
+
+        Young claims are checked often and old ones progressively less. When a
+        payer's typical turnaround is known, checks before that point are spaced
+        out, since a response is unlikely to be ready yet.
+        """
+        age = claim.age(now)
+        interval = age * self.age_factor
+        expected = self.payer_turnaround.get(claim.payer_id)
+        if expected is not None and age < expected:
+            interval = max(interval, (expected - age) / 2)
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def _record_turnaround(self, claim: OutstandingClaim, now: datetime) -> None:
+        age = claim.age(now)
+        previous = self.payer_turnaround.get(claim.payer_id)
+        self.payer_turnaround[claim.payer_id] = age if previous is None else 0.8 * previous + 0.2 * age
+
+    def start(self) -> None:
+        """Start the background polling loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop polling and release the ClaimTrackerLinc connection pool"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error polling claim statuses: {str(e)}")
+            await asyncio.sleep(self.tick)
+
+    async def poll_once(self) -> int:
+        """
+        Run one poll if any outstanding claim is due
+
+        Returns:
+            int: Number of claims whose status changed
+        """
+        now = datetime.now()
+        due = [claim for claim in self.outstanding.values() if claim.next_check <= now]
+
+        # Give up on claims that have waited too long for a final response
+        changes = []
+        for claim in [claim for claim in due if claim.age(now) >= self.max_age or claim.checks >= self.max_checks]:
+            claim.status = TIMEOUT_STATUS
+            claim.details = {"status": TIMEOUT_STATUS, "message": f"No final response after {claim.checks} checks"}
+            self.stats["timeouts"] += 1
+            changes.append((claim.claim_id, claim.status))
+            self._resolve(claim)
+        due = [claim for claim in due if claim.claim_id in self.outstanding]
+        if not due:
+            await self._finish_poll(changes)
+            return len(changes)
+
+        self.stats["polls"] += 1
+        result = await self.nphies_client.poll_messages("claim-response", self.poll_count)
+        messages = result.get("messages", [])
+        self.stats["messages"] += len(messages)
+
+        now = datetime.now()
+        for message in messages:
+            for claim_id, status_info in self._claim_statuses(message):
+                claim = self.outstanding.get(claim_id)
+                if claim is None:
+                    # The poll dequeues responses for the whole provider, including
+                    # claims tracked by another worker or before a restart; forward
+                    # them rather than lose the adjudication
+                    self.stats["untracked_responses"] += 1
+                    if status_info["status"] in FINAL_OUTCOMES:
+                        self._remember(claim_id, status_info["status"], status_info)
+                    changes.append((claim_id, status_info["status"]))
+                    continue
+                if status_info["status"] != claim.status:
+                    claim.status = status_info["status"]
+                    claim.details = status_info
+                    changes.append((claim.claim_id, claim.status))
+                if claim.status in FINAL_OUTCOMES:
+                    self._record_turnaround(claim, now)
+                    self._resolve(claim)
+
+        # Schedule the next check for every due claim that is still outstanding
+        for claim in due:
+            if claim.claim_id in self.outstanding:
+                claim.checks += 1
+                claim.next_check = datetime.fromtimestamp(now.timestamp() + self._next_interval(claim, now))
+
+        await self._finish_poll(changes)
+        return len(changes)
+
+    async def _finish_poll(self, changes: List[Any]) -> None:
+        """Journal the claims resolved by a poll and push its status changes"""
+        if self._resolved_since_journal:
+            records = [
+                {"claim_id": claim.claim_id, "resolved": claim.status, "submitted_at": claim.submitted_at.isoformat()}
+                for claim in self._resolved_since_journal
+            ]
+            self._resolved_since_journal = []
+            try:
+                await asyncio.to_thread(self._append_journal, records)
+                # Rewrite the journal once resolved claims make up most of it
+                if self._journal_lines > 2 * len(self.outstanding) + 1000:
+                    await asyncio.to_thread(self._compact_journal)
+            except OSError as e:
+                logger.error(f"Error journalling resolved claims: {str(e)}")
+
+        if changes:
+            self.stats["status_changes"] += len(changes)
+            await asyncio.gather(*(self._push_to_tracker(claim_id, status) for claim_id, status in changes))
+
+    def _resolve(self, claim: OutstandingClaim) -> None:
+        del self.outstanding[claim.claim_id]
+        self._resolved_since_journal.append(claim)
+        self._remember(claim.claim_id, claim.status, claim.details)
+
+    def _remember(self, claim_id: str, status: str, details: Dict[str, Any]) -> None:
+        self.resolved[claim_id] = {"status": status, "details": details, "final": True}
+        if len(self.resolved) > self.max_resolved:
+            # Dicts keep insertion order, so this drops the oldest entry
+            self.resolved.pop(next(iter(self.resolved)))
+
+    def _append_journal(self, records: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._journal_lock:
+            with open(self.journal_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            self._journal_lines += len(records)
+
+    def _read_journal(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.journal_path):
+            return []
+        records = []
+        with open(self.journal_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping corrupt outstanding claim journal line")
+        return records
+
+    def _compact_journal(self) -> None:
+        """Rewrite the journal with only the claims still outstanding"""
+        directory = os.path.dirname(self.journal_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.journal_path}.tmp"
+        with self._journal_lock:
+            records = [claim.to_record() for claim in list(self.outstanding.values())]
+            with open(temp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(temp_path, self.journal_path)
+            self._journal_lines = len(records)
+
+    def _claim_statuses(self, message: Dict[str, Any]) -> List[Any]:
+        """Extract (claim_id, status info) pairs from a queued response bundle"""
+        statuses = []
+        for entry in message.get("entry", []):
+            resource = entry.get("resource", {})
+            if resource.get("resourceType") != "ClaimResponse":
+                continue
+            reference = resource.get("request", {}).get("reference", "")
+            claim_id = reference.rsplit("/", 1)[-1] if reference else None
+            if not claim_id:
+                continue
+            status_info = self.nphies_client._extract_claim_status({"entry": [entry]})
+            statuses.append((claim_id, status_info))
+        return statuses
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=10)
+        return self._client
+
+    async def _push_to_tracker(self, claim_id: str, status: str) -> None:
+        """Send a claim status change to ClaimTrackerLinc"""
+        try:
+            headers = {"Authorization": f"Bearer {self.tracker_token}"} if self.tracker_token else {}
+            response = await self._get_client().post(
+                f"{self.tracker_url}/claims/{claim_id}/status",
+                json={
+                    "claim_id": claim_id,
+                    "status": TRACKER_STATUS.get(status, status),
+                    "notes": f"NPHIES outcome: {status}",
+                    "updated_by": "claimlinc-status-poller"
+                },
+                headers=headers
+            )
+            if response.status_code != 200:
+                self.stats["tracker_errors"] += 1
+                logger.warning(f"ClaimTrackerLinc rejected status for {claim_id}: {response.status_code}")
+        except Exception as e:
+            self.stats["tracker_errors"] += 1
+            logger.error(f"Error pushing status for {claim_id}: {str(e)}")
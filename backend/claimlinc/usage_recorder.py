@@ -0,0 +1,170 @@
+"""
+Usage Recorder for ClaimLinc
+Buffers billing usage events in memory and sends them to the billing service in
+aggregated batches, by size or on an interval. Batches that cannot be delivered
+are appended to a local spool file and replayed on the next successful flush,
+so billing latency and outages never reach the request path.
+"""
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple
+
+import httpx
+
+logger = logging.getLogger("claimlinc.usage")
+
+class UsageRecorder:
+    """Aggregating, spooling client for the billing usage API"""
+
+    def __init__(self, billing_url: Optional[str] = None, spool_path: Optional[str] = None):
+        """
+        Initialize the usage recorder
+
+        Args:
+            billing_url: Billing usage endpoint (defaults to environment variable)
+            spool_path: File for undelivered usage (defaults to environment variable)
+        """
+        self.billing_url = billing_url or os.environ.get("BILLING_SERVICE_URL", "http://billing-service:8080/api/usage")
+        self.spool_path = spool_path or os.environ.get("USAGE_SPOOL_PATH", "logs/usage_spool.jsonl")
+        # Without a billing service, flushed usage is only logged
+        self.billing_enabled = os.environ.get("BILLING_ENABLED", "false").lower() == "true"
+        self.flush_size = int(os.environ.get("USAGE_FLUSH_SIZE", "500"))
+        self.flush_interval = float(os.environ.get("USAGE_FLUSH_INTERVAL", "10"))
+
+        # (user_id, operation) -> aggregated usage record
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._pending_events = 0
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = {"events": 0, "flushes": 0, "records_sent": 0, "records_spooled": 0}
+
+    def record(self, user_id: str, operation_type: str, count: int = 1) -> None:
+        """Add a usage event to the current batch without waiting on billing"""
+        timestamp = datetime.utcnow().isoformat()
+        key = (user_id, operation_type)
+        record = self._pending.get(key)
+        if record is None:
+            self._pending[key] = {
+                "user_id": user_id,
+                "service": "claimlinc",
+                "operation": operation_type,
+                "count": count,
+                "events": 1,
+                "first_timestamp": timestamp,
+                "timestamp": timestamp
+            }
+        else:
+            record["count"] += count
+            record["events"] += 1
+            record["timestamp"] = timestamp
+        self._pending_events += 1
+        self.stats["events"] += 1
+
+        if self._pending_events >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+            except RuntimeError:
+                # No running loop; the periodic flush will pick the batch up
+                pass
+
+    def start(self) -> None:
+        """Start the periodic flush loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush loop and flush what is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing usage: {str(e)}")
+
+    def _get_flush_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def flush(self) -> None:
+        """Send buffered usage, plus anything spooled earlier, to the billing service"""
+        async with self._get_flush_lock():
+            records = list(self._pending.values())
+            self._pending = {}
+            self._pending_events = 0
+
+            if not self.billing_enabled:
+                if records:
+                    self.stats["flushes"] += 1
+                for record in records:
+                    logger.info(f"Usage recorded: {json.dumps(record)}")
+                return
+
+            spooled = await asyncio.to_thread(self._read_spool)
+            if not records and not spooled:
+                return
+            self.stats["flushes"] += 1
+
+            # The spool is only cleared once its records have been delivered
+            if await self._send(spooled + records):
+                self.stats["records_sent"] += len(spooled) + len(records)
+                if spooled:
+                    await asyncio.to_thread(os.remove, self.spool_path)
+            elif records:
+                await asyncio.to_thread(self._append_spool, records)
+                self.stats["records_spooled"] += len(records)
+
+    async def _send(self, records: List[Dict[str, Any]]) -> bool:
+        try:
+            if self._client is None or self._client.is_closed:
+                self._client = httpx.AsyncClient(timeout=10)
+            response = await self._client.post(self.billing_url, json={"service": "claimlinc", "usage": records})
+            if response.status_code not in [200, 201, 202]:
+                logger.error(f"Failed to record usage: {response.status_code} {response.text}")
+                return False
+            return True
+        except Exception as e:
+            logger.error(f"Error recording usage: {str(e)}")
+            return False
+
+    def _append_spool(self, records: List[Dict[str, Any]]) -> None:
+        directory = os.path.dirname(self.spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.spool_path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def _read_spool(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.spool_path):
+            return []
+        records = []
+        with open(self.spool_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping corrupt usage spool line")
+        return records
@@ -0,0 +1,137 @@
+"""
+Duplicate detection benchmark for ClaimTrackerLinc
+Builds the duplicate index over synthetic claims with injected duplicates and
+reports check latency plus precision and recall against an exhaustive scan.
+
+Usage:
+    python bench_duplicates.py --claims 200000 --queries 2000
+"""
+
+import argparse
+import hashlib
+import random
+import time
+from datetime import date, timedelta
+
+from duplicate_index import DuplicateIndex, procedure_codes, jaccard, service_day
+
+CODES = [f"{99000 + i}" for i in range(400)]
+DIAGNOSES = [f"E{10 + i}.{j}" for i in range(20) for j in range(10)]
+START_DATE = date(2025, 1, 1)
+
+def hash_signature(claim: dict) -> str:
+    """Same signature ClaimTrackerLinc computes when tracking a claim"""
+    hash_input = f"{claim['patient_id']}|{claim['date_of_service']}|{claim['total_charge']}"
+    for proc in claim["procedures"]:
+        hash_input += f"|{proc.get('code')}"
+    for diag in claim["diagnoses"]:
+        hash_input += f"|{diag.get('code')}"
+    return hashlib.md5(hash_input.encode()).hexdigest()
+
+def random_claim(rng: random.Random, index: int, patients: int) -> dict:
+    # Skewed code choice, so common procedure mixes repeat as they do in practice
+    codes = {CODES[min(int(rng.expovariate(1 / 40)), len(CODES) - 1)] for _ in range(rng.randint(1, 6))}
+    return {
+        "claim_id": f"CLM-{index:08d}",
+        "patient_id": f"PAT-{rng.randrange(patients):07d}",
+        "date_of_service": (START_DATE + timedelta(days=rng.randrange(365))).isoformat() + "T00:00:00Z",
+        "total_charge": float(rng.randint(50, 2000)),
+        "procedures": [{"code": code} for code in sorted(codes)],
+        "diagnoses": [{"code": rng.choice(DIAGNOSES)}],
+    }
+
+def variant(rng: random.Random, claim: dict, index: int, kind: str, window: int) -> dict:
+    """Derive an exact, same-day or date-window duplicate of a claim"""
+    copy = dict(claim, claim_id=f"CLM-{index:08d}", procedures=list(claim["procedures"]))
+    if kind in ("same_day", "window") and rng.random() < 0.5:
+        copy["procedures"].append({"code": rng.choice(CODES)})
+    if kind == "window":
+        day = date.fromisoformat(claim["date_of_service"][:10]) + timedelta(days=rng.randint(1, window))
+        copy["date_of_service"] = day.isoformat() + "T00:00:00Z"
+    return copy
+
+def build(count: int, patients: int, duplicate_rate: float, window: int, seed: int) -> list:
+    rng = random.Random(seed)
+    claims = []
+    for index in range(count):
+        if claims and rng.random() < duplicate_rate:
+            kind = rng.choice(["exact", "same_day", "window"])
+            claim = variant(rng, rng.choice(claims), index, kind, window)
+        else:
+            claim = random_claim(rng, index, patients)
+        claim["hash_signature"] = hash_signature(claim)
+        claims.append(claim)
+    return claims
+
+def exhaustive_matches(index: DuplicateIndex, claims_by_patient: dict, claim: dict) -> set:
+    """Every tracked claim the duplicate rules match, found by scanning"""
+    codes = procedure_codes(claim["procedures"])
+    day = service_day(claim["date_of_service"])
+    matches = set()
+    for other in claims_by_patient.get(claim["patient_id"], []):
+        if other["claim_id"] == claim["claim_id"]:
+            continue
+        if other["hash_signature"] == claim["hash_signature"]:
+            matches.add(other["claim_id"])
+        elif (abs(service_day(other["date_of_service"]) - day) <= index.date_window_days
+              and jaccard(codes, procedure_codes(other["procedures"])) > index.similarity_threshold):
+            matches.add(other["claim_id"])
+    return matches
+
+def run(count: int, queries: int, patients: int, duplicate_rate: float, window: int, seed: int) -> None:
+    claims = build(count + queries, patients, duplicate_rate, window, seed)
+    history, probes = claims[:count], claims[count:]
+
+    index = DuplicateIndex(date_window_days=window)
+    start = time.perf_counter()
+    for claim in history:
+        index.add(claim["claim_id"], claim["patient_id"], claim["date_of_service"],
+                  claim["hash_signature"], claim["procedures"])
+    build_seconds = time.perf_counter() - start
+
+    claims_by_patient = {}
+    for claim in history:
+        claims_by_patient.setdefault(claim["patient_id"], []).append(claim)
+
+    true_positives = returned = expected = 0
+    # Matches on other days can only come from the LSH index
+    window_found = window_expected = 0
+    elapsed = 0.0
+    for claim in probes:
+        start = time.perf_counter()
+        result = index.check(claim["claim_id"], claim["patient_id"], claim["date_of_service"],
+                             claim["hash_signature"], claim["procedures"])
+        elapsed += time.perf_counter() - start
+        found = {match["claim_id"] for match in result["duplicate_claims"]}
+        truth = exhaustive_matches(index, claims_by_patient, claim)
+        true_positives += len(found & truth)
+        returned += len(found)
+        expected += len(truth)
+        window_truth = {
+            other_id for other_id in truth
+            if index.claims[other_id].day != service_day(claim["date_of_service"])
+        }
+        window_expected += len(window_truth)
+        window_found += len(found & window_truth)
+
+    print(f"tracked claims:     {count:,} ({patients:,} patients)")
+    print(f"queries:            {queries:,} (duplicate rate {duplicate_rate:.0%}, window {window} days)")
+    print(f"LSH:                {index.bands} bands x {index.rows} rows, threshold {index.similarity_threshold}")
+    print(f"index build:        {build_seconds:.1f} s")
+    print(f"check latency:      {elapsed / queries * 1e6:.0f} us/claim")
+    print(f"expected matches:   {expected:,}")
+    print(f"precision:          {true_positives / returned if returned else 1.0:.4f}")
+    print(f"recall:             {true_positives / expected if expected else 1.0:.4f}")
+    print(f"LSH window recall:  {window_found / window_expected if window_expected else 1.0:.4f}"
+          f" ({window_expected:,} date-window matches)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ClaimTrackerLinc duplicate detection")
+    parser.add_argument("--claims", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--patients", type=int, default=50000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    parser.add_argument("--window", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.claims, args.queries, args.patients, args.duplicate_rate, args.window, args.seed)
@@ -0,0 +1,61 @@
+"""
+Change feed for ClaimTrackerLinc
+Wakes long-poll and server-sent-event consumers of the claim event log when
+the store commits new events, so consumers wait on a notification instead of
+re-querying the log on a timer.
+"""
+
+import asyncio
+from typing import Optional
+
+class ChangeFeed:
+    """Tracks the latest committed event offset and wakes waiters when it moves"""
+
+    def __init__(self, head: int = 0):
+        self.head = head
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    def _get_changed(self) -> asyncio.Event:
+        if self._changed is None:
+            self._loop = asyncio.get_running_loop()
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def notify(self, head: int) -> None:
+        """Record a new head offset; safe to call from any thread"""
+        self.head = max(self.head, head)
+        if self._loop is None or self._loop.is_closed():
+            return
+        if self._is_loop_thread():
+            self._wake()
+        else:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _is_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _wake(self) -> None:
+        # Waiters hold the old event; swap in a fresh one for the next change
+        changed, self._changed = self._changed, asyncio.Event()
+        if changed is not None:
+            changed.set()
+
+    async def wait(self, after: int, timeout: float) -> bool:
+        """
+        Wait until an event newer than ``after`` is committed
+
+        Returns:
+            bool: True if the head moved past ``after`` before the timeout
+        """
+        changed = self._get_changed()
+        if self.head > after:
+            return True
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.head > after
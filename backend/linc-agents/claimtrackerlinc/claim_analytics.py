@@ -0,0 +1,112 @@
+"""
+Claim analytics for ClaimTrackerLinc
+In-memory duplicate and status aggregates per day of service and provider,
+kept in Fenwick trees so a date-range total sums a handful of precomputed
+buckets regardless of how many days or claims the range covers.
+"""
+
+from datetime import date
+from typing import Dict, List, Any, Optional
+
+# Day ordinals (days since 0001-01-01) fit below 2**20 until the year 2870
+TREE_SIZE = 1 << 20
+
+# Per-bucket duplicate metrics, in this order
+METRICS = ("total_claims", "exact_duplicates", "potential_duplicates", "financial_impact", "flagged_charge")
+
+def day_ordinal(day: str) -> int:
+    return date.fromisoformat(day).toordinal()
+
+class FenwickTree:
+    """Sparse Fenwick (binary indexed) tree of fixed-width metric vectors"""
+
+    __slots__ = ("width", "nodes")
+
+    def __init__(self, width: int):
+        self.width = width
+        self.nodes: Dict[int, List[float]] = {}
+
+    def add(self, index: int, deltas: List[float]) -> None:
+        while index < TREE_SIZE:
+            node = self.nodes.get(index)
+            if node is None:
+                self.nodes[index] = list(deltas)
+            else:
+                for i, delta in enumerate(deltas):
+                    node[i] += delta
+            index += index & -index
+
+    def prefix(self, index: int) -> List[float]:
+        """Sum of every bucket at or below ``index``"""
+        totals = [0] * self.width
+        while index > 0:
+            node = self.nodes.get(index)
+            if node is not None:
+                for i, value in enumerate(node):
+                    totals[i] += value
+            index -= index & -index
+        return totals
+
+    def range(self, low: int, high: int) -> List[float]:
+        upper = self.prefix(high)
+        lower = self.prefix(low - 1)
+        return [u - l for u, l in zip(upper, lower)]
+
+class ClaimAnalytics:
+    """Duplicate and status aggregates bucketed by day of service and provider"""
+
+    def __init__(self):
+        self.totals = FenwickTree(len(METRICS))
+        self.providers: Dict[str, FenwickTree] = {}
+        self.provider_names: Dict[str, str] = {}
+        self.statuses: Dict[str, FenwickTree] = {}
+
+    def add(self, day: str, provider_id: str, provider_name: Optional[str], deltas: List[float]) -> None:
+        """Apply duplicate metric deltas (in METRICS order) to a day/provider bucket"""
+        ordinal = day_ordinal(day)
+        self.totals.add(ordinal, deltas)
+        tree = self.providers.get(provider_id)
+        if tree is None:
+            tree = self.providers[provider_id] = FenwickTree(len(METRICS))
+        tree.add(ordinal, deltas)
+        if provider_name:
+            self.provider_names[provider_id] = provider_name
+
+    def add_status(self, day: str, status: str, delta: int) -> None:
+        tree = self.statuses.get(status)
+        if tree is None:
+            tree = self.statuses[status] = FenwickTree(1)
+        tree.add(day_ordinal(day), [delta])
+
+    def summary(self, day_from: Optional[str] = None, day_to: Optional[str] = None) -> Dict[str, Any]:
+        """Duplicate analytics for an inclusive range of days (YYYY-MM-DD)"""
+        low = day_ordinal(day_from) if day_from else 1
+        high = day_ordinal(day_to) if day_to else TREE_SIZE - 1
+        totals = dict(zip(METRICS, self.totals.range(low, high)))
+
+        provider_analysis = []
+        for provider_id, tree in self.providers.items():
+            metrics = dict(zip(METRICS, tree.range(low, high)))
+            duplicate_count = metrics["exact_duplicates"] + metrics["potential_duplicates"]
+            if duplicate_count > 0:
+                provider_analysis.append({
+                    "provider_id": provider_id,
+                    "provider_name": self.provider_names.get(provider_id),
+                    "duplicate_count": duplicate_count,
+                    "total_charge": metrics["flagged_charge"]
+                })
+
+        status_breakdown = {}
+        for status, tree in self.statuses.items():
+            count = tree.range(low, high)[0]
+            if count > 0:
+                status_breakdown[status] = count
+
+        return {
+            "total_claims": totals["total_claims"],
+            "exact_duplicates": totals["exact_duplicates"],
+            "potential_duplicates": totals["potential_duplicates"],
+            "financial_impact": totals["financial_impact"],
+            "provider_analysis": provider_analysis,
+            "status_breakdown": status_breakdown
+        }
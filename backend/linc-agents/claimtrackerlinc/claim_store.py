@@ -0,0 +1,540 @@
+"""
+Claim store for ClaimTrackerLinc
+Embedded SQLite storage (WAL mode) for tracked claims, with indexes on the
+columns the API filters and deduplicates by. The full tracked-claim document is
+kept as JSON alongside the indexed columns.
+"""
+
+import os
+import json
+import base64
+import sqlite3
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Optional, Iterator, Callable
+
+from claim_analytics import ClaimAnalytics
+
+logger = logging.getLogger("claimtrackerlinc.store")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    claim_id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    provider_id TEXT NOT NULL,
+    provider_name TEXT,
+    payer_id TEXT,
+    status TEXT NOT NULL,
+    date_of_service TEXT NOT NULL,
+    total_charge REAL NOT NULL DEFAULT 0,
+    hash_signature TEXT,
+    is_duplicate INTEGER NOT NULL DEFAULT 0,
+    has_potential_duplicates INTEGER NOT NULL DEFAULT 0,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_claims_patient ON claims (patient_id, date_of_service);
+CREATE INDEX IF NOT EXISTS idx_claims_provider ON claims (provider_id, date_of_service);
+CREATE INDEX IF NOT EXISTS idx_claims_status ON claims (status, date_of_service);
+DROP INDEX IF EXISTS idx_claims_date;
+CREATE INDEX IF NOT EXISTS idx_claims_date_id ON claims (date_of_service, claim_id);
+CREATE INDEX IF NOT EXISTS idx_claims_charge_id ON claims (total_charge, claim_id);
+CREATE INDEX IF NOT EXISTS idx_claims_hash ON claims (hash_signature);
+
+-- Duplicate analytics per day of service and provider, maintained on every write
+CREATE TABLE IF NOT EXISTS duplicate_buckets (
+    day TEXT NOT NULL,
+    provider_id TEXT NOT NULL,
+    provider_name TEXT,
+    total_claims INTEGER NOT NULL DEFAULT 0,
+    exact_duplicates INTEGER NOT NULL DEFAULT 0,
+    potential_duplicates INTEGER NOT NULL DEFAULT 0,
+    financial_impact REAL NOT NULL DEFAULT 0,
+    flagged_charge REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, provider_id)
+);
+CREATE TABLE IF NOT EXISTS status_buckets (
+    day TEXT NOT NULL,
+    provider_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, provider_id, status)
+);
+
+-- Append-only change log; offsets only ever increase and are never reused
+CREATE TABLE IF NOT EXISTS claim_events (
+    offset INTEGER PRIMARY KEY AUTOINCREMENT,
+    claim_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_claim_events_claim ON claim_events (claim_id, offset);
+"""
+
+BUCKET_UPSERT = """
+INSERT INTO duplicate_buckets (day, provider_id, provider_name, total_claims, exact_duplicates,
+                               potential_duplicates, financial_impact, flagged_charge)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (day, provider_id) DO UPDATE SET
+    provider_name = COALESCE(excluded.provider_name, provider_name),
+    total_claims = total_claims + excluded.total_claims,
+    exact_duplicates = exact_duplicates + excluded.exact_duplicates,
+    potential_duplicates = potential_duplicates + excluded.potential_duplicates,
+    financial_impact = financial_impact + excluded.financial_impact,
+    flagged_charge = flagged_charge + excluded.flagged_charge
+"""
+
+STATUS_UPSERT = """
+INSERT INTO status_buckets (day, provider_id, status, claims) VALUES (?, ?, ?, ?)
+ON CONFLICT (day, provider_id, status) DO UPDATE SET claims = claims + excluded.claims
+"""
+
+# Columns GET /claims may sort by; claim_id breaks ties so cursors are unique
+SORT_FIELDS = {"date_of_service", "claim_id", "total_charge", "status", "provider_id", "patient_id"}
+
+def encode_cursor(sort: str, sort_value: Any, claim_id: str) -> str:
+    raw = json.dumps([sort, sort_value, claim_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """Return the (sort value, claim_id) a cursor resumes after"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, sort_value, claim_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Malformed cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor was issued for a different sort order")
+    return sort_value, claim_id
+
+def project(tracked_claim: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    Keep only the requested fields of a tracked claim
+
+    Fields are top-level keys ("tracking_events") or dotted paths ("claim.status").
+    """
+    if not fields:
+        return tracked_claim
+    projected: Dict[str, Any] = {}
+    for field in fields:
+        source, target = tracked_claim, projected
+        parts = field.split(".")
+        for part in parts[:-1]:
+            source = source.get(part) if isinstance(source, dict) else None
+            if source is None:
+                break
+            target = target.setdefault(part, {})
+        else:
+            if isinstance(source, dict) and parts[-1] in source:
+                target[parts[-1]] = source[parts[-1]]
+    return projected
+
+def normalize_service_date(value: str) -> str:
+    """
+    Normalise a date of service to a sortable UTC timestamp string
+
+    Stored dates and filter bounds both go through this, so range filters are
+    plain string comparisons on the index.
+    """
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%dT%H:%M:%S")
+
+class ClaimExists(Exception):
+    """A claim with the same claim_id is already tracked"""
+
+    def __init__(self, claim_id: str):
+        super().__init__(f"Claim {claim_id} is already tracked")
+        self.claim_id = claim_id
+
+class ClaimStore:
+    """SQLite-backed store of tracked claims"""
+
+    def __init__(self, path: Optional[str] = None, legacy_json_path: Optional[str] = None):
+        """
+        Open (and create if needed) the claim store
+
+        Args:
+            path: SQLite database file (defaults to environment variable)
+            legacy_json_path: JSON file imported once into an empty store
+        """
+        self.path = path or os.environ.get("CLAIM_STORE_PATH", "data/claims.db")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        # Bucket deltas written in the open transaction, applied to memory on commit
+        self.analytics = ClaimAnalytics()
+        self._pending_buckets: List[tuple] = []
+        # Called with the latest event offset after a commit that appended events
+        self.listeners: List[Callable[[int], None]] = []
+        self._events_written = False
+
+        legacy_json_path = legacy_json_path or os.environ.get("CLAIM_STORE_LEGACY_JSON", "data/tracked_claims.json")
+        if legacy_json_path and os.path.exists(legacy_json_path) and self.count() == 0:
+            self._import_json(legacy_json_path)
+        elif self.conn.execute("SELECT 1 FROM duplicate_buckets LIMIT 1").fetchone() is None and self.count() > 0:
+            self._rebuild_buckets()
+        if self.last_offset() == 0 and self.count() > 0:
+            self._backfill_events()
+        self._load_analytics()
+
+    def _import_json(self, json_path: str) -> None:
+        """Import tracked claims from the file-based store used previously"""
+        with open(json_path, "r") as f:
+            claims_data = json.load(f)
+        # Their embedded tracking events are backfilled into the log afterwards
+        skipped = 0
+        with self.transaction():
+            for tracked_claim in claims_data:
+                try:
+                    self.add(tracked_claim, record_events=False)
+                except ClaimExists:
+                    # The file store appended re-tracked claims; the first record wins
+                    skipped += 1
+        logger.info(f"Imported {len(claims_data) - skipped} tracked claims from {json_path} ({skipped} repeated)")
+
+    def _rebuild_buckets(self) -> None:
+        """Recompute the analytics buckets from the claims table"""
+        with self.transaction():
+            self.conn.execute("DELETE FROM duplicate_buckets")
+            self.conn.execute("DELETE FROM status_buckets")
+            self.conn.execute(
+                """INSERT INTO duplicate_buckets
+                   SELECT substr(date_of_service, 1, 10), provider_id, MAX(provider_name), COUNT(*),
+                          SUM(is_duplicate), SUM(has_potential_duplicates),
+                          SUM(CASE WHEN is_duplicate THEN total_charge ELSE 0 END),
+                          SUM(CASE WHEN is_duplicate OR has_potential_duplicates THEN total_charge ELSE 0 END)
+                   FROM claims GROUP BY 1, 2"""
+            )
+            self.conn.execute(
+                """INSERT INTO status_buckets
+                   SELECT substr(date_of_service, 1, 10), provider_id, status, COUNT(*)
+                   FROM claims GROUP BY 1, 2, 3"""
+            )
+        logger.info("Rebuilt claim analytics buckets")
+
+    def _backfill_events(self) -> None:
+        """Seed the event log from the tracking events embedded in stored claims"""
+        events = []
+        for row in self.conn.execute("SELECT record FROM claims"):
+            tracked_claim = json.loads(row["record"])
+            for event in tracked_claim.get("tracking_events", []):
+                events.append((tracked_claim["claim"]["claim_id"], event))
+        events.sort(key=lambda item: item[1].get("timestamp", ""))
+        with self.transaction():
+            for claim_id, event in events:
+                data = {k: v for k, v in event.items() if k not in ("event_type", "timestamp")}
+                self.append_event(claim_id, event.get("event_type", "unknown"), data, event.get("timestamp"))
+        logger.info(f"Backfilled {len(events)} claim events")
+
+    def _load_analytics(self) -> None:
+        """Load the persisted buckets into the in-memory range trees"""
+        self.analytics = ClaimAnalytics()
+        for row in self.conn.execute("SELECT * FROM duplicate_buckets"):
+            self.analytics.add(row["day"], row["provider_id"], row["provider_name"], [
+                row["total_claims"], row["exact_duplicates"], row["potential_duplicates"],
+                row["financial_impact"], row["flagged_charge"]
+            ])
+        for row in self.conn.execute("SELECT day, status, claims FROM status_buckets WHERE claims != 0"):
+            self.analytics.add_status(row["day"], row["status"], row["claims"])
+
+    def _notify_listeners(self) -> None:
+        if not self._events_written:
+            return
+        self._events_written = False
+        head = self.last_offset()
+        for listener in self.listeners:
+            try:
+                listener(head)
+            except Exception as e:
+                logger.error(f"Error notifying claim event listener: {str(e)}")
+
+    def _commit_buckets(self) -> None:
+        for kind, *args in self._pending_buckets:
+            if kind == "duplicates":
+                self.analytics.add(*args)
+            else:
+                self.analytics.add_status(*args)
+        self._pending_buckets.clear()
+
+    def _apply_buckets(self, row: tuple, sign: int) -> None:
+        """Add (sign=1) or remove (sign=-1) one claim row's contribution to the analytics buckets"""
+        (_, _, provider_id, provider_name, _, claim_status, date_of_service,
+         total_charge, _, is_duplicate, has_potential, _) = row
+        day = date_of_service[:10]
+        flagged = is_duplicate or has_potential
+        deltas = [
+            sign, sign * is_duplicate, sign * has_potential,
+            sign * total_charge if is_duplicate else 0, sign * total_charge if flagged else 0
+        ]
+        self.conn.execute(BUCKET_UPSERT, (day, provider_id, provider_name, *deltas))
+        self.conn.execute(STATUS_UPSERT, (day, provider_id, claim_status, sign))
+        self._pending_buckets.append(("duplicates", day, provider_id, provider_name, deltas))
+        self._pending_buckets.append(("status", day, claim_status, sign))
+
+    def transaction(self) -> "Transaction":
+        return Transaction(self)
+
+    @staticmethod
+    def _row_values(tracked_claim: Dict[str, Any]) -> tuple:
+        claim = tracked_claim["claim"]
+        duplicate_check = tracked_claim.get("duplicate_check_result") or {}
+        is_duplicate = bool(duplicate_check.get("is_duplicate", False))
+        return (
+            claim["claim_id"],
+            claim["patient_id"],
+            claim["provider_id"],
+            claim.get("provider_name"),
+            claim.get("payer_id"),
+            claim.get("status", "draft"),
+            normalize_service_date(claim["date_of_service"]),
+            claim.get("total_charge", 0),
+            claim.get("hash_signature"),
+            int(is_duplicate),
+            int(not is_duplicate and len(duplicate_check.get("duplicate_claims", [])) > 0),
+            json.dumps(tracked_claim),
+        )
+
+    def add(self, tracked_claim: Dict[str, Any], record_events: bool = True) -> None:
+        """
+        Insert a new tracked claim, keeping the analytics buckets in step
+
+        Raises:
+            ClaimExists: The claim_id is already tracked; nothing is written
+        """
+        row = self._row_values(tracked_claim)
+        with self.transaction():
+            try:
+                self.conn.execute("INSERT INTO claims VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            except sqlite3.IntegrityError as e:
+                if "UNIQUE" not in str(e):
+                    raise
+                raise ClaimExists(row[0])
+            self._apply_buckets(row, 1)
+            if record_events:
+                self.append_event(row[0], "created", {
+                    "patient_id": row[1],
+                    "provider_id": row[2],
+                    "status": row[5],
+                    "is_duplicate": bool(row[9]),
+                    "has_potential_duplicates": bool(row[10])
+                })
+
+    def add_many(self, tracked_claims: List[Dict[str, Any]], record_events: bool = True) -> None:
+        """Insert a batch of new tracked claims in a single transaction, all or none"""
+        with self.transaction():
+            for tracked_claim in tracked_claims:
+                self.add(tracked_claim, record_events)
+
+    def existing(self, claim_ids: List[str]) -> set:
+        """The claim_ids among these that are already tracked"""
+        found = set()
+        # Stay under SQLite's bound parameter limit
+        for start in range(0, len(claim_ids), 500):
+            chunk = claim_ids[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT claim_id FROM claims WHERE claim_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def get(self, claim_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT record FROM claims WHERE claim_id = ?", (claim_id,)).fetchone()
+        return json.loads(row["record"]) if row else None
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM claims").fetchone()[0]
+
+    def update_status(self, claim_id: str, new_status: str, event: Dict[str, Any]) -> Optional[str]:
+        """
+        Set a claim's status and append a tracking event
+
+        Returns:
+            The previous status, or None if the claim does not exist
+        """
+        with self.transaction():
+            tracked_claim = self.get(claim_id)
+            if tracked_claim is None:
+                return None
+            old_status = tracked_claim["claim"]["status"]
+            tracked_claim["claim"]["status"] = new_status
+            tracked_claim["tracking_events"].append({**event, "old_status": old_status, "new_status": new_status})
+            self.conn.execute(
+                "UPDATE claims SET status = ?, record = ? WHERE claim_id = ?",
+                (new_status, json.dumps(tracked_claim), claim_id)
+            )
+            row = self.conn.execute(
+                "SELECT substr(date_of_service, 1, 10), provider_id FROM claims WHERE claim_id = ?", (claim_id,)
+            ).fetchone()
+            self.conn.execute(STATUS_UPSERT, (row[0], row[1], old_status, -1))
+            self.conn.execute(STATUS_UPSERT, (row[0], row[1], new_status, 1))
+            self._pending_buckets.append(("status", row[0], old_status, -1))
+            self._pending_buckets.append(("status", row[0], new_status, 1))
+            self.append_event(claim_id, event.get("event_type", "status_update"), {
+                **{k: v for k, v in event.items() if k not in ("event_type", "timestamp")},
+                "old_status": old_status,
+                "new_status": new_status
+            }, event.get("timestamp"))
+            return old_status
+
+    def append_event(self, claim_id: str, event_type: str, data: Dict[str, Any],
+                     timestamp: Optional[str] = None) -> None:
+        """Append to the claim event log; must run inside the transaction making the change"""
+        self.conn.execute(
+            "INSERT INTO claim_events (claim_id, event_type, timestamp, data) VALUES (?, ?, ?, ?)",
+            (claim_id, event_type, timestamp or datetime.now().isoformat(), json.dumps(data))
+        )
+        self._events_written = True
+
+    def last_offset(self) -> int:
+        row = self.conn.execute("SELECT MAX(offset) FROM claim_events").fetchone()
+        return row[0] or 0
+
+    def events_after(self, offset: int, limit: int = 500, claim_id: Optional[str] = None,
+                     event_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Events with an offset greater than ``offset``, oldest first"""
+        clauses, params = ["offset > ?"], [offset]
+        if claim_id:
+            clauses.append("claim_id = ?")
+            params.append(claim_id)
+        if event_type:
+            clauses.append("event_type = ?")
+            params.append(event_type)
+        rows = self.conn.execute(
+            f"SELECT * FROM claim_events WHERE {' AND '.join(clauses)} ORDER BY offset LIMIT ?",
+            params + [limit]
+        )
+        return [
+            {
+                "offset": row["offset"],
+                "claim_id": row["claim_id"],
+                "event_type": row["event_type"],
+                "timestamp": row["timestamp"],
+                "data": json.loads(row["data"])
+            }
+            for row in rows
+        ]
+
+    def _where(self, patient_id: Optional[str] = None, provider_id: Optional[str] = None,
+               status: Optional[str] = None, date_from: Optional[str] = None,
+               date_to: Optional[str] = None, has_duplicate: Optional[bool] = None):
+        clauses, params = [], []
+        if patient_id:
+            clauses.append("patient_id = ?")
+            params.append(patient_id)
+        if provider_id:
+            clauses.append("provider_id = ?")
+            params.append(provider_id)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if date_from:
+            clauses.append("date_of_service >= ?")
+            params.append(normalize_service_date(date_from))
+        if date_to:
+            clauses.append("date_of_service <= ?")
+            params.append(normalize_service_date(date_to))
+        if has_duplicate is not None:
+            clauses.append("is_duplicate = ?")
+            params.append(int(has_duplicate))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, **filters) -> List[Dict[str, Any]]:
+        """Return tracked claims matching the filters, using the column indexes"""
+        where, params = self._where(**filters)
+        rows = self.conn.execute(f"SELECT record FROM claims{where} ORDER BY date_of_service, claim_id", params)
+        return [json.loads(row["record"]) for row in rows]
+
+    def page(self, sort: str = "date_of_service", after: Optional[str] = None, limit: int = 100,
+             **filters) -> tuple:
+        """
+        Return one keyset-paginated page of tracked claims
+
+        Args:
+            sort: Column to order by, prefixed with "-" for descending
+            after: Cursor from the previous page
+            limit: Maximum claims on the page
+
+        Returns:
+            tuple: (tracked claims, cursor for the next page or None)
+        """
+        descending = sort.startswith("-")
+        column = sort.lstrip("-")
+        if column not in SORT_FIELDS:
+            raise ValueError(f"Cannot sort by {column}")
+
+        where, params = self._where(**filters)
+        if after:
+            sort_value, claim_id = decode_cursor(after, sort)
+            where += " AND " if where else " WHERE "
+            where += f"({column}, claim_id) {'<' if descending else '>'} (?, ?)"
+            params += [sort_value, claim_id]
+        direction = "DESC" if descending else "ASC"
+
+        rows = self.conn.execute(
+            f"SELECT {column} AS sort_value, claim_id, record FROM claims{where} "
+            f"ORDER BY {column} {direction}, claim_id {direction} LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(sort, rows[-1]["sort_value"], rows[-1]["claim_id"])
+        return [json.loads(row["record"]) for row in rows], next_cursor
+
+    def iter_claims(self) -> Iterator[Dict[str, Any]]:
+        """Yield every tracked claim, for rebuilding in-memory indexes"""
+        for row in self.conn.execute("SELECT record FROM claims"):
+            yield json.loads(row["record"])["claim"]
+
+    def duplicate_summary(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Duplicate analytics over a date range, from the per-day, per-provider buckets
+
+        Bounds are applied at day granularity.
+        """
+        return self.analytics.summary(
+            normalize_service_date(date_from)[:10] if date_from else None,
+            normalize_service_date(date_to)[:10] if date_to else None
+        )
+
+class Transaction:
+    """
+    Context manager for an explicit SQLite transaction on an autocommit connection
+
+    Analytics bucket changes reach memory, and event listeners are notified,
+    only once the transaction commits.
+    """
+
+    def __init__(self, store: ClaimStore):
+        self.store = store
+        self.conn = store.conn
+        self.nested = False
+
+    def __enter__(self):
+        self.nested = self.conn.in_transaction
+        if not self.nested:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.nested:
+            return False
+        if exc_type:
+            self.conn.execute("ROLLBACK")
+            self.store._pending_buckets.clear()
+            self.store._events_written = False
+        else:
+            self.conn.execute("COMMIT")
+            self.store._commit_buckets()
+            self.store._notify_listeners()
+        return False
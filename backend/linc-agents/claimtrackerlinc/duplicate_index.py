@@ -0,0 +1,234 @@
+"""
+Duplicate index for ClaimTrackerLinc
+In-memory indexes for duplicate claim detection:
+
+- exact: claims with the same hash_signature
+- potential: same patient and date of service with similar procedures
+- near: same patient within a date window with similar procedures, found
+  through MinHash signatures and banded locality-sensitive hashing
+
+Each check touches only the candidates its indexes return, so its cost does
+not grow with the number of tracked claims.
+"""
+
+import os
+import hashlib
+import random
+from datetime import date
+from typing import Dict, List, Any, Optional, Set, Tuple, Iterable, FrozenSet, Union
+
+from claim_store import normalize_service_date
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# One claim ID, or the set of claim IDs sharing an index key
+Bucket = Union[str, Set[str]]
+
+def procedure_codes(procedures: Iterable[Dict[str, Any]]) -> FrozenSet[str]:
+    return frozenset(str(p.get("code")) for p in procedures)
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def service_day(date_of_service: str) -> int:
+    """Day number of a date of service, for window comparisons"""
+    return date.fromisoformat(normalize_service_date(date_of_service)[:10]).toordinal()
+
+class IndexedClaim:
+    """The fields of a tracked claim the duplicate checks need"""
+
+    __slots__ = ("claim_id", "patient_id", "date_of_service", "day", "hash_signature", "codes")
+
+    def __init__(self, claim_id: str, patient_id: str, date_of_service: str,
+                 hash_signature: Optional[str], codes: FrozenSet[str]):
+        self.claim_id = claim_id
+        self.patient_id = patient_id
+        self.date_of_service = date_of_service
+        self.day = service_day(date_of_service)
+        self.hash_signature = hash_signature
+        self.codes = codes
+
+class DuplicateIndex:
+    """Exact-hash, patient/date bucket and MinHash LSH indexes over tracked claims"""
+
+    def __init__(self, similarity_threshold: Optional[float] = None, date_window_days: Optional[int] = None,
+                 bands: Optional[int] = None, rows: Optional[int] = None, seed: int = 1):
+        """
+        Initialize the duplicate index
+
+        Args:
+            similarity_threshold: Procedure Jaccard similarity above which claims are flagged
+            date_window_days: Days either side of the date of service searched for near duplicates
+            bands: LSH bands; more bands raise recall at the cost of more candidates
+            rows: MinHash values per band; more rows raise precision of the candidates
+            seed: Seed for the MinHash permutations
+        """
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else float(
+            os.environ.get("DUPLICATE_SIMILARITY_THRESHOLD", "0.5"))
+        self.date_window_days = date_window_days if date_window_days is not None else int(
+            os.environ.get("DUPLICATE_DATE_WINDOW_DAYS", "3"))
+        self.bands = bands or int(os.environ.get("DUPLICATE_LSH_BANDS", "16"))
+        self.rows = rows or int(os.environ.get("DUPLICATE_LSH_ROWS", "2"))
+
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(self.bands * self.rows)
+        ]
+        # Per-code permuted hashes; a set's signature is their elementwise minimum
+        self._code_signatures: Dict[str, Tuple[int, ...]] = {}
+
+        # Index values are a bare claim ID until a second claim shares the key,
+        # which keeps the mostly-singleton buckets small at millions of claims
+        self.claims: Dict[str, IndexedClaim] = {}
+        self.by_hash: Dict[str, Bucket] = {}
+        self.by_patient_date: Dict[Tuple[str, int], Bucket] = {}
+        # LSH buckets are scoped to a patient, so common procedure mixes do not collide across patients
+        self.lsh_buckets: Dict[int, Bucket] = {}
+
+    def __len__(self) -> int:
+        return len(self.claims)
+
+    def scratch(self) -> "DuplicateIndex":
+        """Empty index with the same settings and code signature cache, for checking a batch"""
+        index = DuplicateIndex(self.similarity_threshold, self.date_window_days, self.bands, self.rows)
+        index._permutations = self._permutations
+        index._code_signatures = self._code_signatures
+        return index
+
+    def _code_signature(self, code: str) -> Tuple[int, ...]:
+        signature = self._code_signatures.get(code)
+        if signature is None:
+            h = int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), "big")
+            signature = tuple(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for a, b in self._permutations)
+            self._code_signatures[code] = signature
+        return signature
+
+    def minhash(self, codes: FrozenSet[str]) -> List[int]:
+        """MinHash signature of a procedure code set"""
+        return list(map(min, zip(*(self._code_signature(code) for code in codes))))
+
+    def _band_keys(self, patient_id: str, codes: FrozenSet[str]) -> List[int]:
+        signature = self.minhash(codes)
+        return [
+            hash((patient_id, band, *signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def add(self, claim_id: str, patient_id: str, date_of_service: str,
+            hash_signature: Optional[str], procedures: Iterable[Dict[str, Any]]) -> None:
+        """Index a tracked claim, replacing any earlier version of it"""
+        if claim_id in self.claims:
+            self.remove(claim_id)
+        entry = IndexedClaim(claim_id, patient_id, date_of_service, hash_signature, procedure_codes(procedures))
+        self.claims[claim_id] = entry
+        if hash_signature:
+            self._insert(self.by_hash, hash_signature, claim_id)
+        self._insert(self.by_patient_date, (patient_id, entry.day), claim_id)
+        if entry.codes:
+            for key in self._band_keys(patient_id, entry.codes):
+                self._insert(self.lsh_buckets, key, claim_id)
+
+    def remove(self, claim_id: str) -> None:
+        entry = self.claims.pop(claim_id, None)
+        if entry is None:
+            return
+        if entry.hash_signature:
+            self._discard(self.by_hash, entry.hash_signature, claim_id)
+        self._discard(self.by_patient_date, (entry.patient_id, entry.day), claim_id)
+        if entry.codes:
+            for key in self._band_keys(entry.patient_id, entry.codes):
+                self._discard(self.lsh_buckets, key, claim_id)
+
+    @staticmethod
+    def _insert(index: Dict[Any, Bucket], key: Any, claim_id: str) -> None:
+        ids = index.get(key)
+        if ids is None:
+            index[key] = claim_id
+        elif isinstance(ids, str):
+            if ids != claim_id:
+                index[key] = {ids, claim_id}
+        else:
+            ids.add(claim_id)
+
+    @staticmethod
+    def _discard(index: Dict[Any, Bucket], key: Any, claim_id: str) -> None:
+        ids = index.get(key)
+        if ids is None:
+            return
+        if isinstance(ids, str):
+            if ids == claim_id:
+                del index[key]
+            return
+        ids.discard(claim_id)
+        if len(ids) == 1:
+            index[key] = next(iter(ids))
+
+    @staticmethod
+    def _members(index: Dict[Any, Bucket], key: Any) -> Tuple[str, ...]:
+        ids = index.get(key)
+        if ids is None:
+            return ()
+        if isinstance(ids, str):
+            return (ids,)
+        return tuple(sorted(ids))
+
+    def _match(self, entry: IndexedClaim, match_type: str, similarity: float) -> Dict[str, Any]:
+        return {
+            "claim_id": entry.claim_id,
+            "patient_id": entry.patient_id,
+            "date_of_service": entry.date_of_service,
+            "match_type": match_type,
+            "similarity": similarity
+        }
+
+    def check(self, claim_id: str, patient_id: str, date_of_service: str,
+              hash_signature: Optional[str], procedures: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Find tracked claims that duplicate the given claim
+
+        Returns:
+            dict: Duplicate check result in the ClaimTrackerLinc format
+        """
+        codes = procedure_codes(procedures)
+        day = service_day(date_of_service)
+        duplicates = []
+        seen = {claim_id}
+
+        # Check for exact hash matches
+        for other_id in self._members(self.by_hash, hash_signature) if hash_signature else ():
+            if other_id not in seen:
+                seen.add(other_id)
+                duplicates.append(self._match(self.claims[other_id], "exact", 1.0))
+        exact_match = len(duplicates) > 0
+
+        # Same patient and date of service with similar procedures
+        for other_id in self._members(self.by_patient_date, (patient_id, day)):
+            if other_id in seen:
+                continue
+            seen.add(other_id)
+            similarity = jaccard(codes, self.claims[other_id].codes)
+            if similarity > self.similarity_threshold:
+                duplicates.append(self._match(self.claims[other_id], "potential", similarity))
+
+        # Same patient within the date window, found through LSH candidates
+        if self.date_window_days > 0 and codes:
+            candidates = set()
+            for key in self._band_keys(patient_id, codes):
+                candidates.update(self._members(self.lsh_buckets, key))
+            for other_id in sorted(candidates - seen):
+                other = self.claims[other_id]
+                if abs(other.day - day) > self.date_window_days:
+                    continue
+                similarity = jaccard(codes, other.codes)
+                if similarity > self.similarity_threshold:
+                    duplicates.append(self._match(other, "near", similarity))
+
+        return {
+            "is_duplicate": exact_match,
+            "duplicate_claims": duplicates,
+            "needs_review": len(duplicates) > 0 and not exact_match
+        }
@@ -0,0 +1,498 @@
+"""
+Whole-bundle clinical coding audit for MatchLinc
+Audits the claims in an NPHIES claim, preauthorization or predetermination
+bundle line by line before it is submitted. Each claim is indexed once
+(diagnoses and supportingInfo by sequence, payer, service date), then every
+item, detail and sub-detail is checked against that index: its codes against
+the terminology tables, its diagnosis and supportingInfo links, the
+diagnosis-procedure rules and the MDS lab test requirements.
+
+Large bundles are cut into groups of whole items and audited in worker
+processes. Workers compile the same rule file and memory-map the same
+terminology tables, so only the claim index and the item lines are sent to them.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple
+
+from rule_engine import RuleEngine, RuleSet, LabTestRequirement, ValidationMemo, normalize_procedure
+from validation_cache import ValidationCache
+from terminology import Terminology
+
+logger = logging.getLogger("matchlinc.audit")
+
+ICD_10_AM = "http://hl7.org/fhir/sid/icd-10-am"
+LAB_TEST = "lab-test"
+
+def iter_resources(documents: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+    """Every FHIR resource in a mix of bundles (including batch bundles of bundles) and bare resources"""
+    for document in documents:
+        if isinstance(document, list):
+            yield from iter_resources(document)
+        elif isinstance(document, dict):
+            if document.get("resourceType") == "Bundle":
+                yield from iter_resources(entry.get("resource") for entry in document.get("entry", []))
+            elif document.get("resourceType"):
+                yield document
+
+def codings(concept: Optional[Dict[str, Any]]) -> List[Dict[str, Optional[str]]]:
+    result = []
+    for c in (concept or {}).get("coding", []):
+        if not c.get("code"):
+            continue
+        if not isinstance(c["code"], str):
+            raise ValueError(f"Coding code {c['code']!r} is not a string")
+        result.append({"system": c.get("system"), "code": c["code"], "display": c.get("display")})
+    return result
+
+def sequence_number(value: Any, where: str) -> Any:
+    if value is not None and not isinstance(value, (int, str)):
+        raise ValueError(f"{where}: {value!r} is not a sequence number")
+    return value
+
+def sequence_list(value: Any, where: str) -> List[Any]:
+    """A diagnosisSequence or informationSequence, checked so lookups by it cannot fail"""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError(f"{where} is not a list")
+    return [sequence_number(s, where) for s in value]
+
+def first_code(concepts: Iterable[Optional[Dict[str, Any]]]) -> Optional[str]:
+    for concept in concepts:
+        for coding in codings(concept):
+            return coding["code"]
+    return None
+
+def finding(severity: str, code: str, message: str, suggestion: Optional[str] = None) -> Dict[str, Any]:
+    result = {"severity": severity, "code": code, "message": message}
+    if suggestion:
+        result["suggestion"] = suggestion
+    return result
+
+class ClaimIndex:
+    """
+    The claim-level context every line is checked against, built in one pass
+
+    Holds only plain data (no attachments or line items), so it is cheap to
+    send to audit workers.
+    """
+
+    def __init__(self, claim: Dict[str, Any], organizations: Dict[str, str], payer_id: Optional[str] = None):
+        identifiers = [i["value"] for i in claim.get("identifier", []) if i.get("value")]
+        self.claim_id = str(identifiers[0]) if identifiers else claim.get("id")
+        self.use = claim.get("use")
+        self.type = first_code([claim.get("type")])
+        self.payer_id = payer_id or self._payer(claim.get("insurer"), organizations)
+        self.date = ((claim.get("billablePeriod") or {}).get("start") or claim.get("created") or "")[:10] or None
+
+        self.diagnoses: Dict[Any, Dict[str, Any]] = {}
+        for diagnosis in claim.get("diagnosis", []):
+            coding = (codings(diagnosis.get("diagnosisCodeableConcept")) or [{}])[0]
+            self.diagnoses[sequence_number(diagnosis.get("sequence"), "diagnosis")] = {
+                "code": coding.get("code"),
+                "system": coding.get("system"),
+                "type": first_code(diagnosis.get("type") or [])
+            }
+
+        self.supporting_info: Dict[Any, Dict[str, Any]] = {}
+        for info in claim.get("supportingInfo", []):
+            quantity = info.get("valueQuantity") or {}
+            self.supporting_info[sequence_number(info.get("sequence"), "supportingInfo")] = {
+                "category": first_code([info.get("category")]),
+                "codes": codings(info.get("code")),
+                "value": quantity.get("value"),
+                "unit": quantity.get("code") or quantity.get("unit")
+            }
+
+        # supportingInfo sequences referenced by any item, to find lab results no line uses
+        self.linked_information = {sequence for item in claim.get("item", [])
+                                   for sequence in sequence_list(item.get("informationSequence"), "informationSequence")}
+
+    @staticmethod
+    def _payer(reference: Optional[Dict[str, Any]], organizations: Dict[str, str]) -> Optional[str]:
+        if not reference:
+            return None
+        if (reference.get("identifier") or {}).get("value"):
+            return str(reference["identifier"]["value"])
+        # A literal reference only names a payer if the Organization is in the bundle
+        return organizations.get((reference.get("reference") or "").rstrip("/").rsplit("/", 1)[-1])
+
+    def lab_tests(self, sequences: Iterable[Any]) -> List[Tuple[Any, Dict[str, Any]]]:
+        return [(s, self.supporting_info[s]) for s in sequences
+                if s in self.supporting_info and self.supporting_info[s]["category"] == LAB_TEST]
+
+def claim_lines(item: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """An item and its details and sub-details as lines; details inherit the item's links and dates"""
+    date = item.get("servicedDate") or (item.get("servicedPeriod") or {}).get("start")
+    base = {
+        "item_sequence": item.get("sequence"),
+        "date": date[:10] if date else None,
+        "diagnosis_sequence": sequence_list(item.get("diagnosisSequence"), "diagnosisSequence"),
+        "information_sequence": sequence_list(item.get("informationSequence"), "informationSequence")
+    }
+
+    def line(element: Dict[str, Any], path: str, **sequences) -> Dict[str, Any]:
+        quantity = (element.get("quantity") or {}).get("value")
+        if quantity is not None and not isinstance(quantity, (int, float)):
+            raise ValueError(f"{path} quantity {quantity!r} is not a number")
+        return dict(base, path=path, codes=codings(element.get("productOrService")), quantity=quantity, **sequences)
+
+    path = f"item[{item.get('sequence')}]"
+    lines = [line(item, path, level="item")]
+    for detail in item.get("detail", []):
+        detail_path = f"{path}.detail[{detail.get('sequence')}]"
+        lines.append(line(detail, detail_path, level="detail", detail_sequence=detail.get("sequence")))
+        for sub_detail in detail.get("subDetail", []):
+            lines.append(line(sub_detail, f"{detail_path}.subDetail[{sub_detail.get('sequence')}]", level="subDetail",
+                              detail_sequence=detail.get("sequence"), sub_detail_sequence=sub_detail.get("sequence")))
+    return lines
+
+class LineAuditor:
+    """Checks claim lines against one rule set, the terminology tables and the validation cache"""
+
+    def __init__(self, rule_set: RuleSet, terminology: Terminology, validation_cache: ValidationCache):
+        self.rule_set = rule_set
+        self.terminology = terminology
+        self.validation_cache = validation_cache
+        # Bundles repeat the same service and diagnosis combinations line after line
+        self.memo = ValidationMemo(rule_set)
+        self._code_results: Dict[Tuple[str, str, str, Optional[str]], List[Dict[str, Any]]] = {}
+        self._matches: Dict[Tuple[int, str, Tuple[str, ...]], Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]] = {}
+
+    def audit_claim(self, index: ClaimIndex) -> List[Dict[str, Any]]:
+        """Claim-level findings: diagnosis and lab test codes, principal diagnosis, unlinked lab results"""
+        findings = []
+        for sequence, diagnosis in index.diagnoses.items():
+            findings.extend(self._code_findings(f"diagnosis[{sequence}]", diagnosis["system"] or ICD_10_AM,
+                                                diagnosis["code"], index.date))
+        if index.diagnoses and not any(d["type"] == "principal" for d in index.diagnoses.values()):
+            findings.append(finding("error", "missing-principal-diagnosis", "No diagnosis has type principal"))
+
+        for sequence, info in index.lab_tests(index.supporting_info):
+            if not info["codes"]:
+                findings.append(finding("error", "missing-lab-test-code",
+                                        f"supportingInfo[{sequence}] lab-test has no code"))
+            for coding in info["codes"]:
+                findings.extend(self._code_findings(f"supportingInfo[{sequence}]", coding["system"],
+                                                    coding["code"], index.date))
+            if sequence not in index.linked_information:
+                findings.append(finding("warning", "unlinked-lab-test",
+                                        f"supportingInfo[{sequence}] lab-test is not in any item's informationSequence"))
+        return findings
+
+    def _code_findings(self, where: str, system: Optional[str], code: Optional[str],
+                       on_date: Optional[str]) -> List[Dict[str, Any]]:
+        if not system or not code:
+            return []
+        key = (where, system, code, on_date)
+        findings = self._code_results.get(key)
+        if findings is None:
+            result = self.terminology.validate(system, code, on_date)
+            findings = []
+            # Systems without a table are not checked, and a code missing from a
+            # partial table (such as the seed data) may still be valid
+            if result["known"] is False:
+                findings.append(finding("error" if result["complete"] else "warning", "unknown-code",
+                                        f"{where}: {code} is not in {system}"))
+            elif result["known"] and not result["valid"]:
+                findings.append(finding("error", "code-not-in-force", f"{where}: {code} is not in force on {on_date or 'today'}"))
+            self._code_results[key] = findings
+        return findings
+
+    def audit_lines(self, index: ClaimIndex, lines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [self.audit_line(index, line) for line in lines]
+
+    def audit_line(self, index: ClaimIndex, line: Dict[str, Any]) -> Dict[str, Any]:
+        findings: List[Dict[str, Any]] = []
+        date = line["date"] or index.date
+        if not line["codes"]:
+            findings.append(finding("error", "missing-code", "Line has no productOrService code"))
+        for coding in line["codes"]:
+            findings.extend(self._code_findings("productOrService", coding["system"], coding["code"], date))
+
+        # Broken links belong to the item; its details inherit them
+        if line["level"] == "item":
+            missing = [s for s in line["diagnosis_sequence"] if s not in index.diagnoses]
+            if missing:
+                findings.append(finding("error", "missing-diagnosis-reference",
+                                        f"diagnosisSequence {missing} does not match any diagnosis"))
+            elif not line["diagnosis_sequence"] and index.diagnoses:
+                findings.append(finding("warning", "no-linked-diagnosis", "Item has no diagnosisSequence"))
+            missing = [s for s in line["information_sequence"] if s not in index.supporting_info]
+            if missing:
+                findings.append(finding("error", "missing-information-reference",
+                                        f"informationSequence {missing} does not match any supportingInfo"))
+
+        diagnoses = [index.diagnoses[s]["code"] for s in line["diagnosis_sequence"]
+                     if s in index.diagnoses and index.diagnoses[s]["code"]]
+        match = None
+        for coding in line["codes"]:
+            if any(rule.applies_to(index.payer_id) for rule in self.rule_set.rules_for_procedure(coding["code"])):
+                match = self._diagnosis_match(index, coding["code"], diagnoses, findings)
+                break
+        for coding in line["codes"]:
+            requirement = self.rule_set.lab_requirement(coding["code"])
+            if requirement:
+                self._lab_test_findings(index, line, requirement, findings)
+                break
+
+        return {
+            "path": line["path"],
+            "level": line["level"],
+            "item_sequence": line["item_sequence"],
+            "detail_sequence": line.get("detail_sequence"),
+            "sub_detail_sequence": line.get("sub_detail_sequence"),
+            "codes": line["codes"],
+            "diagnoses": diagnoses,
+            "diagnosis_match": match,
+            "valid": not any(f["severity"] == "error" for f in findings),
+            "findings": findings
+        }
+
+    def _diagnosis_match(self, index: ClaimIndex, code: str, diagnoses: List[str],
+                         findings: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # Repeated lines (a daily charge over a stay) share one result per claim, code and linked diagnoses
+        key = (id(index), code, tuple(diagnoses))
+        cached = self._matches.get(key)
+        if cached is None:
+            cached = self._matches[key] = self._match(index, code, diagnoses)
+        match, match_findings = cached
+        findings.extend(match_findings)
+        return match
+
+    def _match(self, index: ClaimIndex, code: str, diagnoses: List[str]) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        result = self.validation_cache.validate(self.rule_set, [code], diagnoses, index.payer_id, memo=self.memo)[0]
+        if result["is_valid"]:
+            return {"rule_id": result["rule_id"], "matched_diagnosis": result["matched_diagnosis"],
+                    "confidence": result["confidence"]}, []
+
+        # A supporting diagnosis elsewhere on the claim only needs linking
+        linked = set(diagnoses)
+        others = [d["code"] for d in index.diagnoses.values() if d["code"] and d["code"] not in linked]
+        if others:
+            claim_result = self.validation_cache.validate(self.rule_set, [code], diagnoses + others,
+                                                          index.payer_id, memo=self.memo)[0]
+            if claim_result["is_valid"] and claim_result["matched_diagnosis"] in others:
+                return None, [finding(
+                    "warning", "diagnosis-not-linked",
+                    f"{claim_result['matched_diagnosis']} supports {code} but is not in the item's diagnosisSequence",
+                    f"Add {claim_result['matched_diagnosis']} to the item's diagnosisSequence"
+                )]
+        return None, [finding("error", "diagnosis-mismatch", f"No linked diagnosis supports {code}",
+                              (result["suggestions"] or [None])[0])]
+
+    @staticmethod
+    def _lab_test_findings(index: ClaimIndex, line: Dict[str, Any], requirement: LabTestRequirement,
+                           findings: List[Dict[str, Any]]) -> None:
+        suggestion = requirement.definition.get("suggestion")
+        linked = [(s, info) for s, info in index.lab_tests(line["information_sequence"])
+                  if any(normalize_procedure(c["code"]) in requirement.lab_test_codes for c in info["codes"])]
+        if not linked:
+            unlinked = [s for s, info in index.lab_tests(index.supporting_info)
+                        if any(normalize_procedure(c["code"]) in requirement.lab_test_codes for c in info["codes"])]
+            if unlinked:
+                findings.append(finding("error", "lab-test-not-linked",
+                                        f"{requirement.display} result is in supportingInfo{unlinked} but not in the item's informationSequence",
+                                        suggestion))
+            else:
+                findings.append(finding("error", "missing-lab-test",
+                                        f"{requirement.display} requires a linked lab-test result", suggestion))
+        elif requirement.units:
+            for sequence, info in linked:
+                if info["unit"] not in requirement.units:
+                    findings.append(finding("error", "lab-test-unit",
+                                            f"supportingInfo[{sequence}] unit {info['unit']} is not one of {sorted(requirement.units)}",
+                                            suggestion))
+        if requirement.max_quantity is not None and (line["quantity"] or 0) > requirement.max_quantity:
+            findings.append(finding("error", "quantity-exceeds",
+                                    f"Quantity {line['quantity']} exceeds {requirement.max_quantity} for {requirement.display}"))
+
+# Rule engine, terminology and cache of an audit worker process, set up once by _init_worker
+_worker: Optional[Tuple[RuleEngine, Terminology, ValidationCache]] = None
+
+def _init_worker(rules_path: str, terminology_path: str) -> None:
+    global _worker
+    _worker = (RuleEngine(rules_path), Terminology(terminology_path), ValidationCache())
+
+def _audit_group(version: str, group: List[Tuple[ClaimIndex, List[Dict[str, Any]]]]) -> Tuple[str, List[List[Dict[str, Any]]]]:
+    """Audit a group of item lines in a worker, against the rule set version the request started with"""
+    rule_engine, terminology, validation_cache = _worker
+    rule_set = rule_engine.current()
+    if rule_set.version != version:
+        rule_set = rule_engine.load()
+    auditor = LineAuditor(rule_set, terminology, validation_cache)
+    return rule_set.version, [auditor.audit_lines(index, lines) for index, lines in group]
+
+def available_cpus() -> int:
+    """CPUs this process may run on, which in a container can be fewer than the host has"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class BundleAuditor:
+    """Audits every claim in a bundle, in the request thread or across worker processes for large bundles"""
+
+    def __init__(self, rule_engine: RuleEngine, terminology: Terminology, validation_cache: ValidationCache,
+                 workers: Optional[int] = None):
+        """
+        Initialize the bundle auditor
+
+        Args:
+            rule_engine: Rule engine shared with /validate
+            terminology: Terminology tables shared with /terminology
+            validation_cache: Validation cache shared with /validate
+            workers: Audit worker processes (defaults to environment variable; 0 or 1 audits in-process)
+        """
+        self.rule_engine = rule_engine
+        self.terminology = terminology
+        self.validation_cache = validation_cache
+        self.workers = workers if workers is not None else \
+            int(os.environ.get("AUDIT_WORKERS", str(min(4, available_cpus()))))
+        # Below this many lines handing work to processes costs more than it saves
+        self.parallel_threshold = int(os.environ.get("AUDIT_PARALLEL_THRESHOLD", "2000"))
+        # Lines per worker task; items are never split across tasks
+        self.group_size = int(os.environ.get("AUDIT_GROUP_SIZE", "500"))
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked: the service process runs threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(os.path.abspath(self.rule_engine.path), os.path.abspath(self.terminology.directory))
+                )
+            return self._executor
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    @staticmethod
+    def index(documents: Iterable[Any], payer_id: Optional[str] = None) -> List[Tuple[ClaimIndex, List[List[Dict[str, Any]]]]]:
+        """
+        Every Claim in the documents, indexed, with its lines grouped by item
+
+        Raises:
+            ValueError: A resource does not have the shape of its FHIR type
+        """
+        try:
+            resources = list(iter_resources(documents))
+            organizations = {}
+            for resource in resources:
+                identifiers = resource.get("identifier") or []
+                if resource.get("resourceType") == "Organization" and resource.get("id") and identifiers and identifiers[0].get("value"):
+                    organizations[str(resource["id"])] = str(identifiers[0]["value"])
+            return [(ClaimIndex(resource, organizations, payer_id), [claim_lines(item) for item in resource.get("item", [])])
+                    for resource in resources if resource.get("resourceType") == "Claim"]
+        except (AttributeError, TypeError) as e:
+            raise ValueError(f"Malformed bundle: {str(e)}")
+
+    def _groups(self, claims: List[Tuple[ClaimIndex, List[List[Dict[str, Any]]]]]) -> List[List[Tuple[int, ClaimIndex, List[Dict[str, Any]]]]]:
+        """Whole items packed, in bundle order, into groups of about group_size lines"""
+        groups: List[List[Tuple[int, ClaimIndex, List[Dict[str, Any]]]]] = [[]]
+        size = 0
+        for position, (index, items) in enumerate(claims):
+            for lines in items:
+                if size and size + len(lines) > self.group_size:
+                    groups.append([])
+                    size = 0
+                groups[-1].append((position, index, lines))
+                size += len(lines)
+        return groups
+
+    def _audit_serial(self, rule_set: RuleSet, claims: List[Tuple[ClaimIndex, List[List[Dict[str, Any]]]]]) -> List[List[Dict[str, Any]]]:
+        auditor = LineAuditor(rule_set, self.terminology, self.validation_cache)
+        return [[result for lines in items for result in auditor.audit_lines(index, lines)] for index, items in claims]
+
+    async def _audit_parallel(self, rule_set: RuleSet,
+                              claims: List[Tuple[ClaimIndex, List[List[Dict[str, Any]]]]]) -> Tuple[List[List[Dict[str, Any]]], int]:
+        groups = self._groups(claims)
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        outputs = await asyncio.gather(*(
+            loop.run_in_executor(pool, _audit_group, rule_set.version, [(index, lines) for _, index, lines in group])
+            for group in groups
+        ))
+        versions = {version for version, _ in outputs}
+        if versions != {rule_set.version}:
+            raise RuntimeError(f"workers audited with rule set {sorted(versions)}, not {rule_set.version}")
+
+        lines: List[List[Dict[str, Any]]] = [[] for _ in claims]
+        for group, (_, results) in zip(groups, outputs):
+            for (position, _, _), item_results in zip(group, results):
+                lines[position].extend(item_results)
+        return lines, len(groups)
+
+    async def audit(self, documents: Iterable[Any], payer_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Line-level findings for every claim in the documents
+
+        Returns:
+            dict: Claims with their claim-level findings and audited lines, and a
+            summary; None if the documents contain no Claim
+        """
+        claims = await asyncio.to_thread(self.index, documents, payer_id)
+        if not claims:
+            return None
+        rule_set = self.rule_engine.current()
+        line_count = sum(len(lines) for _, items in claims for lines in items)
+
+        groups = 0
+        if self.workers > 1 and line_count >= self.parallel_threshold:
+            try:
+                lines, groups = await self._audit_parallel(rule_set, claims)
+            except (BrokenProcessPool, RuntimeError) as e:
+                # A dead worker or a rule reload mid-audit: redo it in-process against one rule set
+                logger.warning(f"Parallel audit failed, auditing in-process: {str(e)}")
+                if isinstance(e, BrokenProcessPool):
+                    self.shutdown()
+                groups = 0
+        if not groups:
+            lines = await asyncio.to_thread(self._audit_serial, rule_set, claims)
+
+        claim_auditor = LineAuditor(rule_set, self.terminology, self.validation_cache)
+        report = []
+        errors = warnings = invalid_lines = 0
+        for (index, _), claim_lines_audited in zip(claims, lines):
+            findings = claim_auditor.audit_claim(index)
+            all_findings = findings + [f for line in claim_lines_audited for f in line["findings"]]
+            errors += sum(1 for f in all_findings if f["severity"] == "error")
+            warnings += sum(1 for f in all_findings if f["severity"] == "warning")
+            invalid_lines += sum(1 for line in claim_lines_audited if not line["valid"])
+            report.append({
+                "claim_id": index.claim_id,
+                "use": index.use,
+                "type": index.type,
+                "payer_id": index.payer_id,
+                "valid": not any(f["severity"] == "error" for f in all_findings),
+                "findings": findings,
+                "lines": claim_lines_audited
+            })
+
+        return {
+            "claims": report,
+            "summary": {
+                "claims": len(report),
+                "valid_claims": sum(1 for claim in report if claim["valid"]),
+                "lines": line_count,
+                "invalid_lines": invalid_lines,
+                "errors": errors,
+                "warnings": warnings,
+                "parallel": bool(groups),
+                "groups": groups,
+                "rule_set_version": rule_set.version
+            }
+        }
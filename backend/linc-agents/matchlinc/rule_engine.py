@@ -0,0 +1,406 @@
+"""
+Diagnosis-procedure rule engine for MatchLinc
+Loads diagnosis/procedure compatibility rules from a file and compiles both
+code axes into interval tables: procedure codes, prefixes and ranges resolve to
+their rules with one dictionary lookup and one bisect, and each diagnosis code
+resolves to every rule it supports the same way. Validating a claim is then a
+lookup per code rather than a scan of every procedure x diagnosis x rule.
+
+The same file carries the MDS lab test requirements: services, such as HbA1c,
+that NPHIES rejects unless they are linked to a lab result with given codes.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+
+logger = logging.getLogger("matchlinc.rules")
+
+# Inclusive range ends cover every longer code sharing their prefix (I99 covers I99.8)
+PREFIX_END = "\uffff"
+
+DEFAULT_CONFIDENCE = 0.9
+DEFAULT_SUGGESTION = "Review documentation for a diagnosis that supports medical necessity"
+
+def normalize_diagnosis(code: str) -> str:
+    """ICD-10-AM codes compare without the dot and case-insensitively"""
+    return code.strip().upper().replace(".", "")
+
+def normalize_procedure(code: str) -> str:
+    return code.strip().upper()
+
+def parse_diagnosis_range(code_range: Any) -> Tuple[str, str]:
+    """An ICD-10-AM range ("M75.1-M75.12", a single code, or a [low, high] pair) as normalised bounds"""
+    if isinstance(code_range, (list, tuple)):
+        low, high = code_range
+    elif "-" in code_range:
+        low, high = code_range.split("-", 1)
+    else:
+        low = high = code_range
+    return normalize_diagnosis(low), normalize_diagnosis(high)
+
+class IntervalTable:
+    """Values keyed by exact code and by inclusive code range, cut into elementary segments"""
+
+    def __init__(self):
+        self.exact: Dict[str, List[Any]] = {}
+        self.ranged: List[Tuple[str, str, Any]] = []
+        self.boundaries: List[str] = []
+        self.segments: List[List[Any]] = []
+
+    def add_code(self, code: str, value: Any) -> None:
+        self.exact.setdefault(code, []).append(value)
+
+    def add_range(self, low: str, high: str, value: Any) -> None:
+        self.ranged.append((low, high + PREFIX_END, value))
+
+    def seal(self) -> None:
+        """Cut the ranges at every boundary so a lookup is one bisect"""
+        points = sorted({low for low, _, _ in self.ranged} | {end for _, end, _ in self.ranged})
+        self.boundaries = points
+        self.segments = [
+            [value for start, end, value in self.ranged if start <= low and high <= end]
+            for low, high in zip(points, points[1:])
+        ]
+        if points:
+            self.segments.append([])
+
+    def lookup(self, code: str) -> List[Any]:
+        values = self.exact.get(code, [])
+        i = bisect_right(self.boundaries, code) - 1
+        if i >= 0 and self.segments[i]:
+            values = values + self.segments[i] if values else self.segments[i]
+        return values
+
+class ProcedureRule:
+    """One compiled compatibility rule: the procedures it covers and the diagnoses that support them"""
+
+    def __init__(self, index: int, definition: Dict[str, Any]):
+        self.index = index
+        self.definition = definition
+        self.procedure_codes = [normalize_procedure(c) for c in
+                                definition.get("procedure_codes") or
+                                ([definition["procedure_code"]] if definition.get("procedure_code") else [])]
+        self.procedure_prefixes = [normalize_procedure(p) for p in
+                                   definition.get("procedure_prefixes") or
+                                   ([definition["procedure_prefix"]] if definition.get("procedure_prefix") else [])]
+        self.procedure_ranges = [(normalize_procedure(low), normalize_procedure(high))
+                                 for low, high in definition.get("procedure_ranges", [])]
+        if not (self.procedure_codes or self.procedure_prefixes or self.procedure_ranges):
+            raise ValueError("rule covers no procedure codes")
+        self.rule_id = definition.get("id") or (self.procedure_codes + self.procedure_prefixes + [""])[0] or f"rule-{index}"
+        self.confidence = float(definition.get("confidence", DEFAULT_CONFIDENCE))
+        self.diagnoses = definition.get("compatible_diagnoses", [])
+        if not self.diagnoses:
+            raise ValueError("rule lists no compatible diagnoses")
+        # Payer-specific rules apply only to those payers; rules without payers apply to all
+        self.payers = set(definition.get("payers") or [])
+        # Exact codes outrank prefixes and ranges when several rules cover a procedure
+        self.specificity = 0 if self.procedure_codes else 1
+
+    def applies_to(self, payer_id: Optional[str]) -> bool:
+        return not self.payers or payer_id in self.payers
+
+    @property
+    def procedure_selectors(self) -> List[str]:
+        """The procedures covered, as shown in coding rule responses"""
+        return (self.procedure_codes + [f"{prefix}xx" for prefix in self.procedure_prefixes] +
+                [f"{low}-{high}" for low, high in self.procedure_ranges])
+
+    @property
+    def diagnosis_ranges(self) -> List[str]:
+        return [d["code_range"] if isinstance(d["code_range"], str) else "-".join(d["code_range"])
+                for d in self.diagnoses]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "rule_id": self.rule_id,
+            "procedures": self.procedure_selectors,
+            "procedure_display": self.definition.get("procedure_display"),
+            "compatible_diagnoses": self.diagnoses,
+            "confidence": self.confidence
+        }
+
+class LabTestRequirement:
+    """An MDS rule: services that must be linked to a lab test result of given codes and units"""
+
+    def __init__(self, definition: Dict[str, Any]):
+        self.definition = definition
+        self.service_codes = [normalize_procedure(c) for c in definition.get("service_codes", [])]
+        if not self.service_codes:
+            raise ValueError("requirement covers no service codes")
+        self.requirement_id = definition.get("id") or self.service_codes[0]
+        self.lab_test_codes = {normalize_procedure(c) for c in definition.get("lab_test_codes", [])}
+        if not self.lab_test_codes:
+            raise ValueError("requirement lists no lab test codes")
+        # Accepted UCUM units of the result; any unit when empty
+        self.units = set(definition.get("units") or [])
+        self.max_quantity = definition.get("max_quantity")
+        self.display = definition.get("service_display") or self.requirement_id
+
+class RuleSet:
+    """Immutable compiled rule set, with interval tables on the procedure and diagnosis axes"""
+
+    def __init__(self, data: Any, version: str = "empty", generation: int = 0):
+        # Older rule files are a bare list of procedure rules
+        if isinstance(data, list):
+            data = {"procedure_rules": data}
+        self.version = version
+        # Increases with every load, so consumers can tell a newer rule set from an older one
+        self.generation = generation
+        self.name = data.get("version")
+        self.rules: List[ProcedureRule] = []
+        self.procedures = IntervalTable()
+        self.diagnoses = IntervalTable()
+        self.guidance = IntervalTable()
+        self.guidance_entries: List[Dict[str, Any]] = data.get("diagnosis_guidance", [])
+        self.lab_requirements: Dict[str, LabTestRequirement] = {}
+
+        for definition in data.get("procedure_rules", []):
+            try:
+                rule = ProcedureRule(len(self.rules), definition)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping coding rule {definition.get('id') or definition.get('procedure_code')}: {str(e)}")
+                continue
+            self.rules.append(rule)
+            for code in rule.procedure_codes:
+                self.procedures.add_code(code, rule)
+            for prefix in rule.procedure_prefixes:
+                self.procedures.add_range(prefix, prefix, rule)
+            for low, high in rule.procedure_ranges:
+                self.procedures.add_range(low, high, rule)
+            for entry in rule.diagnoses:
+                low, high = parse_diagnosis_range(entry["code_range"])
+                confidence = float(entry.get("confidence", rule.confidence))
+                self.diagnoses.add_range(low, high, (rule.index, confidence))
+
+        for entry in self.guidance_entries:
+            low, high = parse_diagnosis_range(entry["code_range"])
+            self.guidance.add_range(low, high, entry)
+
+        for definition in data.get("lab_test_requirements", []):
+            try:
+                requirement = LabTestRequirement(definition)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"Skipping lab test requirement {definition.get('id')}: {str(e)}")
+                continue
+            for code in requirement.service_codes:
+                self.lab_requirements[code] = requirement
+
+        for table in (self.procedures, self.diagnoses, self.guidance):
+            table.seal()
+        # Most specific first, then the most confident
+        for rules in list(self.procedures.exact.values()) + self.procedures.segments:
+            rules.sort(key=lambda rule: (rule.specificity, -rule.confidence, rule.index))
+
+    def rules_for_procedure(self, code: str) -> List[ProcedureRule]:
+        return self.procedures.lookup(normalize_procedure(code))
+
+    def lab_requirement(self, code: str) -> Optional[LabTestRequirement]:
+        return self.lab_requirements.get(normalize_procedure(code))
+
+    def rules_for_diagnosis(self, code: str) -> List[ProcedureRule]:
+        return [self.rules[index] for index, _ in self.diagnoses.lookup(normalize_diagnosis(code))]
+
+    def supported_rules(self, diagnosis_keys: Tuple[str, ...]) -> Dict[int, Tuple[float, str]]:
+        """Best (confidence, diagnosis key) per rule index that one of the normalised diagnoses supports"""
+        supported: Dict[int, Tuple[float, str]] = {}
+        for key in diagnosis_keys:
+            for index, confidence in self.diagnoses.lookup(key):
+                # Ties go to the first key, so results do not depend on how a claim orders its diagnoses
+                if index not in supported or confidence > supported[index][0]:
+                    supported[index] = (confidence, key)
+        return supported
+
+    def match_procedure(self, code: str, supported: Dict[int, Tuple[float, str]],
+                        payer_id: Optional[str] = None) -> Dict[str, Any]:
+        """Validation result for one procedure given the rules its claim's diagnoses support
+
+        matched_diagnosis is the normalised diagnosis key; callers map it back to the claim's code.
+        """
+        rules = [rule for rule in self.rules_for_procedure(code) if rule.applies_to(payer_id)]
+        best: Optional[Tuple[float, str, ProcedureRule]] = None
+        for rule in rules:
+            if rule.index in supported:
+                confidence, diagnosis = supported[rule.index]
+                if best is None or confidence > best[0]:
+                    best = (confidence, diagnosis, rule)
+
+        result = {
+            "procedure_code": code,
+            "is_valid": best is not None,
+            "matched_diagnosis": best[1] if best else None,
+            "confidence": best[0] if best else 0,
+            "rule_id": best[2].rule_id if best else None,
+            "issues": [],
+            "suggestions": []
+        }
+        if best is None:
+            result["issues"].append("No supporting diagnosis found for this procedure")
+            if rules:
+                rule = rules[0]
+                result["suggestions"].append(
+                    rule.definition.get("suggestion") or
+                    f"Add a diagnosis in {', '.join(rule.diagnosis_ranges)} that supports this procedure"
+                )
+            else:
+                result["suggestions"].append(DEFAULT_SUGGESTION)
+        return result
+
+    def validate(self, procedure_codes: List[str], diagnosis_codes: List[str],
+                 payer_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Validation results for every procedure against a claim's diagnoses"""
+        return ValidationMemo(self).validate(procedure_codes, diagnosis_codes, payer_id)
+
+    def coding_rules(self, diagnosis_code: Optional[str] = None,
+                     procedure_code: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Coding rules for a diagnosis and/or procedure code, in the /coding-rules format"""
+        results = []
+        if diagnosis_code:
+            rules = self.rules_for_diagnosis(diagnosis_code)
+            guidance = self.guidance.lookup(normalize_diagnosis(diagnosis_code))
+            if rules or guidance:
+                compatible = []
+                for rule in rules:
+                    compatible.extend(s for s in rule.procedure_selectors if s not in compatible)
+                results.append({
+                    "code": diagnosis_code,
+                    "code_type": "diagnosis",
+                    "compatible_procedures": compatible,
+                    "documentation_requirements": [r for entry in guidance for r in entry.get("documentation_requirements", [])],
+                    "common_pitfalls": [p for entry in guidance for p in entry.get("common_pitfalls", [])],
+                    "rules": [rule.summary() for rule in rules]
+                })
+        if procedure_code:
+            rules = self.rules_for_procedure(procedure_code)
+            if rules:
+                supporting = []
+                for rule in rules:
+                    supporting.extend(r for r in rule.diagnosis_ranges if r not in supporting)
+                results.append({
+                    "code": procedure_code,
+                    "code_type": "procedure",
+                    "supporting_diagnoses": supporting,
+                    "documentation_requirements": [r for rule in rules for r in rule.definition.get("documentation_requirements", [])],
+                    "common_pitfalls": [p for rule in rules for p in rule.definition.get("common_pitfalls", [])],
+                    "rules": [rule.summary() for rule in rules]
+                })
+        return results
+
+def diagnosis_key(diagnosis_codes: List[str]) -> Tuple[Tuple[str, ...], Dict[str, str]]:
+    """A claim's diagnoses as a sorted tuple of normalised codes, and each key's code as given"""
+    spelled: Dict[str, str] = {}
+    for code in diagnosis_codes:
+        spelled.setdefault(normalize_diagnosis(code), code)
+    return tuple(sorted(spelled)), spelled
+
+def claim_results(results: Dict[str, Dict[str, Any]], procedure_codes: List[str],
+                  spelled: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Per-claim copies of shared results by normalised procedure, in claim order and spelling"""
+    claim = []
+    for code in procedure_codes:
+        result = dict(results[normalize_procedure(code)], procedure_code=code)
+        if result["matched_diagnosis"] is not None:
+            result["matched_diagnosis"] = spelled[result["matched_diagnosis"]]
+        claim.append(result)
+    return claim
+
+class ValidationMemo:
+    """
+    Memoised validation against one rule set
+
+    Results depend only on the procedure code, the set of diagnoses and the
+    payer, so a batch that repeats a combination computes it once. Diagnosis
+    sets resolve to their supported rules once however many procedures they
+    are checked against.
+    """
+
+    def __init__(self, rule_set: RuleSet):
+        self.rule_set = rule_set
+        self.supported: Dict[Tuple[str, ...], Dict[int, Tuple[float, str]]] = {}
+        self.results: Dict[Tuple[str, Tuple[str, ...], Optional[str]], Dict[str, Any]] = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def match(self, procedure_code: str, diagnoses: Tuple[str, ...], payer_id: Optional[str] = None) -> Dict[str, Any]:
+        key = (normalize_procedure(procedure_code), diagnoses, payer_id)
+        self.lookups += 1
+        result = self.results.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        supported = self.supported.get(diagnoses)
+        if supported is None:
+            supported = self.supported[diagnoses] = self.rule_set.supported_rules(diagnoses)
+        result = self.results[key] = self.rule_set.match_procedure(key[0], supported, payer_id)
+        return result
+
+    def validate(self, procedure_codes: List[str], diagnosis_codes: List[str],
+                 payer_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Validation results for every procedure against a claim's diagnoses"""
+        diagnoses, spelled = diagnosis_key(diagnosis_codes)
+        results = {normalize_procedure(code): self.match(code, diagnoses, payer_id) for code in procedure_codes}
+        return claim_results(results, procedure_codes, spelled)
+
+class RuleEngine:
+    """Loads the rule file, keeps it compiled and recompiles it when it changes"""
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Initialize the rule engine
+
+        Args:
+            path: Rule JSON file (defaults to environment variable)
+        """
+        self.path = path or os.environ.get("MATCH_RULES_PATH", "data/procedure_diagnosis_rules.json")
+        # Seconds between modification time checks on the request path
+        self.check_interval = float(os.environ.get("MATCH_RULES_RELOAD_CHECK", "2"))
+        self.rule_set = RuleSet({})
+        self.loaded_at: Optional[str] = None
+        self._mtime: Optional[Tuple[int, int]] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.load()
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> RuleSet:
+        """Read and compile the rule file, then swap the rule set in"""
+        with self._lock:
+            mtime = self._stat()
+            try:
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+            except FileNotFoundError:
+                logger.warning(f"{self.path} not found")
+                raw = b"[]"
+            # The version is the content digest, so rewriting identical rules keeps it
+            self.rule_set = RuleSet(json.loads(raw), hashlib.sha256(raw).hexdigest()[:12], self.rule_set.generation + 1)
+            self._mtime = mtime
+            self.loaded_at = datetime.now().isoformat()
+            logger.info(f"Compiled {len(self.rule_set.rules)} coding rules (version {self.rule_set.version})")
+            return self.rule_set
+
+    def current(self) -> RuleSet:
+        """The compiled rule set, recompiling first if the file has changed"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            if self._stat() != self._mtime:
+                try:
+                    self.load()
+                except Exception as e:
+                    # Keep serving the previous rule set until the file parses again
+                    logger.error(f"Error reloading coding rules: {str(e)}")
+        return self.rule_set
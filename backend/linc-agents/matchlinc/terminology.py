@@ -0,0 +1,321 @@
+"""
+Terminology tables for MatchLinc
+Code systems (ICD-10-AM, NPHIES procedures, services and laboratory codes,
+scientific codes, MOH categories, LOINC) are stored as one compact, sorted
+binary table per system and memory-mapped on first use. A lookup is a binary
+search over a fixed-width index, a prefix query is two binary searches, and
+only the pages touched are read, so millions of codes cost little memory and
+nothing at startup.
+
+Tables are built from CSV files (code, display, parent, valid_from, valid_to)
+in the terminology directory; a table is rebuilt when its CSV is newer. Codes
+are stored upper-case, and ICD-10-AM codes without the dot.
+
+Usage:
+    python terminology.py data/terminology
+"""
+
+import os
+import csv
+import mmap
+import struct
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import date
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple
+
+from rule_engine import normalize_diagnosis
+
+logger = logging.getLogger("matchlinc.terminology")
+
+# Code system URL to table name
+SYSTEMS = {
+    "http://hl7.org/fhir/sid/icd-10-am": "icd-10-am",
+    "http://nphies.sa/terminology/CodeSystem/procedures": "nphies-procedures",
+    "http://nphies.sa/terminology/CodeSystem/services": "nphies-services",
+    "http://nphies.sa/terminology/CodeSystem/laboratory": "nphies-laboratory",
+    "http://nphies.sa/terminology/CodeSystem/medication-codes": "medication-codes",
+    "http://nphies.sa/terminology/CodeSystem/scientific-codes": "scientific-codes",
+    "http://nphies.sa/terminology/CodeSystem/moh-category": "moh-category",
+    "http://loinc.org": "loinc",
+}
+
+# Tables whose codes compare without the dot, as the rule engine compares diagnoses
+DOTLESS_TABLES = {"icd-10-am"}
+
+MAGIC = b"LINCTERM"
+# Version 2 stores ICD-10-AM codes without the dot
+FORMAT_VERSION = 2
+# magic, format version, entry count, index offset
+HEADER = struct.Struct("<8sIIQ")
+# record offset, record length, code length
+INDEX_ENTRY = struct.Struct("<QIH")
+FIELDS = ("code", "display", "parent", "valid_from", "valid_to")
+SEPARATOR = "\x1f"
+
+def table_name(system: str) -> str:
+    """Table name for a code system URL; table names pass through unchanged"""
+    return SYSTEMS.get(system, system)
+
+def normalize_code(code: str, table: Optional[str] = None) -> str:
+    """Normalise a code the way the named table stores it"""
+    if table in DOTLESS_TABLES:
+        return normalize_diagnosis(code)
+    return code.strip().upper()
+
+def path_table(path: str) -> str:
+    """Table name of a .codes or .csv file"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+def build_table(path: str, rows: Iterable[Dict[str, Any]]) -> int:
+    """
+    Write a sorted binary table, replacing any existing one atomically
+
+    Args:
+        path: Table file to write
+        rows: Dicts with code and optionally display, parent, valid_from, valid_to;
+              a repeated code keeps its last row
+
+    Returns:
+        int: Number of codes written
+    """
+    name = path_table(path)
+    records: Dict[bytes, bytes] = {}
+    for row in rows:
+        code = normalize_code(row.get("code") or "", name)
+        if not code:
+            continue
+        values = [code] + [(row.get(field) or "").strip().replace(SEPARATOR, " ") for field in FIELDS[1:]]
+        records[code.encode("utf-8")] = SEPARATOR.join(values).encode("utf-8")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+            index = []
+            offset = HEADER.size
+            for code in sorted(records):
+                record = records[code]
+                f.write(record)
+                index.append(INDEX_ENTRY.pack(offset, len(record), len(code)))
+                offset += len(record)
+            f.write(b"".join(index))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index), offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(records)
+
+def build_from_csv(csv_path: str, table_path: str) -> int:
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return build_table(table_path, csv.DictReader(f))
+
+class CodeTable:
+    """A memory-mapped, sorted code table"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = path_table(path)
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_RANDOM"):
+            # Binary search jumps around the file; readahead would only inflate resident memory
+            self._mm.madvise(mmap.MADV_RANDOM)
+        magic, version, self.count, self._index_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is not a terminology table")
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _entry(self, i: int) -> Tuple[int, int, int]:
+        return INDEX_ENTRY.unpack_from(self._mm, self._index_offset + i * INDEX_ENTRY.size)
+
+    def _key(self, i: int) -> bytes:
+        offset, _, code_length = self._entry(i)
+        return self._mm[offset:offset + code_length]
+
+    def _record(self, i: int) -> Dict[str, Optional[str]]:
+        offset, length, _ = self._entry(i)
+        values = self._mm[offset:offset + length].decode("utf-8").split(SEPARATOR)
+        return {field: value or None for field, value in zip(FIELDS, values)}
+
+    def _bisect_left(self, key: bytes) -> int:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, code: str) -> Optional[Dict[str, Optional[str]]]:
+        """The entry for a code, or None"""
+        key = normalize_code(code, self.name).encode("utf-8")
+        i = self._bisect_left(key)
+        if i < self.count and self._key(i) == key:
+            return self._record(i)
+        return None
+
+    def prefix(self, prefix: str, limit: Optional[int] = None) -> Iterator[Dict[str, Optional[str]]]:
+        """Entries whose code starts with a prefix, in code order"""
+        key = normalize_code(prefix, self.name).encode("utf-8")
+        start = self._bisect_left(key)
+        # 0xff never occurs in UTF-8, so it sorts after every code with the prefix
+        end = self._bisect_left(key + b"\xff")
+        if limit is not None:
+            end = min(end, start + limit)
+        for i in range(start, end):
+            yield self._record(i)
+
+    def count_prefix(self, prefix: str) -> int:
+        key = normalize_code(prefix, self.name).encode("utf-8")
+        return self._bisect_left(key + b"\xff") - self._bisect_left(key)
+
+def table_version(path: str) -> Optional[int]:
+    """Format version of a table file, or None if it is not one"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    magic, version, _, _ = HEADER.unpack(header)
+    return version if magic == MAGIC else None
+
+def is_current(entry: Dict[str, Optional[str]], on_date: Optional[str] = None) -> bool:
+    """Whether an entry is valid on a date (today by default)"""
+    day = on_date[:10] if on_date else date.today().isoformat()
+    return (not entry.get("valid_from") or entry["valid_from"] <= day) and \
+        (not entry.get("valid_to") or day <= entry["valid_to"])
+
+class Terminology:
+    """Code tables by system, opened lazily from the terminology directory"""
+
+    def __init__(self, directory: Optional[str] = None, complete_tables: Optional[Iterable[str]] = None):
+        """
+        Initialize the terminology registry
+
+        Args:
+            directory: Directory of <table>.codes and <table>.csv files (defaults to environment variable)
+            complete_tables: Tables holding the full code system, so a code missing
+                from them is invalid (defaults to environment variable)
+        """
+        self.directory = directory or os.environ.get("TERMINOLOGY_PATH", "data/terminology")
+        if complete_tables is None:
+            complete_tables = os.environ.get("TERMINOLOGY_COMPLETE_TABLES", "").split(",")
+        self.complete_tables = {table_name(name.strip()) for name in complete_tables if name.strip()}
+        self._tables: Dict[str, CodeTable] = {}
+        self._lock = threading.Lock()
+
+    def table(self, system: str) -> Optional[CodeTable]:
+        """
+        The table for a code system URL or table name, or None if there is none
+
+        Only opened tables are kept; a missing table is looked for again next
+        time, so one added later is picked up and unknown names cost nothing.
+        """
+        name = table_name(system)
+        table = self._tables.get(name)
+        if table is not None:
+            return table
+        with self._lock:
+            if name not in self._tables:
+                table = self._open(name)
+                if table is None:
+                    return None
+                self._tables[name] = table
+            return self._tables[name]
+
+    def _open(self, name: str) -> Optional[CodeTable]:
+        if os.sep in name or name.startswith("."):
+            return None
+        table_path = os.path.join(self.directory, f"{name}.codes")
+        csv_path = os.path.join(self.directory, f"{name}.csv")
+        try:
+            if os.path.exists(csv_path) and (not os.path.exists(table_path) or
+                                             os.path.getmtime(csv_path) > os.path.getmtime(table_path) or
+                                             table_version(table_path) != FORMAT_VERSION):
+                count = build_from_csv(csv_path, table_path)
+                logger.info(f"Built terminology table {name} with {count} codes")
+            if not os.path.exists(table_path):
+                return None
+            return CodeTable(table_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error opening terminology table {name}: {str(e)}")
+            return None
+
+    def systems(self) -> List[Dict[str, Any]]:
+        """Tables available in the directory, opened or not"""
+        names = set()
+        if os.path.isdir(self.directory):
+            names = {os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith((".codes", ".csv"))}
+        urls = {name: url for url, name in SYSTEMS.items()}
+        return [{"table": name, "system": urls.get(name), "loaded": self._tables.get(name) is not None,
+                 "complete": name in self.complete_tables}
+                for name in sorted(names)]
+
+    def lookup(self, system: str, code: str) -> Optional[Dict[str, Optional[str]]]:
+        table = self.table(system)
+        return table.lookup(code) if table else None
+
+    def display(self, system: str, code: str) -> Optional[str]:
+        entry = self.lookup(system, code)
+        return entry["display"] if entry else None
+
+    def validate(self, system: str, code: str, on_date: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Check a code against its system's table
+
+        Returns:
+            dict: known is None when the system has no table, else whether the
+            code exists; valid also requires it to be in force on the date.
+            complete says whether the table holds the whole code system, so
+            that an unknown code is really invalid rather than just unlisted
+        """
+        table = self.table(system)
+        if table is None:
+            return {"system": system, "code": code, "known": None, "valid": None, "display": None, "complete": False}
+        entry = table.lookup(code)
+        return {
+            "system": system,
+            "code": code,
+            "known": entry is not None,
+            "valid": entry is not None and is_current(entry, on_date),
+            "display": entry["display"] if entry else None,
+            "complete": table.name in self.complete_tables
+        }
+
+    def ancestors(self, system: str, code: str) -> List[Dict[str, Optional[str]]]:
+        """Parent chain of a code, nearest first"""
+        table = self.table(system)
+        chain: List[Dict[str, Optional[str]]] = []
+        entry = table.lookup(code) if table else None
+        while entry and entry.get("parent") and len(chain) < 32:
+            entry = table.lookup(entry["parent"])
+            if entry:
+                chain.append(entry)
+        return chain
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build MatchLinc terminology tables from CSV files")
+    parser.add_argument("directory", nargs="?", default=os.environ.get("TERMINOLOGY_PATH", "data/terminology"))
+    args = parser.parse_args()
+    for file_name in sorted(os.listdir(args.directory)):
+        if file_name.endswith(".csv"):
+            name = os.path.splitext(file_name)[0]
+            count = build_from_csv(os.path.join(args.directory, file_name), os.path.join(args.directory, f"{name}.codes"))
+            print(f"{name}: {count:,} codes")
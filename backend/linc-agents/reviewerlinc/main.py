@@ -1,15 +1,22 @@
 from fastapi import FastAPI, Depends, HTTPException, Body, status, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import Dict, List, Any, Optional
 import httpx
 import os
 import json
 import uvicorn
+import asyncio
 from urllib.parse import urljoin
 import logging
 from datetime import datetime
 from pydantic import BaseModel
 
+from fee_schedule_index import FeeScheduleIndex, VersionConflict
+from fee_analysis import FeeComparison
+from contract_engine import ContractEngine
+from payment_reconciliation import RemittanceIndex, RemittanceReconciler, SummaryAccumulator
+
 # Configure logging
 logging.basicConfig(
     level=logging.getLevelName(os.environ.get("LOG_LEVEL", "INFO").upper()),
@@ -33,6 +40,17 @@ PORT = int(os.environ.get("PORT", 3007))
 ENVIRONMENT = os.environ.get("ENVIRONMENT", "development")
 FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "http://fhir-gateway:8000/fhir")
 AUTH_SERVICE_URL = os.environ.get("AUTH_SERVICE_URL", "http://authlinc:3003")
+# Remittances with more payment details than this are streamed as NDJSON by default
+RECONCILE_STREAM_THRESHOLD = int(os.environ.get("RECONCILE_STREAM_THRESHOLD", "1000"))
+
+# Fee schedules indexed by payer and procedure code, reloaded when the file changes
+fee_index = FeeScheduleIndex()
+# Columnar fee comparison, rebuilt whenever the fee schedule snapshot changes
+fee_comparison = FeeComparison()
+# Contract terms compiled into per-payer rule indexes, recompiled when the files change
+contract_engine = ContractEngine()
+# Prices the claims behind each remittance detail through the contract engine
+remittance_reconciler = RemittanceReconciler(contract_engine)
 
 # Data models
 class FeeScheduleItem(BaseModel):
@@ -60,6 +78,26 @@ class ContractTerm(BaseModel):
     value: Any
     effective_date: str
     end_date: Optional[str] = None
+    category: Optional[str] = "reimbursement"
+    procedure_codes: Optional[List[str]] = None
+    code_range: Optional[List[str]] = None
+    carve_out: bool = False
+
+class ReimbursementLine(BaseModel):
+    sequence: Optional[int] = None
+    procedure_code: str
+    quantity: float = 1
+    charge: Optional[float] = None
+    paid: Optional[float] = None
+
+class ReimbursementClaim(BaseModel):
+    claim_id: Optional[str] = None
+    payer_id: str
+    date_of_service: Optional[str] = None
+    items: List[ReimbursementLine]
+
+class ReimbursementRequest(BaseModel):
+    claims: List[ReimbursementClaim]
 
 # Authentication middleware
 async def validate_token(request: Request) -> Dict[str, Any]:
@@ -108,51 +146,17 @@ async def get_fee_schedules(
     """
     Get fee schedules with optional filtering
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    # Load mock data from file
+    # Served from the in-memory index; dates were parsed when the file was loaded
+    snapshot = fee_index.current()
     try:
-        with open("data/fee_schedules.json", "r") as f:
-            fee_schedules = json.load(f)
-    except FileNotFoundError:
-        fee_schedules = []
-    
-    # Apply filters
-    if payer_id:
-        fee_schedules = [fs for fs in fee_schedules if fs.get("payer_id") == payer_id]
-    
-    if procedure_code:
-        filtered_schedules = []
-        for schedule in fee_schedules:
-            filtered_items = [item for item in schedule.get("items", []) if item.get("procedure_code") == procedure_code]
-            if filtered_items:
-                filtered_schedule = schedule.copy()
-                filtered_schedule["items"] = filtered_items
-                filtered_schedules.append(filtered_schedule)
-        fee_schedules = filtered_schedules
-    
-    if effective_date:
-        date_obj = datetime.fromisoformat(effective_date.replace("Z", "+00:00"))
-        filtered_schedules = []
-        for schedule in fee_schedules:
-            filtered_items = []
-            for item in schedule.get("items", []):
-                item_start = datetime.fromisoformat(item.get("effective_date").replace("Z", "+00:00"))
-                item_end = None
-                if item.get("end_date"):
-                    item_end = datetime.fromisoformat(item.get("end_date").replace("Z", "+00:00"))
-                
-                if item_start <= date_obj and (not item_end or date_obj <= item_end):
-                    filtered_items.append(item)
-            
-            if filtered_items:
-                filtered_schedule = schedule.copy()
-                filtered_schedule["items"] = filtered_items
-                filtered_schedules.append(filtered_schedule)
-        fee_schedules = filtered_schedules
+        fee_schedules = snapshot.query(payer_id, procedure_code, effective_date)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid effective_date: {str(e)}"
+        )
     
-    return {"fee_schedules": fee_schedules}
+    return {"fee_schedules": fee_schedules, "version": snapshot.version}
 
 @app.get("/fee-schedules/{payer_id}")
 async def get_payer_fee_schedule(
@@ -162,70 +166,110 @@ async def get_payer_fee_schedule(
     """
     Get fee schedule for a specific payer
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    try:
-        with open("data/fee_schedules.json", "r") as f:
-            fee_schedules = json.load(f)
-            for schedule in fee_schedules:
-                if schedule.get("payer_id") == payer_id:
-                    return schedule
-    except FileNotFoundError:
-        pass
-    except Exception as e:
-        logger.error(f"Error retrieving fee schedule: {str(e)}")
+    schedule = fee_index.current().by_payer.get(payer_id)
+    if schedule is not None:
+        return schedule
     
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail=f"Fee schedule for payer ID {payer_id} not found"
     )
 
+@app.get("/fee-schedules/{payer_id}/fee")
+async def get_procedure_fee(
+    payer_id: str,
+    procedure_code: str,
+    date_of_service: Optional[str] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Get the fee in force for a payer and procedure code on a date of service (default today)
+    """
+    date_of_service = date_of_service or datetime.now().date().isoformat()
+    try:
+        item = fee_index.current().fee(payer_id, procedure_code, date_of_service)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid date_of_service: {str(e)}"
+        )
+    
+    if item is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No fee for procedure {procedure_code} with payer ID {payer_id} on {date_of_service}"
+        )
+    return item
+
+@app.post("/admin/fee-schedules/reload")
+async def reload_fee_schedules(
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Reload fee schedules from disk without waiting for the change check
+    """
+    try:
+        snapshot = fee_index.load()
+    except Exception as e:
+        logger.error(f"Error reloading fee schedules: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error reloading fee schedules: {str(e)}"
+        )
+    
+    return {
+        "status": "reloaded",
+        "version": snapshot.version,
+        "schedules": len(snapshot.schedules),
+        "procedure_entries": len(snapshot.intervals),
+        "loaded_at": fee_index.loaded_at
+    }
+
 @app.put("/fee-schedules/{payer_id}")
 async def update_fee_schedule(
     payer_id: str,
     fee_update: FeeScheduleUpdate,
+    version: Optional[int] = Query(None, description="Reject the update unless the schedules are still at this version"),
     user_data: Dict = Depends(validate_token)
 ):
     """
     Update a fee schedule
     """
-    # In a real implementation, this would update a database
-    # This is a mock implementation for demonstration
-    
-    try:
-        with open("data/fee_schedules.json", "r") as f:
-            fee_schedules = json.load(f)
-        
-        schedule_updated = False
-        for i, schedule in enumerate(fee_schedules):
-            if schedule.get("payer_id") == payer_id:
-                # Update existing schedule
-                fee_schedules[i]["items"] = [item.dict() for item in fee_update.items]
-                fee_schedules[i]["last_updated"] = fee_update.update_date
-                fee_schedules[i]["updated_by"] = fee_update.updated_by or user_data.get("email")
-                fee_schedules[i]["update_reason"] = fee_update.update_reason
-                schedule_updated = True
-                break
-        
-        if not schedule_updated:
-            # Create new schedule
+    def build(schedule: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # A new schedule dict; the one in the published snapshot is never mutated
+        if schedule is not None:
+            new_schedule = dict(schedule)
+        else:
             new_schedule = {
                 "payer_id": payer_id,
-                "payer_name": fee_update.items[0].payer_name if fee_update.items else "Unknown Payer",
-                "items": [item.dict() for item in fee_update.items],
-                "last_updated": fee_update.update_date,
-                "updated_by": fee_update.updated_by or user_data.get("email"),
-                "update_reason": fee_update.update_reason
+                "payer_name": fee_update.items[0].payer_name if fee_update.items else "Unknown Payer"
             }
-            fee_schedules.append(new_schedule)
-        
-        # Save updated data
-        with open("data/fee_schedules.json", "w") as f:
-            json.dump(fee_schedules, f, indent=2)
+        new_schedule["items"] = [item.dict() for item in fee_update.items]
+        new_schedule["last_updated"] = fee_update.update_date
+        new_schedule["updated_by"] = fee_update.updated_by or user_data.get("email")
+        new_schedule["update_reason"] = fee_update.update_reason
+        return new_schedule
+    
+    try:
+        # Builds and persists the next snapshot off the event loop; readers keep the current one
+        snapshot = await asyncio.to_thread(fee_index.update, payer_id, build, version)
         
-        return {"status": "success", "message": f"Fee schedule for payer ID {payer_id} updated successfully"}
+        return {
+            "status": "success",
+            "message": f"Fee schedule for payer ID {payer_id} updated successfully",
+            "version": snapshot.version
+        }
     
+    except VersionConflict as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Fee schedules changed since version {version}; current version is {e.current_version}"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid fee schedule: {str(e)}"
+        )
     except Exception as e:
         logger.error(f"Error updating fee schedule: {str(e)}")
         raise HTTPException(
@@ -242,14 +286,7 @@ async def get_contracts(
     """
     Get payer contracts
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    try:
-        with open("data/contracts.json", "r") as f:
-            contracts = json.load(f)
-    except FileNotFoundError:
-        contracts = []
+    contracts = contract_engine.current().contracts
     
     # Apply filters
     if payer_id:
@@ -268,17 +305,9 @@ async def get_contract_details(
     """
     Get details for a specific contract
     """
-    # In a real implementation, this would query a database
-    # This is a mock implementation for demonstration
-    
-    try:
-        with open("data/contracts.json", "r") as f:
-            contracts = json.load(f)
-            for contract in contracts:
-                if contract.get("id") == contract_id:
-                    return contract
-    except FileNotFoundError:
-        pass
+    contract = contract_engine.current().by_id.get(contract_id)
+    if contract is not None:
+        return contract
     
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -294,23 +323,9 @@ async def add_contract_term(
     """
     Add a term to a contract
     """
-    # In a real implementation, this would update a database
-    # This is a mock implementation for demonstration
-    
     try:
-        with open("data/contracts.json", "r") as f:
-            contracts = json.load(f)
-        
-        contract_found = False
-        for i, contract in enumerate(contracts):
-            if contract.get("id") == contract_id:
-                # Add term to contract
-                if "terms" not in contract:
-                    contracts[i]["terms"] = []
-                
-                contracts[i]["terms"].append(term.dict())
-                contract_found = True
-                break
+        # Persisted atomically and recompiled into the rule index
+        contract_found = await asyncio.to_thread(contract_engine.add_term, contract_id, term.dict(exclude_none=True))
         
         if not contract_found:
             raise HTTPException(
@@ -318,14 +333,15 @@ async def add_contract_term(
                 detail=f"Contract with ID {contract_id} not found"
             )
         
-        # Save updated data
-        with open("data/contracts.json", "w") as f:
-            json.dump(contracts, f, indent=2)
-        
         return {"status": "success", "message": f"Term added to contract {contract_id} successfully"}
     
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     except Exception as e:
         logger.error(f"Error adding contract term: {str(e)}")
         raise HTTPException(
@@ -333,89 +349,154 @@ async def add_contract_term(
             detail=f"Error adding contract term: {str(e)}"
         )
 
+@app.post("/reimbursement/expected")
+async def expected_reimbursement(
+    request: ReimbursementRequest,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Compute expected reimbursement for every line of a batch of claims
+
+    Lines with a paid amount are compared with the expected amount and flagged
+    when underpaid.
+    """
+    try:
+        results = contract_engine.evaluate([claim.dict() for claim in request.claims], fee_index.current())
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid claim: {str(e)}"
+        )
+    
+    return {
+        "claims": results,
+        "summary": {
+            "claims": len(results),
+            "expected_total": round(sum(r["expected_total"] for r in results), 2),
+            "underpaid_claims": sum(1 for r in results if r.get("underpaid")),
+            "unpriced_lines": sum(r["unpriced_lines"] for r in results)
+        }
+    }
+
+@app.post("/reimbursement/reconcile")
+async def reconcile_remittance(
+    document: Dict[str, Any] = Body(...),
+    payer_id: Optional[str] = None,
+    stream: Optional[bool] = None,
+    user_data: Dict = Depends(validate_token)
+):
+    """
+    Reconcile a PaymentReconciliation against expected reimbursement
+
+    Accepts a PaymentReconciliation, a bundle containing one, or
+    {"payment_reconciliation": ..., "claims": [...]} where claims are FHIR
+    Claim/ClaimResponse resources or bundles, or claims in the
+    /reimbursement/expected format. Each payment detail is joined to its claim
+    and every line priced, giving variance per claim and per line. Large
+    remittances (or stream=true) are returned as NDJSON, one detail per line
+    followed by the summary.
+    """
+    if document.get("resourceType"):
+        documents, flattened = [document], []
+    else:
+        claims = document.get("claims") or []
+        documents = [document.get("payment_reconciliation")] + [c for c in claims if isinstance(c, dict) and c.get("resourceType")]
+        flattened = [c for c in claims if isinstance(c, dict) and not c.get("resourceType")]
+    
+    remittance = RemittanceIndex(documents)
+    remittance.add_claims(flattened)
+    if not remittance.reconciliations:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No PaymentReconciliation resource found"
+        )
+    
+    fee_schedules = fee_index.current()
+    results = remittance_reconciler.reconcile(remittance, fee_schedules, payer_id=payer_id)
+    summary = SummaryAccumulator(remittance.reconciliations)
+    
+    if stream is None:
+        stream = sum(len(r.get("detail", [])) for r in remittance.reconciliations) > RECONCILE_STREAM_THRESHOLD
+    
+    if stream:
+        def generate():
+            try:
+                for result in results:
+                    summary.add(result)
+                    yield json.dumps(result) + "\n"
+            except ValueError as e:
+                # Headers are already sent, so report the error in the stream
+                yield json.dumps({"error": f"Invalid claim: {str(e)}"}) + "\n"
+                return
+            yield json.dumps({"summary": summary.summary()}) + "\n"
+        
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+    
+    try:
+        details = await asyncio.to_thread(list, results)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid claim: {str(e)}"
+        )
+    
+    for result in details:
+        summary.add(result)
+    return {
+        "details": details,
+        "summary": summary.summary()
+    }
+
 @app.get("/analysis/fee-comparison")
 async def analyze_fee_comparison(
     payer_id: Optional[str] = None,
     benchmark: Optional[str] = Query("medicare", enum=["medicare", "average", "top_payer"]),
+    as_of: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=10000),
     user_data: Dict = Depends(validate_token)
 ):
     """
     Analyze and compare fee schedules against benchmarks
     """
-    # In a real implementation, this would perform actual analysis
-    # This is a mock implementation for demonstration
+    renewal_dates = {c.get("payer_id"): c.get("end_date") for c in contract_engine.current().contracts if c.get("end_date")}
     
-    analysis_result = {
-        "benchmark_type": benchmark,
-        "analysis_date": datetime.now().isoformat(),
-        "overall_comparison": {
-            "average_difference_percentage": -5.2,
-            "highest_difference_percentage": 15.8,
-            "lowest_difference_percentage": -25.3,
-        },
-        "potential_revenue_impact": {
-            "monthly": 12500.00,
-            "annual": 150000.00,
-            "notes": "Based on current procedure volume and payer mix"
-        },
-        "procedure_analysis": [
-            {
-                "procedure_code": "99213",
-                "description": "Office/outpatient visit est",
-                "your_fee": 78.50,
-                "benchmark_fee": 82.53,
-                "difference_percentage": -4.9,
-                "volume_last_month": 320,
-                "revenue_impact": -1289.60
-            },
-            {
-                "procedure_code": "99214",
-                "description": "Office/outpatient visit est",
-                "your_fee": 110.00,
-                "benchmark_fee": 120.15,
-                "difference_percentage": -8.4,
-                "volume_last_month": 150,
-                "revenue_impact": -1522.50
-            },
-            {
-                "procedure_code": "99396",
-                "description": "Preventive visit est, 40-64 years",
-                "your_fee": 130.00,
-                "benchmark_fee": 125.42,
-                "difference_percentage": 3.7,
-                "volume_last_month": 45,
-                "revenue_impact": 206.10
-            }
-        ],
-        "payer_analysis": [
-            {
-                "payer_id": "BCBS001",
-                "payer_name": "BlueCross BlueShield",
-                "average_difference_percentage": -2.8,
-                "contract_renewal_date": "2025-09-15",
-                "negotiation_opportunity": "Medium"
-            },
-            {
-                "payer_id": "AETNA001",
-                "payer_name": "Aetna",
-                "average_difference_percentage": -7.5,
-                "contract_renewal_date": "2025-06-30",
-                "negotiation_opportunity": "High"
-            },
-            {
-                "payer_id": "MCARE001",
-                "payer_name": "Medicare",
-                "average_difference_percentage": 0.0,
-                "contract_renewal_date": "N/A",
-                "negotiation_opportunity": "None"
-            }
-        ],
-        "recommendations": [
-            "Focus negotiation efforts on Aetna with renewal approaching in 45 days",
-            "Consider raising fees for preventive services which are currently above benchmark",
-            "Review high-volume E&M codes which are significantly below benchmark"
-        ]
-    }
+    try:
+        # Off the event loop: the first analysis after a schedule change rebuilds the fee arrays
+        analysis_result = await asyncio.to_thread(
+            fee_comparison.analyze,
+            fee_index.current(),
+            benchmark=benchmark,
+            payer_id=payer_id,
+            as_of=as_of,
+            renewal_dates=renewal_dates,
+            limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    
+    below_benchmark = [p for p in analysis_result["procedure_analysis"] if (p["revenue_impact"] or 0) < 0]
+    above_benchmark = [p for p in analysis_result["procedure_analysis"] if (p["difference_percentage"] or 0) > 0]
+    opportunities = sorted(
+        (p for p in analysis_result["payer_analysis"] if p["average_difference_percentage"] is not None),
+        key=lambda p: p["average_difference_percentage"]
+    )
+    analysis_result["recommendations"] = []
+    if opportunities and opportunities[0]["negotiation_opportunity"] in ("High", "Medium"):
+        analysis_result["recommendations"].append(
+            f"Focus negotiation efforts on {opportunities[0]['payer_name']} "
+            f"(renewal {opportunities[0]['contract_renewal_date']})"
+        )
+    if above_benchmark:
+        analysis_result["recommendations"].append(
+            f"Protect rates for {', '.join(p['procedure_code'] for p in above_benchmark[:3])} which are currently above benchmark"
+        )
+    if below_benchmark:
+        analysis_result["recommendations"].append(
+            f"Review high-volume codes {', '.join(p['procedure_code'] for p in below_benchmark[:3])} which are below benchmark"
+        )
     
     if payer_id:
         # Filter analysis to specific payer
@@ -426,13 +507,6 @@ async def analyze_fee_comparison(
                 break
         
         if filtered_payer:
-            analysis_result["payer_analysis"] = [filtered_payer]
-            analysis_result["overall_comparison"] = {
-                "average_difference_percentage": filtered_payer["average_difference_percentage"],
-                "highest_difference_percentage": filtered_payer["average_difference_percentage"] + 5,
-                "lowest_difference_percentage": filtered_payer["average_difference_percentage"] - 10,
-            }
-            
             # Adjust recommendations for specific payer
             if filtered_payer["negotiation_opportunity"] == "High":
                 analysis_result["recommendations"] = [
@@ -453,7 +527,6 @@ async def analyze_fee_comparison(
                     "Prepare for future negotiations by collecting outcomes data"
                 ]
         else:
-            analysis_result["payer_analysis"] = []
             analysis_result["recommendations"] = [f"No data available for payer ID {payer_id}"]
     
     return analysis_result
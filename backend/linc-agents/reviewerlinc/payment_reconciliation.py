@@ -0,0 +1,290 @@
+"""
+Remittance reconciliation for ReviewerLinc
+Joins the details of an NPHIES PaymentReconciliation against the claims they
+pay and prices every claim line through the contract engine and fee schedule
+index, so a whole remittance is checked in one pass instead of item by item.
+
+Claims and ClaimResponses are taken from the same bundle or supplied alongside
+it; each is indexed once by claim identifier before the details are walked.
+"""
+
+import logging
+from typing import Dict, List, Any, Optional, Iterable, Iterator, Tuple
+
+from fee_schedule_index import FeeScheduleSnapshot
+
+logger = logging.getLogger("reviewerlinc.reconciliation")
+
+NPHIES_EXTENSION = "http://nphies.sa/fhir/ksa/nphies-fs/StructureDefinition/extension-"
+
+# Detail payment components reported by NPHIES, keyed by extension suffix
+COMPONENTS = {
+    "component-payment": "payment",
+    "component-early-fee": "early_fee",
+    "component-nphies-fee": "nphies_fee",
+}
+
+def iter_resources(documents: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+    """Every FHIR resource in a mix of bundles, bare resources and lists of either"""
+    for document in documents:
+        if isinstance(document, list):
+            yield from iter_resources(document)
+        elif isinstance(document, dict):
+            if document.get("resourceType") == "Bundle":
+                yield from iter_resources(entry.get("resource") for entry in document.get("entry", []))
+            elif document.get("resourceType"):
+                yield document
+
+def coding_code(concept: Optional[Dict[str, Any]]) -> Optional[str]:
+    codings = (concept or {}).get("coding") or []
+    return codings[0].get("code") if codings else None
+
+def money(value: Optional[Dict[str, Any]]) -> Optional[float]:
+    return float(value["value"]) if value and value.get("value") is not None else None
+
+def extension_money(element: Dict[str, Any], suffix: str) -> Optional[float]:
+    for extension in element.get("extension", []):
+        if extension.get("url") == NPHIES_EXTENSION + suffix:
+            return money(extension.get("valueMoney"))
+    return None
+
+def reference_key(reference: Optional[Dict[str, Any]]) -> Optional[str]:
+    """The claim key of a Reference: its identifier value, else the id in its literal reference"""
+    if not reference:
+        return None
+    identifier = reference.get("identifier") or {}
+    if identifier.get("value"):
+        return str(identifier["value"])
+    if reference.get("reference"):
+        return reference["reference"].rstrip("/").rsplit("/", 1)[-1]
+    return None
+
+def resource_keys(resource: Dict[str, Any]) -> List[str]:
+    """Every key a detail may use to point at a resource: identifier values, then the id"""
+    keys = [str(identifier["value"]) for identifier in resource.get("identifier", []) if identifier.get("value")]
+    if resource.get("id"):
+        keys.append(str(resource["id"]))
+    return keys
+
+class OrganizationIndex:
+    """Payer identifiers of the Organizations in a bundle, by literal reference id"""
+
+    def __init__(self):
+        self.by_id: Dict[str, str] = {}
+
+    def add(self, organization: Dict[str, Any]) -> None:
+        identifiers = organization.get("identifier") or []
+        if organization.get("id") and identifiers and identifiers[0].get("value"):
+            self.by_id[str(organization["id"])] = str(identifiers[0]["value"])
+
+    def payer_id(self, reference: Optional[Dict[str, Any]]) -> Optional[str]:
+        if not reference:
+            return None
+        if (reference.get("identifier") or {}).get("value"):
+            return str(reference["identifier"]["value"])
+        # A literal reference only names a payer if the Organization is in the bundle
+        return self.by_id.get(reference_key(reference))
+
+def claim_lines(claim: Dict[str, Any], fee_schedules: FeeScheduleSnapshot, payer_id: Optional[str]) -> List[Dict[str, Any]]:
+    """Claim items as contract engine lines"""
+    lines = []
+    for item in claim.get("item", []):
+        codes = [coding.get("code") for coding in (item.get("productOrService") or {}).get("coding", []) if coding.get("code")]
+        # Claims carry the NPHIES code and the provider's own code; price whichever the payer's schedule lists
+        code = next((code for code in codes if (payer_id, code) in fee_schedules.intervals), codes[0] if codes else "")
+        quantity = (item.get("quantity") or {}).get("value") or 1
+        unit_price = money(item.get("unitPrice"))
+        charge = unit_price * quantity * float(item.get("factor") or 1) if unit_price is not None else money(item.get("net"))
+        lines.append({
+            "sequence": item.get("sequence"),
+            "procedure_code": code,
+            "quantity": quantity,
+            "charge": charge,
+            "date_of_service": item.get("servicedDate") or (item.get("servicedPeriod") or {}).get("start")
+        })
+    return lines
+
+def line_payments(claim_response: Dict[str, Any]) -> Dict[Any, float]:
+    """Benefit paid per item sequence of a ClaimResponse"""
+    paid = {}
+    for item in claim_response.get("item", []):
+        for adjudication in item.get("adjudication", []):
+            if coding_code(adjudication.get("category")) == "benefit" and adjudication.get("amount"):
+                paid[item.get("itemSequence")] = money(adjudication["amount"])
+    return paid
+
+class RemittanceIndex:
+    """Claims, ClaimResponses and payer Organizations of a remittance, indexed once"""
+
+    def __init__(self, documents: Iterable[Any]):
+        self.reconciliations: List[Dict[str, Any]] = []
+        self.claims: Dict[str, Dict[str, Any]] = {}
+        self.responses: Dict[str, Dict[str, Any]] = {}
+        self.organizations = OrganizationIndex()
+
+        for resource in iter_resources(documents):
+            resource_type = resource.get("resourceType")
+            if resource_type == "PaymentReconciliation":
+                self.reconciliations.append(resource)
+            elif resource_type == "Claim":
+                for key in resource_keys(resource):
+                    self.claims.setdefault(key, resource)
+            elif resource_type == "ClaimResponse":
+                key = reference_key(resource.get("request"))
+                if key:
+                    self.responses.setdefault(key, resource)
+            elif resource_type == "Organization":
+                self.organizations.add(resource)
+
+    def add_claims(self, claims: Iterable[Dict[str, Any]]) -> None:
+        """Claims already flattened to the /reimbursement/expected format, keyed by claim_id"""
+        for claim in claims:
+            if claim.get("claim_id"):
+                self.claims.setdefault(str(claim["claim_id"]), claim)
+
+def reconciliation_details(reconciliation: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Payment details of a PaymentReconciliation with their amounts and payment components"""
+    for position, detail in enumerate(reconciliation.get("detail", [])):
+        components = {name: extension_money(detail, suffix) for suffix, name in COMPONENTS.items()}
+        amount = money(detail.get("amount"))
+        yield {
+            "detail": position,
+            "type": coding_code(detail.get("type")),
+            "claim_id": reference_key(detail.get("request")),
+            "claim_response_id": reference_key(detail.get("response")),
+            "date": detail.get("date"),
+            "amount": amount,
+            # The adjudicated payment before early-payment and NPHIES fees are deducted
+            "paid": components["payment"] if components["payment"] is not None else amount,
+            "components": {name: value for name, value in components.items() if value is not None}
+        }
+
+class RemittanceReconciler:
+    """Prices the claims behind each payment detail and reports variance per claim and line"""
+
+    def __init__(self, engine, batch_size: int = 500):
+        """
+        Initialize the reconciler
+
+        Args:
+            engine: ContractEngine used to price claim lines
+            batch_size: Claims priced per call into the engine
+        """
+        self.engine = engine
+        self.batch_size = batch_size
+
+    def _claim(self, remittance: RemittanceIndex, detail: Dict[str, Any], fee_schedules: FeeScheduleSnapshot,
+               payer_id: Optional[str], issuer_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        # The payer is the one requested, else the claim's insurer, else the remittance issuer
+        claim = remittance.claims.get(detail["claim_id"])
+        if claim is None:
+            return None
+        if claim.get("resourceType") != "Claim":
+            # Already in /reimbursement/expected format
+            return dict(claim, payer_id=payer_id or claim.get("payer_id") or issuer_id)
+
+        claim_payer = payer_id or remittance.organizations.payer_id(claim.get("insurer")) or issuer_id
+        lines = claim_lines(claim, fee_schedules, claim_payer)
+        response = remittance.responses.get(detail["claim_id"])
+        if response is not None:
+            paid = line_payments(response)
+            for line in lines:
+                if line["sequence"] in paid:
+                    line["paid"] = paid[line["sequence"]]
+        return {
+            "claim_id": detail["claim_id"],
+            "payer_id": claim_payer,
+            "date_of_service": next((line["date_of_service"] for line in lines if line["date_of_service"]), None)
+                or (claim.get("billablePeriod") or {}).get("start") or claim.get("created"),
+            "items": lines
+        }
+
+    def reconcile(self, remittance: RemittanceIndex, fee_schedules: FeeScheduleSnapshot,
+                  payer_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        One result per payment detail, in remittance order
+
+        Details for claims that are not available are reported as unmatched;
+        advance payments and other details without a claim as unallocated.
+        """
+        batch: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        for reconciliation in remittance.reconciliations:
+            issuer_id = remittance.organizations.payer_id(reconciliation.get("paymentIssuer"))
+            for detail in reconciliation_details(reconciliation):
+                detail["payment_reconciliation_id"] = reconciliation.get("id")
+                claim = self._claim(remittance, detail, fee_schedules, payer_id, issuer_id) if detail["claim_id"] else None
+                if claim is None:
+                    # Flush priced claims first to keep remittance order
+                    yield from self._price(batch, fee_schedules)
+                    batch = []
+                    yield self._unpriced(detail)
+                    continue
+                batch.append((detail, claim))
+                if len(batch) >= self.batch_size:
+                    yield from self._price(batch, fee_schedules)
+                    batch = []
+        yield from self._price(batch, fee_schedules)
+
+    @staticmethod
+    def _unpriced(detail: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(detail, status="unmatched" if detail["claim_id"] else "unallocated")
+
+    def _price(self, batch: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+               fee_schedules: FeeScheduleSnapshot) -> Iterator[Dict[str, Any]]:
+        if not batch:
+            return
+        results = self.engine.evaluate([claim for _, claim in batch], fee_schedules)
+        for (detail, _), result in zip(batch, results):
+            result.pop("paid_total", None)
+            expected = result["expected_total"]
+            claim_result = dict(detail, status=result["pricing"], **result)
+            # The remitted claim payment, not the sum of line benefits, decides the
+            # claim variance; it also pays unpriced lines, so only for priced claims
+            if detail["paid"] is not None and result["pricing"] == "priced":
+                claim_result["variance"] = round(detail["paid"] - expected, 2)
+                claim_result["underpaid"] = self.engine.is_underpaid(detail["paid"], expected)
+            yield claim_result
+
+class SummaryAccumulator:
+    """Running remittance totals, so streamed results need not be kept"""
+
+    def __init__(self, reconciliations: List[Dict[str, Any]]):
+        self.reconciliations = reconciliations
+        self.counts = {"details": 0, "priced_claims": 0, "partially_priced_claims": 0, "unpriced_claims": 0,
+                       "unmatched_details": 0, "unallocated_details": 0,
+                       "underpaid_claims": 0, "underpaid_lines": 0, "unpriced_lines": 0}
+        self.paid = self.expected = 0.0
+
+    def add(self, result: Dict[str, Any]) -> None:
+        self.counts["details"] += 1
+        if result["status"] in ("unmatched", "unallocated"):
+            self.counts[f"{result['status']}_details"] += 1
+            return
+        self.counts[f"{result['status']}_claims"] += 1
+        self.counts["underpaid_lines"] += sum(1 for line in result["items"] if line.get("underpaid"))
+        self.counts["unpriced_lines"] += result["unpriced_lines"]
+        if result["status"] != "priced":
+            # Their expected totals leave out unpriced lines the payment covers
+            return
+        self.paid += result["paid"] or 0
+        self.expected += result["expected_total"]
+        self.counts["underpaid_claims"] += 1 if result.get("underpaid") else 0
+
+    def summary(self) -> Dict[str, Any]:
+        reconciliations = self.reconciliations
+        return {
+            "payment_reconciliations": [r.get("id") for r in reconciliations],
+            "payment_amount": round(sum(money(r.get("paymentAmount")) or 0 for r in reconciliations), 2),
+            "details": self.counts["details"],
+            "priced_claims": self.counts["priced_claims"],
+            "partially_priced_claims": self.counts["partially_priced_claims"],
+            "unpriced_claims": self.counts["unpriced_claims"],
+            "unmatched_details": self.counts["unmatched_details"],
+            "unallocated_details": self.counts["unallocated_details"],
+            "paid_total": round(self.paid, 2),
+            "expected_total": round(self.expected, 2),
+            "variance": round(self.paid - self.expected, 2),
+            "underpaid_claims": self.counts["underpaid_claims"],
+            "underpaid_lines": self.counts["underpaid_lines"],
+            "unpriced_lines": self.counts["unpriced_lines"]
+        }
@@ -7,6 +7,7 @@ It routes NPHIES messages to appropriate agents and handles bidirectional commun
 
 import asyncio
 import aiohttp
+import json
 import logging
 from typing import Dict, Any, Optional, List
 from datetime import datetime
@@ -18,11 +19,20 @@ from models import (
     NphiesPatient,
     NphiesClaim,
     NphiesCoverageEligibilityRequest,
-    NphiesCommunicationRequest
+    NphiesCommunicationRequest,
+    NphiesReference
 )
 
 logger = logging.getLogger(__name__)
 
+def reference_id(reference: Optional[NphiesReference]) -> Optional[str]:
+    """ID of the resource a reference points to, e.g. the insurer of a claim"""
+    if reference is None:
+        return None
+    if reference.reference:
+        return reference.reference.rsplit("/", 1)[-1]
+    return reference.identifier.value if reference.identifier else None
+
 class AgentType(str, Enum):
     """HealthLinc Agent Types"""
     CLAIMLINC = "claimlinc"
@@ -60,15 +70,15 @@ class NphiesAgentRouter:
             NphiesMessageType.PAYMENT_RECONCILIATION: [AgentType.CLAIMLINC, AgentType.REVIEWERLINC]
         }
     
-    async def route_message(self, extracted_data: NphiesExtractedData) -> Dict[str, Any]:
-        """Route NPHIES message to appropriate agents"""
+    async def route_message(self, extracted_data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
+        """Route NPHIES message to appropriate agents, forwarding the caller's bearer token"""
         agents = self.routing_map.get(extracted_data.message_type, [AgentType.RECORDLINC])
         results = {}
         
         # Process with multiple agents concurrently
         tasks = []
         for agent in agents:
-            task = self._process_with_agent(agent, extracted_data)
+            task = self._process_with_agent(agent, extracted_data, auth_token)
             tasks.append(task)
         
         agent_results = await asyncio.gather(*tasks, return_exceptions=True)
@@ -87,25 +97,25 @@ class NphiesAgentRouter:
             "timestamp": datetime.now().isoformat()
         }
     
-    async def _process_with_agent(self, agent: AgentType, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_agent(self, agent: AgentType, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process data with specific agent"""
         try:
             if agent == AgentType.CLAIMLINC:
-                return await self._process_with_claimlinc(data)
+                return await self._process_with_claimlinc(data, auth_token)
             elif agent == AgentType.RECORDLINC:
-                return await self._process_with_recordlinc(data)
+                return await self._process_with_recordlinc(data, auth_token)
             elif agent == AgentType.AUTHLINC:
-                return await self._process_with_authlinc(data)
+                return await self._process_with_authlinc(data, auth_token)
             elif agent == AgentType.NOTIFYLINC:
-                return await self._process_with_notifylinc(data)
+                return await self._process_with_notifylinc(data, auth_token)
             elif agent == AgentType.DOCULINC:
-                return await self._process_with_doculinc(data)
+                return await self._process_with_doculinc(data, auth_token)
             elif agent == AgentType.MATCHLINC:
-                return await self._process_with_matchlinc(data)
+                return await self._process_with_matchlinc(data, auth_token)
             elif agent == AgentType.REVIEWERLINC:
-                return await self._process_with_reviewerlinc(data)
+                return await self._process_with_reviewerlinc(data, auth_token)
             elif agent == AgentType.CLAIMTRACKERLINC:
-                return await self._process_with_claimtrackerlinc(data)
+                return await self._process_with_claimtrackerlinc(data, auth_token)
             else:
                 return {"status": "error", "message": f"Unknown agent: {agent}"}
                 
@@ -113,14 +123,22 @@ class NphiesAgentRouter:
             logger.error(f"Error processing with agent {agent}: {str(e)}")
             return {"status": "error", "message": str(e)}
     
-    async def _make_agent_request(self, agent: AgentType, endpoint: str, task: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        """Make HTTP request to agent"""
-        url = f"{self.base_urls[agent]}/{endpoint}"
+    def _agent_headers(self, task: str, auth_token: Optional[str] = None) -> Dict[str, str]:
+        """Request headers for an agent call, with the caller's bearer token when there is one"""
         headers = {
             "X-MCP-Task": task,
             "X-Request-ID": str(datetime.now().timestamp()),
             "Content-Type": "application/json"
         }
+        if auth_token:
+            headers["Authorization"] = f"Bearer {auth_token}"
+        return headers
+    
+    async def _make_agent_request(self, agent: AgentType, endpoint: str, task: str, payload: Dict[str, Any],
+                                  auth_token: Optional[str] = None) -> Dict[str, Any]:
+        """Make HTTP request to agent"""
+        url = f"{self.base_urls[agent]}/{endpoint}"
+        headers = self._agent_headers(task, auth_token)
         
         async with aiohttp.ClientSession() as session:
             async with session.post(url, json=payload, headers=headers, timeout=30) as response:
@@ -130,7 +148,22 @@ class NphiesAgentRouter:
                     error_text = await response.text()
                     raise Exception(f"Agent request failed: {response.status} - {error_text}")
     
-    async def _process_with_claimlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _stream_agent_request(self, agent: AgentType, endpoint: str, task: str, payload: Dict[str, Any],
+                                    auth_token: Optional[str] = None):
+        """Make HTTP request to agent and yield the records of its NDJSON response as they arrive"""
+        url = f"{self.base_urls[agent]}/{endpoint}"
+        headers = self._agent_headers(task, auth_token)
+        
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=None, sock_read=30)) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise Exception(f"Agent request failed: {response.status} - {error_text}")
+                async for line in response.content:
+                    if line.strip():
+                        yield json.loads(line)
+    
+    async def _process_with_claimlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with ClaimLinc agent"""
         if not data.claims:
             return {"status": "skipped", "reason": "No claims found"}
@@ -159,7 +192,8 @@ class NphiesAgentRouter:
                     AgentType.CLAIMLINC, 
                     "agents/claim", 
                     task, 
-                    claim_payload
+                    claim_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e:
@@ -167,7 +201,7 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "claims": results}
     
-    async def _process_with_recordlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_recordlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with RecordLinc agent"""
         if not data.patients:
             return {"status": "skipped", "reason": "No patients found"}
@@ -203,7 +237,8 @@ class NphiesAgentRouter:
                     AgentType.RECORDLINC, 
                     "agents/record", 
                     "create", 
-                    patient_payload
+                    patient_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e:
@@ -211,7 +246,7 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "patients": results}
     
-    async def _process_with_authlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_authlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with AuthLinc agent"""
         results = []
         
@@ -231,7 +266,8 @@ class NphiesAgentRouter:
                     AgentType.AUTHLINC, 
                     "agents/auth", 
                     "validate", 
-                    auth_payload
+                    auth_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e:
@@ -254,7 +290,8 @@ class NphiesAgentRouter:
                         AgentType.AUTHLINC, 
                         "agents/auth", 
                         "preauth", 
-                        auth_payload
+                        auth_payload,
+                        auth_token
                     )
                     results.append(result)
                 except Exception as e:
@@ -262,7 +299,7 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "authorizations": results}
     
-    async def _process_with_notifylinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_notifylinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with NotifyLinc agent"""
         results = []
         
@@ -283,7 +320,8 @@ class NphiesAgentRouter:
                     AgentType.NOTIFYLINC, 
                     "agents/notify", 
                     "send", 
-                    notification_payload
+                    notification_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e:
@@ -291,7 +329,7 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "notifications": results}
     
-    async def _process_with_doculinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_doculinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with DocuLinc agent"""
         results = []
         
@@ -313,7 +351,8 @@ class NphiesAgentRouter:
                         AgentType.DOCULINC, 
                         "agents/document", 
                         "enhance", 
-                        doc_payload
+                        doc_payload,
+                        auth_token
                     )
                     results.append(result)
                 except Exception as e:
@@ -321,37 +360,38 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "documentation": results}
     
-    async def _process_with_matchlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_matchlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with MatchLinc agent"""
-        results = []
+        if not data.claims:
+            return {"status": "skipped", "reason": "No claims found"}
         
-        # Process diagnosis-procedure matching
-        for claim in data.claims:
-            match_payload = {
+        # Every claim goes to MatchLinc in a single batch request
+        batch_payload = {
+            "claims": [{
                 "claim_id": claim.id,
-                "patient_id": claim.patient.get("reference", "").replace("Patient/", ""),
-                "diagnosis_codes": [d.get("diagnosisCodeableConcept", {}).get("coding", [{}])[0].get("code", "") 
-                                 for d in claim.diagnosis],
-                "procedure_codes": [item.get("productOrService", {}).get("coding", [{}])[0].get("code", "") 
-                                  for item in claim.items],
-                "claim_type": claim.type.get("coding", [{}])[0].get("code", ""),
-                "service_date": claim.created
-            }
-            
-            try:
-                result = await self._make_agent_request(
-                    AgentType.MATCHLINC, 
-                    "agents/match", 
-                    "validate", 
-                    match_payload
-                )
-                results.append(result)
-            except Exception as e:
-                results.append({"status": "error", "claim_id": claim.id, "error": str(e)})
+                "payer_id": reference_id(claim.insurer),
+                "diagnosis_codes": [code for code in (d.get("diagnosisCodeableConcept", {}).get("coding", [{}])[0].get("code", "")
+                                                      for d in claim.diagnosis or []) if code],
+                "procedure_codes": [code for code in (item.get("productOrService", {}).get("coding", [{}])[0].get("code", "")
+                                                      for item in claim.item or []) if code]
+            } for claim in data.claims]
+        }
+        
+        results = []
+        summary = None
+        try:
+            async for record in self._stream_agent_request(AgentType.MATCHLINC, "validate/batch", "validate", batch_payload,
+                                                          auth_token):
+                if "summary" in record:
+                    summary = record["summary"]
+                else:
+                    results.append(record)
+        except Exception as e:
+            return {"status": "error", "message": str(e), "validations": results}
         
-        return {"status": "processed", "validations": results}
+        return {"status": "processed", "validations": results, "summary": summary}
     
-    async def _process_with_reviewerlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_reviewerlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with ReviewerLinc agent"""
         results = []
         
@@ -375,7 +415,8 @@ class NphiesAgentRouter:
                     AgentType.REVIEWERLINC, 
                     "agents/review", 
                     "fee_schedule", 
-                    review_payload
+                    review_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e:
@@ -383,7 +424,7 @@ class NphiesAgentRouter:
         
         return {"status": "processed", "reviews": results}
     
-    async def _process_with_claimtrackerlinc(self, data: NphiesExtractedData) -> Dict[str, Any]:
+    async def _process_with_claimtrackerlinc(self, data: NphiesExtractedData, auth_token: Optional[str] = None) -> Dict[str, Any]:
         """Process with ClaimTrackerLinc agent"""
         results = []
         
@@ -406,7 +447,8 @@ class NphiesAgentRouter:
                     AgentType.CLAIMTRACKERLINC, 
                     "agents/tracker", 
                     "check_duplicate", 
-                    tracker_payload
+                    tracker_payload,
+                    auth_token
                 )
                 results.append(result)
             except Exception as e: